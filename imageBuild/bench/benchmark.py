@@ -0,0 +1,334 @@
+#!/usr/bin/env python3
+"""
+Offline benchmark of imageBuild.py.
+
+A synthetic build tree is generated in a work directory: sbe images with a
+fake sbe_tools.tar.gz holding the stand-in tools of bench/sbe_tools, section
+archives of configurable size and entry count, a golden image, a debug tar
+and the config file. It is built with imageBuild.py --trace and the time of
+each stage and of the whole build are appended to a results file. No sbe/ekb
+repository, network access or signing environment is needed.
+
+The stand-in tools are not the real pak formats or signing, their cost only
+roughly follows the real tools. Compare results of the same machine and
+parameters only.
+"""
+import sys
+import os
+import argparse
+import json
+import time
+import shlex
+import random
+import shutil
+import tarfile
+import platform
+import datetime
+import subprocess
+import statistics
+
+benchDir = os.path.dirname(os.path.abspath(__file__))
+imageToolDir = os.path.dirname(benchDir)
+imageBuildPy = os.path.join(imageToolDir, 'imageBuild.py')
+
+sys.path.insert(0, os.path.join(benchDir, 'sbe_tools', 'tools', 'pymod'))
+import pakcore as pak
+
+# Section kinds, in the order sections are given them
+#   sign: hash list signed with signPak, then image hash (like 'boot')
+#   signNoHash: same, with entries kept out of the hash list (like 'rt')
+#   hash: image hash only, with a placeholder entry (like 'bmc')
+#   asis: used as merged (like 'debug')
+sectionKinds = ['sign', 'signNoHash', 'hash', 'asis']
+
+def entryData(rng, size, compress):
+    # Half random, half zeros so compressed entries have work to do
+    randomSize = size // 2 if compress else size
+    return rng.randbytes(randomSize) + bytes(size - randomSize)
+
+def generateArchive(path, sectionName, index, opts, rng):
+    archive = pak.Archive(path)
+    method = pak.CM.zlib if opts.compress else pak.CM.store
+    if index == 0:
+        archive.add(sectionName + '/info.txt', pak.CM.store, b'benchmark build\n')
+    for entry in range(opts.entries):
+        archive.add('%s/a%d/e%d.bin' % (sectionName, index, entry), method,
+                    entryData(rng, opts.entry_size * 1024, opts.compress))
+    return archive.save()
+
+def generateSbeTools(tarPath):
+    with tarfile.open(tarPath, 'w:gz') as tar:
+        tar.add(os.path.join(benchDir, 'sbe_tools'), arcname='sbe_tools')
+        tar.add(os.path.join(imageToolDir, 'eccEngine.py'), arcname='sbe_tools/eccEngine.py')
+
+def generateDebugTar(tarPath, rng, size):
+    toolsDir = os.path.join(os.path.dirname(tarPath), 'odyssey_debug_files_tools')
+    os.makedirs(toolsDir, exist_ok=True)
+    with open(os.path.join(toolsDir, 'symbols'), 'wb') as f:
+        f.write(entryData(rng, size, True))
+    with tarfile.open(tarPath, 'w:gz') as tar:
+        tar.add(toolsDir, arcname='odyssey_debug_files_tools')
+    shutil.rmtree(toolsDir)
+
+def generateGolden(tarPath, rng, size):
+    imagePath = tarPath[:-len('.tar.gz')]
+    with open(imagePath, 'wb') as f:
+        f.write(entryData(rng, size, True))
+    with tarfile.open(tarPath, 'w:gz') as tar:
+        tar.add(imagePath, arcname=os.path.basename(imagePath))
+    os.remove(imagePath)
+
+def roundUp(value, alignment):
+    return (value + alignment - 1) // alignment * alignment
+
+def generateTree(workDir, opts):
+    """
+    Generate the synthetic build tree in workDir, unless it was generated with
+    the same parameters before. Returns the config file.
+    """
+    params = generatorParams(opts)
+    paramsFile = os.path.join(workDir, 'params.json')
+    configFile = os.path.join(workDir, 'bench_image_config')
+    if not opts.regenerate and os.path.exists(paramsFile):
+        with open(paramsFile) as f:
+            if json.load(f) == params:
+                print("INFO: Reusing generated tree in %s" % workDir)
+                return configFile
+
+    print("INFO: Generating tree in %s" % workDir)
+    for subDir in ('sbe', 'ekb', 'paks', 'pristine', 'out'):
+        if os.path.exists(os.path.join(workDir, subDir)):
+            shutil.rmtree(os.path.join(workDir, subDir))
+    rng = random.Random(opts.seed)
+    odysseyDir = os.path.join(workDir, 'sbe', 'images', 'odyssey')
+    os.makedirs(odysseyDir)
+    os.makedirs(os.path.join(workDir, 'ekb'))
+    os.makedirs(os.path.join(workDir, 'paks'))
+    os.makedirs(os.path.join(workDir, 'pristine'))
+
+    generateSbeTools(os.path.join(workDir, 'sbe', 'images', 'sbe_tools.tar.gz'))
+    generateGolden(os.path.join(odysseyDir, 'golden_odyssey_nor_DD1.img.tar.gz'), rng,
+                   opts.golden_size * 1024)
+    generateDebugTar(os.path.join(workDir, 'pristine', 'odyssey_sbe_debug_DD1.tar.gz'), rng,
+                     opts.debug_size * 1024)
+
+    sections = {}
+    for i in range(opts.sections):
+        sectionName = 'sec%d' % i
+        kind = sectionKinds[i % len(sectionKinds)]
+        archives = []
+        size = 0
+        for index in range(opts.archives):
+            path = os.path.join(workDir, 'paks', '%s_%d.pak' % (sectionName, index))
+            size += generateArchive(path, sectionName, index, opts, rng)
+            archives.append(path)
+
+        # Room for the hash list, signature and image hash
+        headroom = 64*1024 + opts.archives * opts.entries * 256
+        info = {
+            'archives'       : archives,
+            'partition_size' : roundUp(size + headroom, 4096),
+        }
+        if kind in ('sign', 'signNoHash'):
+            info['hashlist'] = 'hash.list'
+            info['hashpath'] = sectionName
+            info['imagehash'] = 'image.hash'
+        if kind == 'signNoHash':
+            info['noHash'] = [sectionName + '/info.txt']
+        if kind == 'hash':
+            info['files'] = [(sectionName + '/attr.ovrd', 'EMPTY')]
+            info['noHash'] = [sectionName + '/info.txt']
+            info['imagehash'] = 'image.hash'
+        sections[sectionName] = info
+
+    config = {
+        'sbeTools'       : 'sbe_tools.tar.gz',
+        'concat'         : opts.copies,
+        'golden_image'   : '%sbeImageDir%/odyssey/golden_odyssey_nor_DD1.img.tar.gz',
+        'image_sections' : sections,
+    }
+    with open(configFile, 'w') as f:
+        f.write("# Generated by bench/benchmark.py\n")
+        f.write(repr(config))
+        f.write("\n")
+
+    with open(paramsFile, 'w') as f:
+        json.dump(params, f)
+    return configFile
+
+def generatorParams(opts):
+    return {key: getattr(opts, key) for key in ('sections', 'archives', 'entries', 'entry_size',
+                                                'compress', 'copies', 'golden_size',
+                                                'debug_size', 'seed')}
+
+def stageTimes(traceFile):
+    """
+    Seconds per build stage of the trace, and of the whole build
+    """
+    with open(traceFile) as f:
+        events = json.load(f)['traceEvents']
+    mainPid = [event['pid'] for event in events
+               if event['ph'] == 'M' and event['args']['name'] == 'imageBuild'][0]
+    stages = {}
+    for event in events:
+        if event['ph'] == 'X' and event['pid'] == mainPid and event['cat'] in ('stage', 'build'):
+            stages[event['name']] = stages.get(event['name'], 0.0) + event['dur'] / 1e6
+    return stages
+
+def runBuild(workDir, configFile, opts):
+    outDir = os.path.join(workDir, 'out')
+    if not opts.warm and os.path.exists(outDir):
+        shutil.rmtree(outDir)
+
+    # The build rewrites the debug tar
+    shutil.copy(os.path.join(workDir, 'pristine', 'odyssey_sbe_debug_DD1.tar.gz'),
+                os.path.join(workDir, 'sbe', 'images', 'odyssey'))
+
+    traceFile = os.path.join(workDir, 'trace.json')
+    cmd = [sys.executable, imageBuildPy, configFile,
+           '--ekb_images', os.path.join(workDir, 'ekb'),
+           '--sbe', os.path.join(workDir, 'sbe'),
+           '--no_downloads', '-o', outDir, '-n', 'pnor.bin',
+           '--trace', traceFile] + shlex.split(opts.build_args)
+    env = dict(os.environ)
+    if not env.get('SIGNING_BASE_DIR') and not env.get('SIGNING_RHEL_PATH'):
+        env['SIGNING_RHEL_PATH'] = '/nonexistent'
+
+    logFile = os.path.join(workDir, 'build.log')
+    start = time.perf_counter()
+    with open(logFile, 'w') as log:
+        resp = subprocess.run(cmd, stdout=log, stderr=subprocess.STDOUT, env=env, cwd=workDir)
+    total = time.perf_counter() - start
+    if resp.returncode != 0:
+        with open(logFile) as log:
+            sys.stdout.write("".join(log.readlines()[-20:]))
+        print("ERROR: build failed with rc %d, see %s" % (resp.returncode, logFile))
+        sys.exit(1)
+
+    return {'total': round(total, 4), 'stages': stageTimes(traceFile)}
+
+def gitCommit():
+    resp = subprocess.run(['git', '-C', imageToolDir, 'rev-parse', '--short', 'HEAD'],
+                          stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    if resp.returncode != 0:
+        return None
+    commit = resp.stdout.decode().strip()
+    resp = subprocess.run(['git', '-C', imageToolDir, 'status', '--porcelain', '--untracked-files=no'],
+                          stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    if resp.stdout.strip():
+        commit += '-dirty'
+    return commit
+
+def medians(runs):
+    result = {'total': statistics.median(run['total'] for run in runs)}
+    for name in runs[0]['stages']:
+        result[name] = statistics.median(run['stages'].get(name, 0.0) for run in runs)
+    return result
+
+def loadResults(resultsFile):
+    if not os.path.exists(resultsFile):
+        return []
+    with open(resultsFile) as f:
+        return json.load(f)
+
+def saveResults(resultsFile, results):
+    tmpFile = "%s.%d.tmp" % (resultsFile, os.getpid())
+    with open(tmpFile, 'w') as f:
+        json.dump(results, f, indent=1)
+    os.replace(tmpFile, resultsFile)
+
+def printTable(record, previous):
+    print()
+    if previous:
+        print("Compared with %s (%s)" % (previous['time'], previous.get('commit')))
+    median = record['median']
+    width = max(len(name) for name in median)
+    print("%-*s %10s %10s %8s" % (width, 'Stage', 'Median s', 'Previous', 'Change'))
+    for name, seconds in median.items():
+        before = previous['median'].get(name) if previous else None
+        change = ''
+        if before:
+            change = "%+.1f%%" % ((seconds - before) / before * 100)
+        print("%-*s %10.3f %10s %8s" % (width, name, seconds,
+                                        '%.3f' % before if before is not None else '-', change))
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark of imageBuild.py",
+                                     epilog="example: benchmark.py --sections 8 --entries 50 "
+                                     "--entry_size 512 --build_args '-j 4 --ecc_engine builtin'")
+    parser.add_argument('--workdir', default='./bench_work',
+                        help='Directory for the generated tree and builds. default ./bench_work')
+    parser.add_argument('--results', default=None,
+                        help='JSON file the results are appended to. '
+                        'default <workdir>/results.json')
+    parser.add_argument('--label', default='',
+                        help='Label stored with the results')
+    parser.add_argument('--sections', type=int, default=6,
+                        help='Number of image sections. default 6')
+    parser.add_argument('--archives', type=int, default=2,
+                        help='Archives merged into each section. default 2')
+    parser.add_argument('--entries', type=int, default=16,
+                        help='Entries per archive. default 16')
+    parser.add_argument('--entry_size', type=int, default=256, metavar='KB',
+                        help='Size of each entry in KB. default 256')
+    parser.add_argument('--compress', action='store_true',
+                        help='Store entries zlib compressed (half of each entry is zeros)')
+    parser.add_argument('--copies', type=int, default=2,
+                        help="Image copies ('concat' of the config). default 2")
+    parser.add_argument('--golden_size', type=int, default=1024, metavar='KB',
+                        help='Size of the golden image in KB. default 1024')
+    parser.add_argument('--debug_size', type=int, default=1024, metavar='KB',
+                        help='Size of the debug tar content in KB. default 1024')
+    parser.add_argument('--seed', type=int, default=1,
+                        help='Seed of the generated data. default 1')
+    parser.add_argument('--regenerate', action='store_true',
+                        help='Generate the tree even if it exists with the same parameters')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Number of builds, the median is reported. default 3')
+    parser.add_argument('--warm', action='store_true',
+                        help="Keep the output directory between builds, e.g. with "
+                        "--build_args '--cache_dir ... --incremental'")
+    parser.add_argument('--build_args', default='',
+                        help='Additional imageBuild.py options')
+    opts = parser.parse_args()
+
+    workDir = os.path.abspath(opts.workdir)
+    os.makedirs(workDir, exist_ok=True)
+    resultsFile = os.path.abspath(opts.results or os.path.join(workDir, 'results.json'))
+
+    configFile = generateTree(workDir, opts)
+
+    runs = []
+    for i in range(opts.repeat):
+        run = runBuild(workDir, configFile, opts)
+        print("INFO: build %d/%d: %.3f s" % (i+1, opts.repeat, run['total']))
+        runs.append(run)
+
+    record = {
+        'time'      : datetime.datetime.now().isoformat(timespec='seconds'),
+        'label'     : opts.label,
+        'commit'    : gitCommit(),
+        'host'      : platform.node(),
+        'cpus'      : os.cpu_count(),
+        'python'    : platform.python_version(),
+        'params'    : generatorParams(opts),
+        'buildArgs' : opts.build_args,
+        'warm'      : opts.warm,
+        'runs'      : runs,
+        'median'    : medians(runs),
+    }
+
+    results = loadResults(resultsFile)
+    previous = None
+    for result in reversed(results):
+        if all(result.get(key) == record[key] for key in ('params', 'buildArgs', 'warm', 'host')):
+            previous = result
+            break
+    results.append(record)
+    saveResults(resultsFile, results)
+
+    printTable(record, previous)
+    print("\nINFO: Results appended to %s" % resultsFile)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+"""
+Benchmark stand-in for the sbe imageTool.py.
+
+  imageTool.py --pakToolDir <dir> signPak --pakFiles <section>=<archive> ...
+  imageTool.py --pakToolDir <dir> pakHash --pakFiles <section>=<archive> ...
+
+signPak adds <section>/hash.list.sig next to the section's hash list, pakHash
+adds image.hash. Both change the archive in place like the real tool. The
+'signature' is a digest, no keys are needed.
+"""
+import argparse
+import hashlib
+import os
+import sys
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--pakToolDir', required=True)
+parser.add_argument('command', choices=['signPak', 'pakHash'])
+parser.add_argument('--pakFiles', nargs='+', required=True)
+args = parser.parse_args()
+
+sys.path.insert(0, os.path.join(args.pakToolDir, 'pymod'))
+import pakcore as pak
+
+for pakFile in args.pakFiles:
+    (sectionName, path) = pakFile.split('=', 1)
+    archive = pak.Archive(path)
+    archive.load()
+    if args.command == 'signPak':
+        hashList = archive.extract(sectionName + '/hash.list')
+        archive.add(sectionName + '/hash.list.sig', pak.CM.store,
+                    hashlib.sha512(hashList).digest())
+    else:
+        with open(path, 'rb') as f:
+            archive.add('image.hash', pak.CM.store, hashlib.sha3_512(f.read()).digest())
+    archive.save()
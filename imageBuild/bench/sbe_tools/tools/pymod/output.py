@@ -0,0 +1,28 @@
+"""
+Benchmark stand-in for the pak tools output module. Nothing is printed.
+"""
+
+class _Levels:
+    CRITICAL = 50
+    DEBUG = 10
+
+class _Out:
+    levels = _Levels()
+
+    def __init__(self):
+        self.level = _Levels.CRITICAL
+        self.indent = 0
+
+    def setConsoleLevel(self, level):
+        self.level = level
+
+    def print(self, *args):
+        pass
+
+    def moreIndent(self):
+        self.indent += 1
+
+    def lessIndent(self):
+        self.indent -= 1
+
+out = _Out()
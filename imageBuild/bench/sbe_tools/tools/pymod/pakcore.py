@@ -0,0 +1,100 @@
+"""
+Benchmark stand-in for pakcore.
+
+Implements the part of the pakcore API used by imageBuild.py. The archive
+format is a simple one of its own, not the real PAK format:
+
+    'PAK1' <entry count:u32>
+    per entry: <name length:u16> <method:u8> <data length:u32> <name> <data>
+"""
+import fnmatch
+import hashlib
+import struct
+import zlib
+
+MAGIC = b'PAK1'
+
+class ArchiveError(Exception):
+    pass
+
+class CM:
+    store = 0
+    zlib = 1
+
+class Entry:
+    def __init__(self, name, method, data=None, raw=None):
+        self.name = name
+        self.method = method
+        if raw is None:
+            raw = zlib.compress(data) if method == CM.zlib else bytes(data)
+        self.raw = raw
+        self.hashValue = None
+
+    @property
+    def data(self):
+        return zlib.decompress(self.raw) if self.method == CM.zlib else self.raw
+
+    def hash(self):
+        self.hashValue = hashlib.sha3_512(self.data).hexdigest()
+        return self.hashValue
+
+class Archive:
+    def __init__(self, filename=None):
+        self.filename = filename
+        self.entries = []
+
+    def __iter__(self):
+        return iter(list(self.entries))
+
+    def load(self):
+        with open(self.filename, 'rb') as f:
+            buf = f.read()
+        if buf[:4] != MAGIC:
+            raise ArchiveError("%s: not a pak archive" % self.filename)
+        (count,) = struct.unpack('>I', buf[4:8])
+        offset = 8
+        self.entries = []
+        for _ in range(count):
+            (nameLength, method, rawLength) = struct.unpack('>HBI', buf[offset:offset+7])
+            offset += 7
+            name = buf[offset:offset+nameLength].decode()
+            offset += nameLength
+            self.entries.append(Entry(name, method, raw=buf[offset:offset+rawLength]))
+            offset += rawLength
+
+    def save(self):
+        parts = [MAGIC, struct.pack('>I', len(self.entries))]
+        for entry in self.entries:
+            name = entry.name.encode()
+            parts += [struct.pack('>HBI', len(name), entry.method, len(entry.raw)),
+                      name, entry.raw]
+        data = b''.join(parts)
+        with open(self.filename, 'wb') as f:
+            f.write(data)
+        return len(data)
+
+    def add(self, name, method, data):
+        self.entries.append(Entry(name, method, data))
+
+    def append(self, entry):
+        self.entries.append(entry)
+
+    def remove(self, entry):
+        self.entries.remove(entry)
+
+    def find(self, patterns):
+        result = [entry for entry in self.entries
+                  if any(fnmatch.fnmatch(entry.name, p) for p in patterns)]
+        if not result:
+            raise ArchiveError("No entries matching %s" % patterns)
+        return result
+
+    def extract(self, name):
+        for entry in self.entries:
+            if entry.name == name:
+                return entry.data
+        raise ArchiveError("%s not found" % name)
+
+    def createHashList(self):
+        return ''.join("%s %s\n" % (entry.name, entry.hashValue)
+                       for entry in self.entries if entry.hashValue).encode()
@@ -0,0 +1,205 @@
+"""
+Timing and resource trace of image builds.
+
+A span records the wall time, the CPU time of the process and of its waited
+for children, the bytes read and written (rchar/wchar of /proc/self/io, which
+includes reaped children) and the peak RSS of the process and its children.
+CPU time and I/O are process wide, so spans running on several threads at
+the same time see each other's usage.
+
+Tracing is off until enable() is called, spans and run() are then almost free.
+The events are written in the Chrome trace format, which chrome://tracing and
+Perfetto can load.
+"""
+import os
+import time
+import json
+import resource
+import threading
+import functools
+import contextlib
+import subprocess
+
+_enabled = False
+_events = []
+_mainPid = os.getpid()
+_start = time.perf_counter()
+
+def enable():
+    global _enabled, _mainPid, _start
+    _enabled = True
+    _mainPid = os.getpid()
+    _start = time.perf_counter()
+
+def enabled():
+    return _enabled
+
+def _readIO():
+    try:
+        with open('/proc/self/io') as f:
+            counters = dict(line.split(':') for line in f)
+        return (int(counters['rchar']), int(counters['wchar']))
+    except (OSError, KeyError, ValueError):
+        return (0, 0)
+
+def _sample():
+    selfUsage = resource.getrusage(resource.RUSAGE_SELF)
+    childUsage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    (readBytes, writeBytes) = _readIO()
+    return {
+        'time'       : time.perf_counter(),
+        'cpu'        : selfUsage.ru_utime + selfUsage.ru_stime,
+        'childCpu'   : childUsage.ru_utime + childUsage.ru_stime,
+        'readBytes'  : readBytes,
+        'writeBytes' : writeBytes,
+        # KiB on Linux
+        'maxRss'     : max(selfUsage.ru_maxrss, childUsage.ru_maxrss),
+    }
+
+def _record(name, category, start, args):
+    end = _sample()
+    eventArgs = dict(args)
+    for key in ('cpu','childCpu'):
+        eventArgs[key] = round(end[key] - start[key], 6)
+    for key in ('readBytes','writeBytes'):
+        eventArgs[key] = end[key] - start[key]
+    eventArgs['maxRssKB'] = end['maxRss']
+    _events.append({
+        'name' : name,
+        'cat'  : category,
+        'ph'   : 'X',
+        'ts'   : round((start['time'] - _start) * 1e6, 1),
+        'dur'  : round((end['time'] - start['time']) * 1e6, 1),
+        'pid'  : os.getpid(),
+        'tid'  : threading.get_native_id(),
+        'args' : eventArgs,
+    })
+
+@contextlib.contextmanager
+def span(name, category='stage', **args):
+    """
+    Record the code run in the with block as span name. args are shown with
+    the span in the trace viewer.
+    """
+    if not _enabled:
+        yield
+        return
+    start = _sample()
+    try:
+        yield
+    finally:
+        _record(name, category, start, args)
+
+def traced(func):
+    """
+    Decorator recording each call of func as a span named after it
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with span(func.__name__):
+            return func(*args, **kwargs)
+    return wrapper
+
+def _commandName(args):
+    if isinstance(args, (str, bytes)):
+        args = args.split()
+    if not args:
+        return '?'
+    name = os.path.basename(args[0])
+    if name == 'git':
+        # Named after the git command, skipping -C <path> and -c <config>
+        i = 1
+        while i < len(args) and args[i].startswith('-'):
+            i += 2 if args[i] in ('-C','-c') else 1
+        if i < len(args):
+            name += ' ' + args[i]
+    return name
+
+def _commandLine(args):
+    if isinstance(args, (str, bytes)):
+        return args
+    return " ".join(str(arg) for arg in args)
+
+def run(args, name=None, **kwargs):
+    """
+    subprocess.run() recorded as a span, named after the command unless name
+    is given
+    """
+    with span(name or _commandName(args), 'subprocess', cmd=_commandLine(args)):
+        return subprocess.run(args, **kwargs)
+
+class Popen(subprocess.Popen):
+    """
+    subprocess.Popen recorded as a span from the start of the process until it
+    is waited for
+    """
+    def __init__(self, args, name=None, **kwargs):
+        self._traceName = name or _commandName(args)
+        self._traceStart = _sample() if _enabled else None
+        self._traceCmd = _commandLine(args)
+        super().__init__(args, **kwargs)
+
+    def wait(self, timeout=None):
+        returncode = super().wait(timeout)
+        if self._traceStart:
+            start, self._traceStart = self._traceStart, None
+            _record(self._traceName, 'subprocess', start, {'cmd': self._traceCmd})
+        return returncode
+
+def mark():
+    """
+    Position in the trace, for takeEvents() and summary()
+    """
+    return len(_events)
+
+def takeEvents(position):
+    """
+    Remove and return the events recorded since position. Used to hand the
+    events of a forked worker back to the parent.
+    """
+    events = _events[position:]
+    del _events[position:]
+    return events
+
+def addEvents(events):
+    _events.extend(events)
+
+def write(fpath):
+    """
+    Write all events to fpath in the Chrome trace format
+    """
+    metadata = []
+    for pid in sorted(set(event['pid'] for event in _events)):
+        metadata.append({'name': 'process_name', 'ph': 'M', 'pid': pid,
+                         'args': {'name': 'imageBuild' if pid == _mainPid
+                                  else 'worker %d' % pid}})
+    tmpPath = "%s.%d.tmp" % (fpath, os.getpid())
+    with open(tmpPath, 'w') as f:
+        json.dump({'traceEvents': metadata + _events, 'displayTimeUnit': 'ms'}, f)
+    os.replace(tmpPath, fpath)
+
+def summary(position=0):
+    """
+    Return the table of the events since position, totals per span name in
+    order of first use
+    """
+    totals = {}
+    for event in _events[position:]:
+        args = event['args']
+        total = totals.setdefault(event['name'], [0, 0.0, 0.0, 0.0, 0, 0, 0])
+        total[0] += 1
+        total[1] += event['dur'] / 1e6
+        total[2] += args['cpu']
+        total[3] += args['childCpu']
+        total[4] += args['readBytes']
+        total[5] += args['writeBytes']
+        total[6] = max(total[6], args['maxRssKB'])
+
+    mb = 1024.0 * 1024.0
+    width = max([len(name) for name in totals] + [4])
+    lines = ["%-*s %6s %9s %9s %9s %9s %9s %9s" % (width, 'Span', 'Count', 'Wall s',
+             'CPU s', 'Child s', 'Read MB', 'Write MB', 'RSS MB')]
+    for name, (count, wall, cpu, childCpu, readBytes, writeBytes, maxRss) in totals.items():
+        lines.append("%-*s %6d %9.3f %9.3f %9.3f %9.1f %9.1f %9.1f" % (width, name, count,
+                     wall, cpu, childCpu, readBytes / mb, writeBytes / mb, maxRss / 1024.0))
+    return "\n".join(lines)
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+"""
+P8 ECC inject/verify/remove, bit exact with 'ecc --p8' from sbe_tools.
+
+Every 8 byte data word (big endian) is followed by one ECC byte. The ECC is
+linear over GF(2), so the ECC of a word is the XOR of the ECC of each of its
+bytes. Per byte position a 256 entry table is built once, and a chunk is
+processed with bytes.translate() over the strided columns of the chunk plus
+a big integer XOR. No per-word Python code runs.
+
+Chunks of the input are spread over a process pool, each worker reads
+and writes its own range of the files.
+"""
+import os
+import sys
+import mmap
+import argparse
+import concurrent.futures
+import multiprocessing
+
+# ECC[n] = parity(eccMatrix[n] & data), row 0 is the LSB of the ECC byte
+eccMatrix = [
+    0x0000e8423c0f99ff,
+    0x00e8423c0f99ff00,
+    0xe8423c0f99ff0000,
+    0x423c0f99ff0000e8,
+    0x3c0f99ff0000e842,
+    0x0f99ff0000e8423c,
+    0x99ff0000e8423c0f,
+    0xff0000e8423c0f99,
+]
+
+WORD_SIZE = 8
+ECC_WORD_SIZE = WORD_SIZE + 1
+
+# Data bytes per chunk handed to a worker, must be a multiple of WORD_SIZE
+CHUNK_SIZE = 8*1024*1024
+
+def generateECC(data):
+    result = 0
+    for i in range(8):
+        result |= (bin(eccMatrix[i] & data).count('1') & 1) << i
+    return result
+
+# eccTables[n][b] is the ECC of a word that only has byte b at position n
+eccTables = [bytes(generateECC(b << (8*(WORD_SIZE-1-n))) for b in range(256))
+             for n in range(WORD_SIZE)]
+
+def eccBytes(data):
+    """
+    Return the ECC byte of each 8 byte word in data
+    """
+    words = len(data) // WORD_SIZE
+    result = 0
+    for n in range(WORD_SIZE):
+        result ^= int.from_bytes(data[n::WORD_SIZE].translate(eccTables[n]), 'big')
+    return result.to_bytes(words, 'big')
+
+def injectChunk(data):
+    words = len(data) // WORD_SIZE
+    out = bytearray(words * ECC_WORD_SIZE)
+    for n in range(WORD_SIZE):
+        out[n::ECC_WORD_SIZE] = data[n::WORD_SIZE]
+    out[WORD_SIZE::ECC_WORD_SIZE] = eccBytes(data)
+    return out
+
+def removeChunk(data):
+    words = len(data) // ECC_WORD_SIZE
+    out = bytearray(words * WORD_SIZE)
+    for n in range(WORD_SIZE):
+        out[n::WORD_SIZE] = data[n::ECC_WORD_SIZE]
+    return out
+
+def verifyChunk(data):
+    """
+    Return the indexes of the words in data whose ECC byte is wrong
+    """
+    expected = eccBytes(removeChunk(data))
+    actual = bytes(data[WORD_SIZE::ECC_WORD_SIZE])
+    if expected == actual:
+        return []
+    return [i for i in range(len(actual)) if expected[i] != actual[i]]
+
+def _injectWorker(srcPath, dstPath, offset, length):
+    with open(srcPath, 'rb') as src, open(dstPath, 'r+b') as dst:
+        data = os.pread(src.fileno(), length, offset)
+        os.pwrite(dst.fileno(), injectChunk(data), offset // WORD_SIZE * ECC_WORD_SIZE)
+
+def _removeWorker(srcPath, dstPath, offset, length):
+    with open(srcPath, 'rb') as src, open(dstPath, 'r+b') as dst:
+        data = os.pread(src.fileno(), length, offset)
+        os.pwrite(dst.fileno(), removeChunk(data), offset // ECC_WORD_SIZE * WORD_SIZE)
+
+def _verifyWorker(srcPath, dataPath, offset, length):
+    with open(srcPath, 'rb') as src:
+        with mmap.mmap(src.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            chunk = m[offset:offset+length]
+    bad = set(verifyChunk(chunk))
+    if dataPath:
+        # Also compare the data words with the file the ECC was made from
+        dataOffset = offset // ECC_WORD_SIZE * WORD_SIZE
+        with open(dataPath, 'rb') as f:
+            expected = os.pread(f.fileno(), len(chunk) // ECC_WORD_SIZE * WORD_SIZE, dataOffset)
+        data = removeChunk(chunk)
+        if data != expected:
+            bad.update(i for i in range(len(data) // WORD_SIZE)
+                       if data[i*WORD_SIZE:(i+1)*WORD_SIZE] != expected[i*WORD_SIZE:(i+1)*WORD_SIZE])
+    return [offset // ECC_WORD_SIZE * WORD_SIZE + i * WORD_SIZE for i in sorted(bad)]
+
+def _runChunks(worker, args, size, chunkSize, jobs):
+    chunks = [(offset, min(chunkSize, size - offset)) for offset in range(0, size, chunkSize)]
+    if jobs is None:
+        jobs = os.cpu_count() or 1
+    if jobs <= 1 or len(chunks) <= 1:
+        return [worker(*args, offset, length) for (offset, length) in chunks]
+    # Not forked: the caller may run threads (the build stages), and a fork
+    # of a multi-threaded process can deadlock in the child
+    method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs,
+            mp_context=multiprocessing.get_context(method)) as pool:
+        futures = [pool.submit(worker, *args, offset, length) for (offset, length) in chunks]
+        return [f.result() for f in futures]
+
+def inject(srcPath, dstPath, jobs=None):
+    """
+    Write srcPath with ECC to dstPath. The size of srcPath must be a multiple of 8.
+    """
+    size = os.path.getsize(srcPath)
+    if size % WORD_SIZE:
+        raise ValueError("%s: size %d is not a multiple of %d" % (srcPath, size, WORD_SIZE))
+    with open(dstPath, 'wb') as dst:
+        dst.truncate(size // WORD_SIZE * ECC_WORD_SIZE)
+    _runChunks(_injectWorker, (srcPath, dstPath), size, CHUNK_SIZE, jobs)
+
+def remove(srcPath, dstPath, jobs=None):
+    """
+    Write srcPath without its ECC bytes to dstPath
+    """
+    size = os.path.getsize(srcPath)
+    if size % ECC_WORD_SIZE:
+        raise ValueError("%s: size %d is not a multiple of %d" % (srcPath, size, ECC_WORD_SIZE))
+    with open(dstPath, 'wb') as dst:
+        dst.truncate(size // ECC_WORD_SIZE * WORD_SIZE)
+    _runChunks(_removeWorker, (srcPath, dstPath), size,
+               CHUNK_SIZE // WORD_SIZE * ECC_WORD_SIZE, jobs)
+
+def verify(srcPath, jobs=None, dataPath=None):
+    """
+    Return the data offsets of all words in srcPath with a wrong ECC byte, or,
+    if dataPath is given, different from the word of dataPath
+    """
+    size = os.path.getsize(srcPath)
+    if size % ECC_WORD_SIZE:
+        raise ValueError("%s: size %d is not a multiple of %d" % (srcPath, size, ECC_WORD_SIZE))
+    if dataPath and os.path.getsize(dataPath) != size // ECC_WORD_SIZE * WORD_SIZE:
+        raise ValueError("%s: size %d doesn't match %s" % (srcPath, size, dataPath))
+    bad = []
+    for result in _runChunks(_verifyWorker, (srcPath, dataPath), size,
+                             CHUNK_SIZE // WORD_SIZE * ECC_WORD_SIZE, jobs):
+        bad.extend(result)
+    return bad
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="P8 ECC inject/verify/remove")
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('--inject', metavar='FILE', help='Add ECC to FILE')
+    group.add_argument('--remove', metavar='FILE', help='Remove ECC from FILE')
+    group.add_argument('--verify', metavar='FILE', help='Check the ECC of FILE')
+    parser.add_argument('--output', metavar='FILE', help='Output file for --inject/--remove')
+    parser.add_argument('--p8', action='store_true', help='P8 ECC format (the only one supported)')
+    parser.add_argument('-j','--jobs', type=int, default=None,
+                        help='Number of worker processes. default: number of cpus')
+    args = parser.parse_args()
+
+    if (args.inject or args.remove) and not args.output:
+        parser.error('--output is required')
+    try:
+        if args.inject:
+            inject(args.inject, args.output, args.jobs)
+        elif args.remove:
+            remove(args.remove, args.output, args.jobs)
+        else:
+            bad = verify(args.verify, args.jobs)
+            for offset in bad[:16]:
+                print("ECC error in word at offset 0x%x" % offset)
+            if bad:
+                print("%d ECC errors found" % len(bad), file=sys.stderr)
+                sys.exit(1)
+    except (OSError, ValueError) as e:
+        print("ERROR: %s" % e, file=sys.stderr)
+        sys.exit(1)
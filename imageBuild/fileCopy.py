@@ -0,0 +1,108 @@
+"""
+Copy helpers used to assemble large images without reading them into memory.
+
+Data is copied in the kernel where possible: reflink (FICLONERANGE) on file
+systems that share extents, then copy_file_range(), then sendfile(). The last
+fallback is a copy through a fixed size buffer.
+"""
+import os
+import fcntl
+import struct
+
+# _IOW(0x94, 13, struct file_clone_range)
+FICLONERANGE = 0x4020940d
+
+BUFFER_SIZE = 1024*1024
+
+def _cloneRange(srcFd, dstFd, length, srcOffset, dstOffset):
+    # Extents can only be shared on block boundaries. The length may end
+    # unaligned at the end of the source file.
+    blockSize = os.fstat(dstFd).st_blksize
+    srcSize = os.fstat(srcFd).st_size
+    if srcOffset % blockSize or dstOffset % blockSize:
+        return False
+    if length % blockSize and srcOffset + length != srcSize:
+        return False
+    try:
+        fcntl.ioctl(dstFd, FICLONERANGE,
+                    struct.pack('qQQQ', srcFd, srcOffset, length, dstOffset))
+    except OSError:
+        return False
+    return True
+
+def _copyFileRange(srcFd, dstFd, length, srcOffset, dstOffset):
+    # Returns the number of bytes copied before copy_file_range gave up
+    copied = 0
+    if not hasattr(os, 'copy_file_range'):
+        return copied
+    try:
+        while copied < length:
+            n = os.copy_file_range(srcFd, dstFd, length - copied,
+                                   srcOffset + copied, dstOffset + copied)
+            if n == 0:
+                break
+            copied += n
+    except OSError:
+        pass
+    return copied
+
+def _sendfile(srcFd, dstFd, length, srcOffset, dstOffset):
+    copied = 0
+    try:
+        os.lseek(dstFd, dstOffset, os.SEEK_SET)
+        while copied < length:
+            n = os.sendfile(dstFd, srcFd, srcOffset + copied, length - copied)
+            if n == 0:
+                break
+            copied += n
+    except OSError:
+        pass
+    return copied
+
+def _bufferedCopy(srcFd, dstFd, length, srcOffset, dstOffset):
+    copied = 0
+    while copied < length:
+        data = os.pread(srcFd, min(BUFFER_SIZE, length - copied), srcOffset + copied)
+        if not data:
+            break
+        os.pwrite(dstFd, data, dstOffset + copied)
+        copied += len(data)
+    return copied
+
+def copyRange(srcFd, dstFd, length, srcOffset=0, dstOffset=0):
+    """
+    Copy length bytes from srcOffset in srcFd to dstOffset in dstFd.
+    Returns the number of bytes copied, which is less than length only if
+    the source file is shorter.
+    """
+    if length <= 0:
+        return 0
+    if _cloneRange(srcFd, dstFd, length, srcOffset, dstOffset):
+        return length
+
+    copied = 0
+    for method in (_copyFileRange, _sendfile, _bufferedCopy):
+        copied += method(srcFd, dstFd, length - copied,
+                         srcOffset + copied, dstOffset + copied)
+        if copied == length:
+            break
+    return copied
+
+def copyFile(srcPath, dstFd, dstOffset=0):
+    """
+    Copy all of srcPath to dstOffset in dstFd. Returns the number of bytes copied.
+    """
+    with open(srcPath, 'rb') as src:
+        length = os.fstat(src.fileno()).st_size
+        return copyRange(src.fileno(), dstFd, length, 0, dstOffset)
+
+def concatFiles(dstPath, srcPaths):
+    """
+    Write the concatenation of srcPaths to dstPath. Returns the size of dstPath.
+    """
+    offset = 0
+    with open(dstPath, 'wb') as dst:
+        for srcPath in srcPaths:
+            offset += copyFile(srcPath, dst.fileno(), offset)
+        dst.truncate(offset)
+    return offset
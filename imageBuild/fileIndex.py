@@ -0,0 +1,158 @@
+"""
+Index of the files of a directory tree, used to look up override and binary
+files by name or glob pattern.
+
+The index keeps the mtime of every directory and the size, mtime and digest
+of every file. It can be saved and loaded again: a directory whose mtime is
+unchanged is not listed again, so refreshing the index of a large tree only
+costs a stat per directory. A file changed in place doesn't change the mtime
+of its directory, so digest() checks its size and mtime before using the
+saved digest.
+"""
+import os
+import json
+import fnmatch
+import hashlib
+
+INDEX_VERSION = 1
+
+def fileDigest(fpath):
+    h = hashlib.sha256()
+    with open(fpath, "rb") as f:
+        for chunk in iter(lambda: f.read(1024*1024), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def isPattern(name):
+    return any(c in name for c in '*?[')
+
+class FileIndex:
+    def __init__(self, root, indexFile=None):
+        self.root = os.path.realpath(root)
+        self.indexFile = indexFile
+        # relative dir -> {'mtime': ns, 'dirs': [names], 'files': {name: [size, mtime, digest]}}
+        self.dirs = {}
+        self.byName = {}
+        self.dirty = False
+        if indexFile and os.path.exists(indexFile):
+            try:
+                with open(indexFile) as f:
+                    data = json.load(f)
+                if data.get('version') == INDEX_VERSION and data.get('root') == self.root:
+                    self.dirs = data['dirs']
+            except (OSError, ValueError, KeyError):
+                print(f"WARN ignoring invalid index {indexFile}")
+
+    def refresh(self):
+        """
+        Bring the index up to date with the tree, listing only the directories
+        that changed since the index was saved
+        """
+        oldDirs = self.dirs
+        self.dirs = {}
+        listed = 0
+        visited = set()
+        stack = ['']
+        while stack:
+            relDir = stack.pop()
+            fullDir = os.path.join(self.root, relDir)
+            try:
+                st = os.stat(fullDir)
+            except OSError:
+                continue
+            # Symbolic links may loop
+            if (st.st_dev, st.st_ino) in visited:
+                continue
+            visited.add((st.st_dev, st.st_ino))
+
+            entry = oldDirs.get(relDir)
+            if not entry or entry['mtime'] != st.st_mtime_ns:
+                entry = self._listDir(fullDir, st.st_mtime_ns, entry)
+                listed += 1
+            self.dirs[relDir] = entry
+            for subDir in entry['dirs']:
+                stack.append(os.path.join(relDir, subDir))
+
+        if listed or set(oldDirs) != set(self.dirs):
+            self.dirty = True
+
+        self.byName = {}
+        for relDir in sorted(self.dirs, key=lambda d: (d.count(os.sep) + bool(d), d)):
+            for name in sorted(self.dirs[relDir]['files']):
+                self.byName.setdefault(name, []).append(os.path.join(self.root, relDir, name))
+        return listed
+
+    def _listDir(self, fullDir, mtime, oldEntry):
+        entry = {'mtime': mtime, 'dirs': [], 'files': {}}
+        oldFiles = oldEntry['files'] if oldEntry else {}
+        try:
+            with os.scandir(fullDir) as it:
+                for dirEntry in it:
+                    try:
+                        if dirEntry.is_dir():
+                            entry['dirs'].append(dirEntry.name)
+                        elif dirEntry.is_file():
+                            st = dirEntry.stat()
+                            record = [st.st_size, st.st_mtime_ns, None]
+                            old = oldFiles.get(dirEntry.name)
+                            if old and old[:2] == record[:2]:
+                                record[2] = old[2]
+                            entry['files'][dirEntry.name] = record
+                    except OSError:
+                        continue
+        except OSError as e:
+            print(f"WARN can't list {fullDir}: {e}")
+        entry['dirs'].sort()
+        return entry
+
+    def save(self):
+        if not self.indexFile or not self.dirty:
+            return
+        os.makedirs(os.path.dirname(self.indexFile), exist_ok=True)
+        tmpFile = "%s.%d.tmp" % (self.indexFile, os.getpid())
+        with open(tmpFile, 'w') as f:
+            json.dump({'version': INDEX_VERSION, 'root': self.root, 'dirs': self.dirs}, f)
+        os.replace(tmpFile, self.indexFile)
+        self.dirty = False
+
+    def find(self, name):
+        """
+        Paths of the files called name, the ones closest to the root first
+        """
+        return list(self.byName.get(name, []))
+
+    def glob(self, pattern):
+        """
+        Paths of the files whose name matches pattern, sorted by name
+        """
+        paths = []
+        for name in sorted(fnmatch.filter(self.byName, pattern)):
+            paths.append(self.byName[name][0])
+        return paths
+
+    def _record(self, fpath):
+        relPath = os.path.relpath(os.path.realpath(fpath), self.root)
+        if relPath.startswith(os.pardir):
+            return None
+        (relDir, name) = os.path.split(relPath)
+        entry = self.dirs.get(relDir)
+        if not entry:
+            return None
+        return entry['files'].get(name)
+
+    def __contains__(self, fpath):
+        return self._record(fpath) is not None
+
+    def digest(self, fpath):
+        """
+        sha256 of fpath, from the index if the file is unchanged
+        """
+        record = self._record(fpath)
+        st = os.stat(fpath)
+        if record and record[:2] == [st.st_size, st.st_mtime_ns] and record[2]:
+            return record[2]
+        digest = fileDigest(fpath)
+        if record:
+            record[:] = [st.st_size, st.st_mtime_ns, digest]
+            self.dirty = True
+        return digest
@@ -0,0 +1,303 @@
+"""
+Waiting for changes to files and directory trees.
+
+Watcher compares the files with a snapshot of their size, mtime and inode.
+Changes are noticed with inotify, called through ctypes, which watches the
+parent directory of each file (so files replaced by a rename are seen) and
+every directory of each tree. Where inotify isn't available, or runs out of
+watches, or on request (network file systems don't report remote changes),
+the files are polled instead.
+
+Either way only paths whose stat differs from the snapshot count as changed,
+so files touched and restored don't trigger anything. Once a change is seen,
+wait() returns after no more events arrived for the debounce delay, so a tool
+writing many files causes one rebuild.
+
+The watcher is only set up after a build, so the build takes a Snapshot of
+its inputs when it reads them and the watcher compares with that: inputs
+changed while the build ran trigger the next build at once. Files the build
+writes itself are excluded.
+"""
+import os
+import time
+import errno
+import ctypes
+import select
+import struct
+
+POLL_INTERVAL = 1.0
+
+IN_MODIFY      = 0x00000002
+IN_ATTRIB      = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM  = 0x00000040
+IN_MOVED_TO    = 0x00000080
+IN_CREATE      = 0x00000100
+IN_DELETE      = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF   = 0x00000800
+IN_Q_OVERFLOW  = 0x00004000
+IN_ONLYDIR     = 0x01000000
+IN_ISDIR       = 0x40000000
+IN_NONBLOCK    = 0o4000
+IN_CLOEXEC     = 0o2000000
+
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | \
+             IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+
+_EVENT = struct.Struct('iIII')
+
+class Inotify:
+    def __init__(self):
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        self.libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+        self.dirs = {}
+
+    def addWatch(self, path):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            e = ctypes.get_errno()
+            if e in (errno.ENOENT, errno.ENOTDIR, errno.EACCES):
+                return
+            raise OSError(e, "%s: %s" % (path, os.strerror(e)))
+        self.dirs[wd] = path
+
+    def read(self, timeout):
+        """
+        Events within timeout seconds as (directory, name, mask), with None
+        for a queue overflow. Returns None if there were no events.
+        """
+        (ready, _, _) = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return None
+        try:
+            buf = os.read(self.fd, 64*1024)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset < len(buf):
+            (wd, mask, _, length) = _EVENT.unpack_from(buf, offset)
+            offset += _EVENT.size
+            name = os.fsdecode(buf[offset:offset+length].rstrip(b'\0'))
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                events.append(None)
+            elif wd in self.dirs:
+                events.append((self.dirs[wd], name, mask))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+def _stat(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_size, st.st_mtime_ns, st.st_ino)
+
+def _under(path, tree):
+    return path == tree or path.startswith(tree + os.sep)
+
+def scan(files, trees, exclude=()):
+    """
+    Stats of files and of the files under the directories of trees, None for
+    the missing ones. Paths in exclude are left out.
+    """
+    stats = {}
+    for path in files:
+        stats[path] = _stat(path)
+    for root in trees:
+        if not os.path.isdir(root):
+            stats[root] = _stat(root)
+            continue
+        for (dirPath, _, fileNames) in os.walk(root):
+            for fileName in fileNames:
+                path = os.path.join(dirPath, fileName)
+                stats[path] = _stat(path)
+    for path in exclude:
+        stats.pop(path, None)
+    return stats
+
+class Snapshot:
+    """
+    Stats of files and directory trees taken when a build reads them
+    """
+    def __init__(self):
+        self.files = set()
+        self.trees = set()
+        self.exclude = set()
+        self.stats = {}
+
+    def covers(self, path):
+        return path in self.files or any(_under(path, tree) for tree in self.trees)
+
+    def add(self, files, trees, exclude=()):
+        """
+        Take the stats of the files and trees not taken yet, without the
+        paths in exclude
+        """
+        self.exclude |= set(os.path.abspath(f) for f in exclude)
+        files = set(os.path.abspath(f) for f in files)
+        trees = set(os.path.abspath(t) for t in trees)
+        files = set(f for f in files if not self.covers(f))
+        trees = set(t for t in trees if not self.covers(t))
+        stats = scan(files, trees, self.exclude)
+        self.stats.update((path, st) for (path, st) in stats.items() if st)
+        self.files |= files
+        self.trees |= trees
+
+    def update(self, other):
+        """
+        Add the stats of other, keeping the ones taken here first
+        """
+        stats = {path: st for (path, st) in other.stats.items() if not self.covers(path)}
+        self.files |= other.files
+        self.trees |= other.trees
+        self.exclude |= other.exclude
+        self.stats.update(stats)
+
+class Watcher:
+    def __init__(self, files, trees, poll=False, snapshot=None):
+        """
+        Watch the paths of files and everything under the directories of trees.
+        Changes are relative to snapshot, as far as it covers the paths, and
+        to their current state otherwise.
+        """
+        self.files = set(os.path.abspath(f) for f in files)
+        self.trees = [os.path.abspath(t) for t in trees]
+        self.exclude = snapshot.exclude if snapshot else set()
+        self.snapshot(snapshot)
+
+        self.inotify = None
+        if not poll:
+            try:
+                self.inotify = Inotify()
+                for path in set(os.path.dirname(f) for f in self.files):
+                    self.inotify.addWatch(path)
+                for tree in self.trees:
+                    self._watchTree(tree)
+            except (OSError, AttributeError) as e:
+                # AttributeError: no inotify in this libc
+                print("WARN inotify not available (%s), polling for changes" % e)
+                if self.inotify:
+                    self.inotify.close()
+                self.inotify = None
+
+    def _watchTree(self, tree):
+        self.inotify.addWatch(tree)
+        for (dirPath, dirNames, _) in os.walk(tree):
+            for dirName in dirNames:
+                self.inotify.addWatch(os.path.join(dirPath, dirName))
+
+    def _watched(self, path):
+        return path not in self.exclude and \
+            (path in self.files or any(_under(path, tree) for tree in self.trees))
+
+    def _scan(self, paths=None):
+        """
+        Stats of the watched files, only the ones at or under paths if given
+        """
+        files = [path for path in self.files if paths is None or path in paths]
+        roots = []
+        for tree in self.trees:
+            roots += [tree] if paths is None else [p for p in paths if _under(p, tree)]
+        return scan(files, roots, self.exclude)
+
+    def snapshot(self, snapshot=None):
+        """
+        Take the state the files are compared with, from snapshot for the
+        paths it covers
+        """
+        stats = self._scan()
+        if snapshot:
+            stats = {path: st for (path, st) in stats.items() if not snapshot.covers(path)}
+            stats.update((path, st) for (path, st) in snapshot.stats.items()
+                         if self._watched(path))
+        self.stats = {path: st for (path, st) in stats.items() if st}
+
+    def changes(self, paths=None):
+        """
+        The watched files, at or under paths if given, that differ from the
+        snapshot
+        """
+        current = self._scan(paths)
+        if paths is not None:
+            # Files deleted under the paths, including removed directories
+            for path in paths:
+                for known in self.stats:
+                    if _under(known, path):
+                        current.setdefault(known, _stat(known))
+        else:
+            for known in self.stats:
+                current.setdefault(known, None)
+        return sorted(path for (path, st) in current.items() if self.stats.get(path) != st)
+
+    def _paths(self, events):
+        """
+        Watched paths of inotify events, None if events were lost
+        """
+        paths = set()
+        for event in events:
+            if event is None:
+                return None
+            (dirPath, name, mask) = event
+            path = os.path.join(dirPath, name) if name else dirPath
+            if not self._watched(path):
+                continue
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                self._watchTree(path)
+            paths.add(path)
+        return paths
+
+    def wait(self, delay):
+        """
+        Wait for changes, then for delay seconds without events. Returns the
+        changed paths.
+        """
+        while self.inotify is None:
+            while not self.changes():
+                time.sleep(POLL_INTERVAL)
+            # Settled once two scans delay apart agree
+            last = self._scan()
+            while True:
+                time.sleep(delay)
+                current = self._scan()
+                if current == last:
+                    break
+                last = current
+            changed = self.changes()
+            if changed:
+                return changed
+
+        # Changed since the snapshot, before the watches were set up
+        pending = bool(self.changes())
+        while True:
+            if pending:
+                (paths, pending) = (None, False)
+            else:
+                paths = self._paths(self.inotify.read(None))
+                if paths is not None and not self.changes(paths):
+                    continue
+            while True:
+                events = self.inotify.read(delay)
+                if events is None:
+                    break
+                more = self._paths(events)
+                if paths is None or more is None:
+                    paths = None
+                else:
+                    paths |= more
+            changed = self.changes(paths)
+            if changed:
+                return changed
+
+    def close(self):
+        if self.inotify:
+            self.inotify.close()
+            self.inotify = None
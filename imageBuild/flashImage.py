@@ -0,0 +1,45 @@
+"""
+In process flash image assembly, with the layout of 'flashbuild build-image':
+the section archives back to back in partition order, each padded with zeros
+to its partition size.
+
+The output file is sized up front and memory mapped. Every archive is read
+once and written at its partition offset in every copy of the image. The
+padding is never written, it stays a hole in the sparse file. A tail file,
+the golden image, is copied in the kernel after the last copy.
+
+The partition table is not compiled here, flashbuild compile-ptable still
+does it. The layout is checked against the real flashbuild only by
+--assemble_check and tests/test_flashImage.py.
+"""
+import os
+import mmap
+
+import fileCopy
+
+def assemble(imagePath, partitions, archives, copies=1, tailPath=None):
+    """
+    Write copies of the flash image of partitions, a list of (name, size),
+    with the archives {name: path} to imagePath, followed by tailPath if
+    given. Returns the size of one copy. Raises ValueError if an archive
+    doesn't fit in its partition.
+    """
+    singleSize = sum(size for (_, size) in partitions)
+    tailSize = os.path.getsize(tailPath) if tailPath else 0
+    with open(imagePath, 'w+b') as image:
+        image.truncate(singleSize * copies + tailSize)
+        if singleSize and copies:
+            with mmap.mmap(image.fileno(), singleSize * copies) as m:
+                offset = 0
+                for (name, size) in partitions:
+                    with open(archives[name], 'rb') as f:
+                        data = f.read()
+                    if len(data) > size:
+                        raise ValueError("partition %s overflow: %d > %d" % (name, len(data), size))
+                    for copy in range(copies):
+                        start = copy * singleSize + offset
+                        m[start:start+len(data)] = data
+                    offset += size
+        if tailPath:
+            fileCopy.copyFile(tailPath, image.fileno(), singleSize * copies)
+    return singleSize
@@ -1,14 +1,26 @@
 #!/usr/bin/env python3
 import sys
+import re
 import os
 import argparse
 import textwrap
 import subprocess
 import ast
 import shutil
-import tarfile
-import inspect
-import platform
+import shlex
+import glob
+import fcntl
+import hashlib
+import filecmp
+import json
+import importlib
+import time
+import concurrent.futures
+import multiprocessing
+
+import fileCopy
+import fileIndex
+import buildTrace
 
 
 def checkEnvVarExist(var):
@@ -50,893 +62,2320 @@ def readConfigFile(configFile):
 
     return data
 
-def mergeArchives(sectionName, archiveFileList, baseEntries):
-    # Create an empty archive for the section
-    mergedArchiveFile = os.path.join(mergedDir, sectionName+'.pak')
-    if os.path.exists(mergedArchiveFile): os.remove(mergedArchiveFile)
-    archive = pak.Archive(mergedArchiveFile)
-
-    # Add essential entries
-    for (entryName,entryPath) in baseEntries:
-        entryData = ''.encode()
-        if os.path.exists(entryPath):
-            with open(entryPath, "rb") as f:
-                entryData = f.read()
-
-        archive.add(entryName, pak.CM.store ,entryData)
-    archive.save()
-
-    # Merge archives
-    if len(archiveFileList) > 0:
-        cmd = "%s merge %s %s" % (pakTool, mergedArchiveFile, ' '.join(archiveFileList))
-        resp = subprocess.run(cmd.split())
-        if resp.returncode != 0:
-            print("ERROR: %s failed with rc %d" % (cmd, resp.returncode))
-            exit(1)
-
-    return mergedArchiveFile
-
-def setupRepository(basePath, commit,remote):
-    print("basePath: %s" % basePath)
-    if not os.path.exists(basePath):
-        if not args.no_downloads:
-            #Download repo
-            print("git repo %s does not exist. Attempting to clone it" % basePath)
-            basePath=basePath.rstrip('/')
-            (dir,repo_name) = os.path.split(basePath)
-            os.makedirs(dir,exist_ok=True)
-            os.chdir(dir)
-            print("cwd: %s  repo: %s" % (os.getcwd(),repo_name))
-            cmd = 'git clone -b %s ssh://gerrit-server/%s %s -o gerrit' % (commit, remote, repo_name)
-            print(cmd)
-            resp = subprocess.run(cmd.split())
-            if resp.returncode != 0:
-                print("git clone failed with rc %d" % resp.returncode)
-                os.chdir(cwd)
-                sys.exit(1)
-
-    if not os.path.exists(os.path.join(basePath,'.git')):
-        print("%s is not a git repositry" % basePath,file=sys.stderr)
-        sys.exit(1)
-
-    os.chdir(basePath)
-    if not args.nobranchchange:
-        resp = subprocess.run(["git","checkout",commit],stdout=subprocess.PIPE)
-        if resp.returncode != 0:
-            print("git checkout had returncode %d" % resp.returncode,file=sys.stderr)
-            os.chdir(cwd)
-            sys.exit(1)
-        if args.update:
-            if 'sbe' in remote:
-                cmd = 'git pull'
-                print(cmd)
-                resp = subprocess.run(cmd.split())
-                if resp.returncode != 0:
-                    print("git update failed with rc %d" % resp.returncode)
-                    os.chdir(cwd)
-                    sys.exit(1)
-            elif 'ekb' in remote:
-                cmd = 'git fetch gerrit'
-                print(cmd)
-                resp = subprocess.run(cmd.split())
-                if resp.returncode != 0:
-                    print("git update failed with rc %d" % resp.returncode)
-                    os.chdir(cwd)
-                    sys.exit(1)
-                cmd = 'git rebase gerrit/%s' % (commit)
-                print(cmd)
-                resp = subprocess.run(cmd.split())
-                if resp.returncode != 0:
-                    print("git update failed with rc %d" % resp.returncode)
-                    os.chdir(cwd)
-                    sys.exit(1)
-            else:
-                print('Unknown remote: %s' % remote,file=sys.stderr)
-                os.chdir(cwd)
-                sys.exit(1)
-
-    if 'sbe' in remote:
-        cmd= config['sbeWorkon']
-        build_cmd=config['sbeBuild']
-        if (args.devready or args.devreadysbe):
-            if not args.nobranchchange:
-                getDevReadyCommits('sbe', commit)
-            else:
-                print("Not getting dev-ready updates because --nobranchchange was specified")
-
-    elif 'ekb' in remote:
-        cmd= config['ekbWorkon']
-        build_cmd= config['ekbBuild']
-        if (args.devready or args.devreadyekb):
-            if not args.nobranchchange:
-                getDevReadyCommits('ekb', commit)
-            else:
-                print("Not getting dev-ready updates because --nobranchchange was specified")
-    else:
-        print('Unknown remote: %s' % remote,file=sys.stderr)
-        os.chdir(cwd)
-        sys.exit(1)
-
-    with subprocess.Popen(cmd.split(),stdin=subprocess.PIPE) as proc:
-        proc.communicate(input=str.encode(build_cmd))
-        if proc.returncode != 0:
-            print("Building %s had a returncode %d" % (
-                basePath,
-                proc.returncode),
-                file=sys.stderr)
-            os.chdir(cwd)
-            sys.exit(1)
-
-def buildPartitionTable(partitions):
-    # Write the  partitions file
-    partitionsfile = os.path.join(genDir,'partitions')
-    with open(partitionsfile,'w') as f:
-        print(partitions, file=f)
-
-    # Build part.tbl
-    cmd = "%s compile-ptable %s %s/part.tbl" % (
-            flashBuildTool,
-            partitionsfile,
-            genDir)
-    #print(cmd)
-    resp = subprocess.run(cmd.split())
-    if resp.returncode !=0:
-        print("falshBuildTool failed to build part.table. rc = %d" % resp.returncode)
-        sys.exit(resp.returncode)
-
-    return partitionsfile
-
-def getDevReadyCommits(repo, commit):
-    print("\nRunning ./", repo, " cronus checkout")
-    if (repo == 'sbe'):
-        dev_out_file = 'cro_ody_sbe_image_cronus_checkout.sversion'
-        dev_out, err = subprocess.Popen(['export PROJECT_NAME=sbe; export SBEROOT=`pwd` export SBEROOT_INT=`pwd`/internal; export SBE_INSIDE_WORKON=1; source ./internal/projectrc; ./sbe cronus_devready checkout; unset SBE_INSIDE_WORKON; unset PROJECT_NAME; unset SBEROOT; unset SBEROOT_INT;'], stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True, universal_newlines=True).communicate()
-    else:
-        dev_out_file = 'cro_ody_ekb_image_cronus_checkout.sversion'
-        dev_out, err = subprocess.Popen(['source ./env.bash; ./ekb cronus checkout --branch', commit], stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True, universal_newlines=True).communicate()
-    # Sometimes seeing stuff in stderr that isn't actually an error, so not going to fail
-    if err:
-        print("INFO: stderr returned:\n", err)
-
-    print(repo, " cronus checkout --branch", commit, "\n")
-    print(dev_out)
-
-    # look for explicit problems
-    if ('Outstanding tracked changes' or 'Not a git repository' or 'Run this tool from the root' or 'Cherry-picks failed') in dev_out:
-        print("ERROR! Failed checking of dev-ready checkouts\n", dev_out)
-        os.chdir(cwd)
-        sys.exit(1)
-
-    # look for confirmation it worked
-    if not ('Checking out' and 'All Cherry-picks applied cleanly') in dev_out:
-        print("ERROR! Failed checking out dev-ready checkouts\n", dev_out)
-        os.chdir(cwd)
-        sys.exit(1)
-
-    # write output to a file
-    filename = os.path.join(output, dev_out_file)
-    outfile = open(filename, 'w')
-    outfile.write(dev_out)
-    outfile.close()
-
-def makeHashList(archiveName,hashfile):
-    # Create and load the archive
-    archive = pak.Archive(archiveName)
-    archive.load()
-
-    # Create all the hashes for the selected files
-    out.print("Creating hashes")
-    out.moreIndent()
-    for entry in archive:
-       out.print(entry.name)
-       entry.hash()
-    out.lessIndent()
-
-    #Add the hash.list content
-    archive.add(hashfile, pak.CM.store, archive.createHashList())
-
-    # Write the updated archive
-    return archive.save()
-
-def saveAndRemove(archiveName, savedArch, extractList):
-    archive = pak.Archive(archiveName)
-    archive.load()
-
-    # An non-existant or empty list would extract everything - don't allow
-    if not extractList:
-        return
-
-    try:
-        # Filter the list
-        result = archive.find(extractList)
-    except pak.ArchiveError as e:
-        out.print(str(e))
-        return
-
-    # Write the files
-    for entry in result:
-        savedArch.append(entry)
-        archive.remove(entry)
-
-    # Write it back out
-    archive.save()
-
-    return
-
-def restoreSaved(archiveName, savedArc):
-    archive = pak.Archive(archiveName)
-    archive.load()
-
-    for entry in savedArc:
-        archive.append(entry)
-
-    archive.save()
-
 def stub_cp(src, dir):
     os.makedirs(dir,exist_ok=True)
     for f in src.values():
         cmd = "cp %s %s/" % (f,dir)
-        resp = subprocess.run(cmd.split())
+        resp = buildTrace.run(cmd.split())
 
 def download(url, dir):
     os.makedirs(dir,exist_ok=True)
     cmd = f"wget {url} -P {dir}"
     print(cmd)
-    resp = subprocess.run(cmd.split())
+    resp = buildTrace.run(cmd.split())
     if resp.returncode != 0:
         print(f"{cmd} failed with rc {resp.returncode}")
         sys.exit(resp.returncode)
     return os.path.join(dir,os.path.basename(url))
 
-def downloadBinaries(output):
-    cwd = os.getcwd()
-    binariesDir=os.path.join(output,"binaries")
-    if os.path.exists(binariesDir):
-        shutil.rmtree(binariesDir)
-    os.makedirs(binariesDir)
-    downloads = os.path.join(output,"downloads")
-    if os.path.exists(downloads):
-        shutil.rmtree(downloads)
-    os.makedirs(downloads)
-    if 'binaries' in config.keys():
-        repoName = "released"
-        repoPath = os.path.join(downloads,repoName)
-        os.chdir(downloads)
-        cmds=config['binaries']['repository']
-        for cmd in cmds:
-            if cmd.startswith('git clone'):
-                cmd = f"{cmd} {repoName}"
-            print(cmd)
-            resp=subprocess.run(cmd.split())
-            if resp.returncode != 0:
-                os.chdir(cwd)
-                print(f"ERROR: {cmd} failed with rc {resp.returncode}")
-                sys.exit(resp.returncode)
-
-        os.chdir(repoName)
-        # get base commit id
-        cmd = f"git log --oneline -n 1"
-        resp=subprocess.run(cmd.split(),stdout=subprocess.PIPE)
-        baseCommit = resp.stdout.decode().split()[0]
+def parseCloneCmd(cmd):
+    # Returns (url, branch) of a 'git clone' command from the config file
+    url = None
+    branch = None
+    tokens = shlex.split(cmd)[2:]
+    i = 0
+    while i < len(tokens):
+        token = tokens[i]
+        if token in ('-b','--branch'):
+            i += 1
+            branch = tokens[i]
+        elif token.startswith('--branch='):
+            branch = token[len('--branch='):]
+        elif token in ('-o','--origin','--depth','-c','--config','--reference'):
+            i += 1
+        elif not token.startswith('-') and url is None:
+            url = token
+        i += 1
+    return (url, branch)
+
+def gitHasCommit(repoPath, commit):
+    resp = buildTrace.run(["git","-C",repoPath,"rev-parse","--verify","--quiet",
+                           commit+"^{commit}"],stdout=subprocess.DEVNULL)
+    return resp.returncode == 0
+
+def fetchPins(repoPath, commits):
+    """
+    Fetch the commits that are neither on a fetched branch nor tagged: other
+    branches are fetched into refs/heads, commit ids as they are
+    """
+    for commit in commits:
+        if gitHasCommit(repoPath, commit):
+            continue
+        if re.fullmatch('[0-9a-f]{40}', commit):
+            refspec = commit
+        else:
+            refspec = f"+refs/heads/{commit}:refs/heads/{commit}"
+        cmd = ["git","-C",repoPath,"fetch","--no-write-fetch-head","origin",refspec]
+        print("INFO: " + " ".join(cmd))
+        resp = buildTrace.run(cmd)
         if resp.returncode != 0:
-            os.chdir(cwd)
-            print(f"ERROR: {cmd} failed with rc {resp.returncode}")
+            print(f"ERROR: {' '.join(cmd)} failed with rc {resp.returncode}")
             sys.exit(resp.returncode)
 
-        files = config['binaries']['files']
-        for file,commit in files:
-            if commit == '':
-                commit = baseCommit
-            cmd = f"git checkout {commit}"
-            print(f"INFO: {cmd}")
-            resp=subprocess.run(cmd.split(),stderr=subprocess.PIPE)
-            if resp.returncode != 0:
-                print(f"ERROR: {cmd} failed with rc {resp.returncode}")
-                os.chdir(cwd)
-                sys.exit(resp.returncode)
+def fetchMissingBlobs(repoPath, commits, specs):
+    """
+    Fetch the blobs of the '<commit>:<path>' specs missing from the partial
+    clone repoPath in a single request, instead of one lazy fetch per blob.
+    commits are the commits of the specs.
+    """
+    resp = buildTrace.run(["git","-C",repoPath,"rev-parse"] + specs,stdout=subprocess.PIPE)
+    if resp.returncode != 0:
+        # extractBlobs() reports the files that don't exist
+        return
+    wanted = set(resp.stdout.decode().split())
 
-            srcpath=os.path.join(repoPath,file)
-            dstpath=os.path.join(binariesDir,os.path.basename(file))
-            cmd = f"cp {srcpath} {dstpath}"
-            resp=subprocess.run(cmd.split())
-            if resp.returncode != 0:
-                print(f"ERROR: {cmd} failed with rc {resp.returncode}")
-                os.chdir(cwd)
-                sys.exit(resp.returncode)
-        os.chdir(cwd)
-    else:
-        os.makedirs(binariesDir,exist_ok=True)
-
-    if os.path.exists(downloads):
-        shutil.rmtree(downloads)
-
-    # create binaries map
-    binaries = {}
-    files = os.listdir(binariesDir)
-    for f in files:
-        fullpath= os.path.join(binariesDir,f)
-        if os.path.isfile(fullpath):
-            binaries[f] = fullpath
-    return (binariesDir,binaries)
-
-def resolveFile(fpath, replacement_tags, overrides, binaries):
-    # replace tags
-    for key,value in replacement_tags.items():
-        fpath = fpath.replace(key,value)
-    # First look for the file in the overrides
-    # If not there then check fpath
-    # If not there then look in binaries
-    fname =  os.path.basename(fpath)
-    if fname in overrides.keys():
-        newPath = overrides[fname]
-    elif os.path.exists(fpath):
-        newPath = fpath
-    elif fname in binaries.keys():
-        newPath = binaries[fname]
-    else:
-        print(f"ERROR Required file not found: {fname}")
+    # --missing=print lists the objects not in the clone without fetching them
+    resp = buildTrace.run(["git","-C",repoPath,"rev-list","--objects","--no-walk",
+                           "--missing=print"] + sorted(set(commits)),stdout=subprocess.PIPE)
+    if resp.returncode != 0:
+        return
+    missing = [line[1:].strip() for line in resp.stdout.decode().splitlines()
+               if line.startswith('?') and line[1:].strip() in wanted]
+    if not missing:
+        return
+
+    cmd = ["git","-C",repoPath,"fetch","--no-tags","--no-write-fetch-head","origin"] + missing
+    print(f"INFO: Fetching {len(missing)} file(s) from the binaries repository")
+    resp = buildTrace.run(cmd)
+    if resp.returncode != 0:
+        print(f"ERROR: {' '.join(cmd)} failed with rc {resp.returncode}")
+        sys.exit(resp.returncode)
+
+def resolveCommits(repoPath, commits):
+    """
+    Commit ids of the commits, tags and branches in commits, as a dict. A
+    plain clone only has the other branches as origin/<branch>, which is
+    tried when the name doesn't resolve as it is. Names that resolve to no
+    commit are left out.
+    """
+    names = sorted(set(commits))
+    lines = "".join("%s^{commit}\norigin/%s^{commit}\n" % (name, name) for name in names)
+    resp = buildTrace.run(["git","-C",repoPath,"cat-file","--batch-check"],
+                          input=lines.encode(),stdout=subprocess.PIPE)
+    if resp.returncode != 0:
+        return {}
+    results = resp.stdout.decode().splitlines()
+    resolved = {}
+    for (i, name) in enumerate(names):
+        for result in results[2*i:2*i+2]:
+            fields = result.split()
+            if len(fields) == 3 and fields[1] == 'commit':
+                resolved[name] = fields[0]
+                break
+    return resolved
+
+def extractBlobs(repoPath, blobs):
+    """
+    Write each '<commit>:<path>' in blobs (list of (spec, dstpath)) to dstpath.
+    All blobs are read from the object database by a single
+    'git cat-file --batch' process, without checking out a worktree.
+    """
+    missing = []
+    with buildTrace.Popen(["git","-C",repoPath,"cat-file","--batch"],
+                          stdin=subprocess.PIPE,stdout=subprocess.PIPE) as proc:
+        for spec,dstpath in blobs:
+            proc.stdin.write(spec.encode() + b'\n')
+            proc.stdin.flush()
+            header = proc.stdout.readline().decode().split()
+            if len(header) != 3:
+                # '<spec> missing' or '<spec> ambiguous'
+                missing.append(spec)
+                continue
+            (oid,objtype,size) = header
+            size = int(size)
+            with open(dstpath,'wb') as f:
+                while size > 0:
+                    chunk = proc.stdout.read(min(size,1024*1024))
+                    if not chunk:
+                        break
+                    f.write(chunk)
+                    size -= len(chunk)
+            proc.stdout.read(1) # trailing newline
+            if objtype != 'blob' or size != 0:
+                missing.append(spec)
+        proc.stdin.close()
+
+    if proc.returncode != 0 or missing:
+        for spec in missing:
+            print(f"ERROR: {spec} not found in {repoPath}")
         sys.exit(1)
 
-    tgzext = '.tar.gz'
-    if newPath.endswith(tgzext):
-        # untar tar -C binaries -xzf binaries/sbe_images/odyssey_dd1_0/golden/golden_odyssey_nor_DD1.img.tar.gz
-        tar = tarfile.open(newPath)
-        # TODO might want to consider case where newPath is in an unwriteable location
+def extractTar(tarPath, destDir, members=None):
+    """
+    Extract tarPath into destDir. If members is given only the members with
+    those names are extracted, unless none of them is in the tar file.
+    """
+    import tarfile
+    import inspect
+
+    with buildTrace.span('extractTar', tar=os.path.basename(tarPath)):
+        tar = tarfile.open(tarPath)
+        selected = None
+        if members:
+            selected = [m for m in tar.getmembers() if os.path.normpath(m.name) in members]
+            if not selected:
+                selected = None
         if 'filter' in inspect.signature(tarfile.TarFile.extractall).parameters:
-            tar.extractall(os.path.dirname(newPath),filter="data")
+            tar.extractall(destDir,members=selected,filter="data")
         else:
-            tar.extractall(os.path.dirname(newPath))
-        newPath=newPath[:-len(tgzext)]
-    print(f"INFO: Using {newPath}")
-    return newPath
-
+            tar.extractall(destDir,members=selected)
+        tar.close()
 
-############################################################
-# Main - Main - Main - Main - Main - Main - Main - Main
-############################################################
+def fileStamp(path):
+    # Size and mtime of path, None if it doesn't exist
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_size, st.st_mtime_ns)
+
+def toolsDigest(toolPaths):
+    # Anything that changes the signing/hashing result has to change the key:
+    # the tools with all their helper modules, given as files or directories,
+    # and the signing environment they pick up.
+    h = hashlib.sha256()
+    for tool in toolPaths:
+        files = [tool]
+        if os.path.isdir(tool):
+            files = []
+            for (dirPath, dirNames, fileNames) in os.walk(tool):
+                dirNames[:] = sorted(d for d in dirNames if d != '__pycache__')
+                files.extend(os.path.join(dirPath, f) for f in sorted(fileNames))
+        for f in files:
+            if os.path.isfile(f):
+                h.update(("%s=%s\n" % (os.path.relpath(f, os.path.dirname(tool)),
+                                        fileIndex.fileDigest(f))).encode())
+    for var in ('HOST_DIR','SIGNING_BASE_DIR','SIGNING_RHEL_PATH','OPEN_SSL_PATH'):
+        h.update(("%s=%s\n" % (var, os.environ.get(var,''))).encode())
+    return h.hexdigest()
+
+def sectionCacheKey(sectionName, info, archiveDigests, baseEntries, toolsHash):
+    h = hashlib.sha256()
+    h.update(("section=%s\ntools=%s\n" % (sectionName, toolsHash)).encode())
+    for digest in archiveDigests:
+        h.update(("archive=%s\n" % digest).encode())
+    for (entryName,entryPath) in baseEntries:
+        entryHash = 'EMPTY'
+        if os.path.exists(entryPath):
+            entryHash = fileIndex.fileDigest(entryPath)
+        h.update(("file=%s:%s\n" % (entryName, entryHash)).encode())
+    for key in ('noHash','hashlist','hashpath','imagehash'):
+        h.update(("%s=%r\n" % (key, info.get(key))).encode())
+    return h.hexdigest()
+
+def sectionCacheGet(cacheDir, key, dstPath):
+    cachedPak = os.path.join(cacheDir, key+'.pak')
+    # Builds sharing the cache may evict the entry at any time, that's a miss
+    try:
+        shutil.copyfile(cachedPak, dstPath)
+    except OSError:
+        return False
+    # mtime is the LRU timestamp
+    try:
+        os.utime(cachedPak)
+    except OSError:
+        pass
+    return True
+
+def sectionCachePut(cacheDir, key, srcPath, maxSize):
+    os.makedirs(cacheDir,exist_ok=True)
+    cachedPak = os.path.join(cacheDir, key+'.pak')
+    tmpPak = "%s.%d.tmp" % (cachedPak, os.getpid())
+    shutil.copyfile(srcPath, tmpPak)
+    total = os.path.getsize(tmpPak)
+    os.replace(tmpPak, cachedPak)
+
+    # Evict least recently used entries until the cache fits in maxSize.
+    # Other builds sharing the cache may have evicted them already.
+    entries = []
+    for f in os.listdir(cacheDir):
+        fullpath = os.path.join(cacheDir,f)
+        if f.endswith('.pak') and fullpath != cachedPak:
+            try:
+                st = os.stat(fullpath)
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, st.st_size, fullpath))
+    total += sum(size for (_,size,_) in entries)
+    for (_,size,fullpath) in sorted(entries):
+        if total <= maxSize:
+            break
+        print(f"INFO: Evicting {os.path.basename(fullpath)} from section cache")
+        try:
+            os.remove(fullpath)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+def archiveSize(pak, entries, path):
+    """
+    Size of a pak archive holding entries, measured by saving it to path
+    """
+    archive = pak.Archive(path)
+    for entry in entries:
+        archive.append(entry)
+    archive.save()
+    size = os.path.getsize(path)
+    os.remove(path)
+    return size
 
-imageToolDir = os.path.dirname(sys.argv[0])
-parser = argparse.ArgumentParser(description="Build image",
-                                 formatter_class=argparse.RawDescriptionHelpFormatter,
-                                 epilog=textwrap.dedent('''
+# Estimated size of the image hash entry added by imageTool.py pakHash
+IMAGE_HASH_RESERVE = 0x100
 
-examples:
-  > imageBuild.py configs/odyssey/dd1/ody_pnor_dd1_image_config -o ./image_output -n pnor.bin
-'''))
+# Extractions used this recently may be in use by another build
+EXTRACT_GRACE = 3600
 
-parser.add_argument('configfile',
-                    help="The configuration file used to build the image.")
-parser.add_argument('-b','--build',action='store_true',
-                    help='Downloads ekb and sbe repositories (if not found), '
-                    'then checks out branchs and builds them. Note: Requires '
-                    ' --ekb and --sbe, or --build_workdir')
-parser.add_argument('--nobranchchange', action='store_true',
-                    help="Don't change the branch when building")
-parser.add_argument('--update', action='store_true',
-                    help='After changing to specified branch, '
-                    'update it from the server as well')
-parser.add_argument('--devready', action='store_true',
-                    help='Apply dev-ready ekb and sbe commits on top of branch')
-parser.add_argument('--devreadyekb', action='store_true',
-                    help='Apply dev-ready ekb commits on top of branch')
-parser.add_argument('--devreadysbe', action='store_true',
-                    help='Apply dev-ready sbe commits on top of branch')
-parser.add_argument('--ekb',default=None,
-                    help='Base path of the ekb git repository.'
-                    ' Use --ekb_images instead for pre-built images')
-parser.add_argument('--ekb_images',default=None,
-                    help='Image directory of pre-built ekb images.')
-parser.add_argument('--sbe',default=None,
-                    help='Base path of sbe repository or sbe images. Default: use value '
-                    'in configfile')
-parser.add_argument('--ovrd',default=None,
-                    help='Directory to look for override source files.'
-                    ' Files must have same name as those being overridden')
-parser.add_argument('-o','--output', default='./image_output',
-                    help='output directory. default ./image_output')
-parser.add_argument('-n','--name', default='image.bin',
-                    help='output image filename. default: image.bin')
-parser.add_argument('--pakToolDir',default=None,
-                    help='Directory of PAK tools. '
-                    'PAK tool override. Only required if PAK tools not available in '
-                    'ekb,sbe,or sbe_tools.')
-parser.add_argument('--sbe_test',action='store_true',
-                    help='Run sbe test cases to validate the images')
-parser.add_argument('--build_workdir', type=str,
-                    help='Work directory for the build. '
-                    'Tool will ignore xxxxRoot configure parameter value.')
-parser.add_argument('--buildGoldenImg', type=int, metavar="SIDE_COUNT",
-                    help='Use to build golden image with the side count '
-                         'instead of the configured frozen golden image.'
-                         'The golden image will be used for the given sides.')
-parser.add_argument('--allowToSign', action='store_true',
-                    help='Use to allow the signing process for the frozen '
-                         'configured image_sections.')
-parser.add_argument('--no_downloads', action='store_true',
-                    help='Disable downloading any repositories/binaries etc.')
-parser.add_argument('--disable_arch_nor_img', action='store_true',
-                    help='disable nor image copy into debug archive')
-args = parser.parse_args()
-
-# process the configuration file and load needed modules whos location is based on
-# the configuration
-configFile = os.path.abspath(args.configfile)
-if(not os.path.exists(configFile)):
-    print("The given config file: '%s', does not exist!" % configFile, file=sys.stderr)
-    sys.exit(1)
-
-cwd = os.getcwd()
-
-configdir = os.path.dirname(configFile)
-
-config = readConfigFile(configFile)
-
-# Get the architecture that's running.
-resp = subprocess.run(["uname","-m"],stdout=subprocess.PIPE)
-exe_arch = resp.stdout.decode('utf-8').rstrip()
-
-# Get the target architecture if available
-target_arch = os.environ.get("ECMD_ARCH")
-if not target_arch:
-    target_arch = exe_arch
-
-output    = os.path.abspath(args.output)
-os.makedirs(output,exist_ok=True)
-
-if args.ekb and args.ekb_images:
-    print("ERROR Can't use --ekb and --ekb_images together.")
-    sys.exit(1)
-
-if not args.ekb and not args.ekb_images and not args.ovrd and not args.build_workdir:
-    print("ERROR Needs to specify either --ekb or --ekb_images or --ovrd or --build_workdir")
-    sys.exit(1)
-
-if args.build and not args.ekb and not args.build_workdir:
-    print("ERROR --build requires --ekb or --build_workdir")
-    sys.exit(1)
-
-## ekb base
-ekbBase = args.ekb
-ekbImageDir = ''
-
-if ekbBase:
-    ekbBase = os.path.realpath(os.path.expanduser(ekbBase))
-    ekbImageDir = config['ekbImageSubDir'].replace('%machine_arch%',target_arch)
-    ekbImageDir = os.path.join(ekbBase,ekbImageDir)
-else:
-    if args.ekb_images:
-        ekbBase = args.ekb_images
-    elif args.build_workdir:
-        ekbBase = os.path.abspath(os.path.join(args.build_workdir, 'ekb'))
-    else:
-        ekbBase = args.ovrd
-
-    ekbBase = os.path.realpath(os.path.expanduser(ekbBase))
-    ekbImagDir = ekbBase
-
-## sbe base
-sbeBase = args.sbe
-if not sbeBase:
-    if args.build_workdir:
-        sbeBase = os.path.abspath(os.path.join(args.build_workdir, 'sbe'))
-    elif 'sbeRoot' in config.keys():
-        sbeBase = config['sbeRoot']
-    else:
-        print("Critical! No path to sbe repository")
-        sys.exit(1)
+def treeSize(path):
+    size = 0
+    for (dirPath, _, fileNames) in os.walk(path):
+        for fileName in fileNames:
+            try:
+                size += os.lstat(os.path.join(dirPath, fileName)).st_size
+            except OSError:
+                pass
+    return size
+
+def evictExtracts(extractRoot, maxSize, keep):
+    """
+    Remove least recently used tar extractions until the extraction cache fits
+    in maxSize. The directories in keep and the recently used ones stay.
+    """
+    entries = []
+    for f in os.listdir(extractRoot):
+        fullpath = os.path.join(extractRoot,f)
+        if f.endswith('.tmp') or not os.path.isdir(fullpath):
+            continue
+        try:
+            mtime = os.stat(fullpath).st_mtime
+        except FileNotFoundError:
+            # Evicted by another build
+            continue
+        entries.append((mtime, treeSize(fullpath), fullpath))
+    total = sum(size for (_,size,_) in entries)
+    now = time.time()
+    for (mtime,size,fullpath) in sorted(entries):
+        if total <= maxSize:
+            break
+        if fullpath in keep or now - mtime < EXTRACT_GRACE:
+            continue
+        print(f"INFO: Evicting {os.path.basename(fullpath)} from extraction cache")
+        # Gone for other builds at once, removed at leisure
+        tmpPath = "%s.%d.evict.tmp" % (fullpath, os.getpid())
+        try:
+            os.rename(fullpath, tmpPath)
+        except OSError:
+            continue
+        shutil.rmtree(tmpPath, ignore_errors=True)
+        total -= size
+
+# Granularity of the ranges compared and rewritten by an incremental build
+PATCH_BLOCK_SIZE = 64*1024
+
+# Builder of the forked section workers, they inherit it from the parent
+_workerBuilder = None
+
+def _prepareSectionWorker(sectionName, info):
+    return _workerBuilder.prepareSectionWorker(sectionName, info)
+
+
+class ImageBuilder:
+    """
+    Builds flash images from config files.
+
+    The options are the command line options of imageBuild.py, see
+    defaultOptions(). State that does not depend on the config file is kept
+    between builds: overrides, downloaded binaries, extracted sbe tools,
+    discovered pak tools and built repositories. build() runs the stages of
+    one image in order and returns its artifacts.
+    """
+
+    # Build stages
+    #    Note : Signing will be skipped if section is configured with 'signed_image'
+    #           and '--allowToSign' option is not passed since the SBE provides
+    #           frozen signed images so tool should not attempt to sign.
+    stage1 = 'merged'
+    stage2 = 'signed'
+    stage3 = 'final'  #hashed
+
+    def __init__(self, options):
+        self.args = options
+        args = options
+
+        if args.ekb and args.ekb_images:
+            print("ERROR Can't use --ekb and --ekb_images together.")
+            sys.exit(1)
 
-sbeBase = os.path.realpath(os.path.expanduser(sbeBase))
-sbeImageDir = os.path.join(sbeBase,'images')
-
-# setup git repos and build - only if --build option specified.
-if args.build:
-    setupRepository(ekbBase, config['ekbCommit'],'hw/ekb-src')
-    setupRepository(sbeBase, config['sbeCommit'],'hw/sbe')
-os.chdir(cwd)
-
-## Load overrides
-overrides = {}
-if args.ovrd:
-    path = os.path.realpath(os.path.expanduser(args.ovrd))
-    if os.path.exists(path):
-        files = os.listdir(path)
-        for f in files:
-            fullpath = os.path.join(path,f)
-            if os.path.isfile(fullpath):
-                overrides[f] = fullpath
-    else:
-        print("WARN override directory does not exist: %s" % path)
-
-## Load released binaries
-binariesDir = ''
-binaries = {}
-if not args.no_downloads:
-    binariesDir,binaries = downloadBinaries(output)
-
-# Untar sbe_tools.tar.gz to get sbe tools
-sbeToolsTar = config['sbeTools']
-if(sbeToolsTar in overrides.keys()):
-    sbeToolsTar = overrides[sbeToolsTar]
-else:
-    sbeToolsTar = os.path.join(sbeImageDir, sbeToolsTar)
-
-sbeTools = tarfile.open(sbeToolsTar)
-
-if 'filter' in inspect.signature(tarfile.TarFile.extractall).parameters:
-    sbeTools.extractall(output,filter="data")
-else:
-    sbeTools.extractall(output)
-
-sbeToolsDir = os.path.join(output,'sbe_tools')
-sbeImageTool = os.path.join(sbeToolsDir, 'imageTool.py')
-
-ARCH = platform.machine()
-sbeEccTool = os.path.join(sbeToolsDir,'ecc') + '_' + ARCH
-if not os.path.exists(sbeEccTool):
-    sbeEccTool = os.path.join(sbeToolsDir,'ecc')
-    if not os.path.exists(sbeEccTool):
-        print("ERROR: %s does not exist. Make sure SBE is current" % sbeEccTool)
-        sys.exit(1)
+        if not args.ekb and not args.ekb_images and not args.ovrd and not args.build_workdir:
+            print("ERROR Needs to specify either --ekb or --ekb_images or --ovrd or --build_workdir")
+            sys.exit(1)
 
+        if args.build and not args.ekb and not args.build_workdir:
+            print("ERROR --build requires --ekb or --build_workdir")
+            sys.exit(1)
 
-## pak tools
-pakToolsDir = args.pakToolDir
-if(pakToolsDir):
-    pakToolsDir = os.path.realpath(os.path.expanduser(pakToolsDir))
-else:
-    # First, look in sbe tools
-    # TODO where under sbeToolsDir will pak tools be?
-    pakToolsDir = os.path.join(sbeToolsDir,'tools')
-if not os.path.exists(os.path.join(pakToolsDir,'paktool')):
-    # Next, look in sbe path
-    pakToolsDir = os.path.join(sbeBase,'public','src','import','public',
-                               'common','utils','imageProcs','tools')
-if not os.path.exists(pakToolsDir):
-    # Finally, look in ekb path
-    pakToolsDir = os.path.join(ekbBase,'public','common','utils',
-                               'imageProcs','tools')
-    if not os.path.exists(pakToolsDir):
-        print("ERROR:  Can't find paktools")
-        sys.exit(1)
-
-imageToolDir = os.path.realpath(os.path.expanduser(imageToolDir))
-pakTool         = os.path.join(pakToolsDir, 'paktool')
-flashBuildTool  = os.path.join(pakToolsDir, 'flashbuild')
+        self.cwd = os.getcwd()
+        self.imageToolDir = os.path.dirname(os.path.realpath(__file__))
+
+        # Get the architecture that's running.
+        self.exeArch = os.uname().machine
+
+        # Get the target architecture if available
+        self.targetArch = os.environ.get("ECMD_ARCH")
+        if not self.targetArch:
+            self.targetArch = self.exeArch
+
+        self.cacheDir = None
+        if args.cache_dir:
+            self.cacheDir = os.path.realpath(os.path.expanduser(args.cache_dir))
+
+        self.traceFile = None
+        if args.trace:
+            self.traceFile = os.path.abspath(args.trace)
+            buildTrace.enable()
+
+        ## Overrides, indexed recursively. The index is kept in the cache dir.
+        self.overrides = None
+        if args.ovrd:
+            path = os.path.realpath(os.path.expanduser(args.ovrd))
+            if os.path.exists(path):
+                indexFile = None
+                if self.cacheDir:
+                    indexFile = os.path.join(self.cacheDir,'index',
+                                             hashlib.sha256(path.encode()).hexdigest()[:16]+'.json')
+                self.overrides = fileIndex.FileIndex(path, indexFile)
+            else:
+                print("WARN override directory does not exist: %s" % path)
+
+        # Shared by all builds of this builder. Sections that are identical
+        # between images are only built once, by way of the section cache.
+        self.sharedBinaries = {}
+        self.sharedSbeTools = {}
+        self.sharedTools = {}
+        self.builtRepositories = set()
+        # Tar extractions of the cache used by the current build, never evicted
+        self.usedExtracts = set()
+
+        self.pak = None
+        self.out = None
+
+    def build(self, configFile, output, name):
+        """
+        Build image 'name' in directory output as described by configFile.
+        Returns the artifacts of the build, see artifacts().
+        """
+        position = buildTrace.mark()
+        self.usedExtracts = set()
+        self.locatedInputs = []
+        if self.args.watch:
+            # The inputs as they were read, changes made during the build
+            # trigger the next one
+            import fileWatch
+            self.watchSnapshot = fileWatch.Snapshot()
+            self.watchSnapshot.add([configFile], [])
+        try:
+            with buildTrace.span('build', 'build', image=name, config=configFile):
+                self.loadConfig(configFile, output, name)
+                self.setupRepositories()
+                self.loadBinaries()
+                self.indexOverrides()
+                self.findTools()
+                self.prepareOutput()
+                self.resolveInputs()
+                self.buildPartitionTable()
+                self.prepareSections()
+                self.signSections()
+                self.resolveImageLayout()
+                self.buildFlashImage()
+                patched = self.patchImage()
+                if not patched:
+                    self.concatImage()
+                self.finishImage(patched)
+        finally:
+            # Also written for a failed build
+            if self.traceFile:
+                buildTrace.write(self.traceFile)
+                print(buildTrace.summary(position))
+        return self.artifacts()
+
+    def artifacts(self):
+        return {
+            'image'       : self.imagefile,
+            'singleImage' : self.singleImagefile,
+            'eccImage'    : self.eccImagefile,
+            'partitions'  : self.partitionsfile,
+            'sections'    : {sectionName: info.get('finalArchive')
+                             for sectionName, info in self.section_info.items()},
+        }
+
+    def watchPaths(self):
+        """
+        Files and directory trees the last build depends on, for --watch.
+        Also valid after a failed build, as far as it got.
+        """
+        files = set()
+        trees = set()
+        if getattr(self, 'configFile', None):
+            files.add(self.configFile)
+        files.update(self.locatedInputs)
+        for sectionName, info in getattr(self, 'section_info', {}).items():
+            if 'signed_image' in info.keys() and not self.args.allowToSign:
+                files.add(self.replaceTags(info['signed_image']))
+        # Without --ekb the ekb images are found under ekbBase
+        ekbImageDir = getattr(self, 'ekbImageDir', None) or getattr(self, 'ekbBase', None)
+        for tree in (ekbImageDir, getattr(self, 'sbeImageDir', None)):
+            if tree:
+                trees.add(tree)
+        if self.overrides:
+            trees.add(self.overrides.root)
+        return (files, trees)
+
+    #--------------------------
+    # Stages
+    #--------------------------
+    @buildTrace.traced
+    def loadConfig(self, configFile, output, name):
+        args = self.args
+        self.configFile = configFile
+        self.output = output
+        self.name = name
+        self.config = readConfigFile(configFile)
+        self.section_info = self.config['image_sections']
+
+        ## ekb base
+        ekbBase = args.ekb
+        self.ekbImageDir = ''
+
+        if ekbBase:
+            ekbBase = os.path.realpath(os.path.expanduser(ekbBase))
+            ekbImageDir = self.config['ekbImageSubDir'].replace('%machine_arch%',self.targetArch)
+            self.ekbImageDir = os.path.join(ekbBase,ekbImageDir)
+        else:
+            if args.ekb_images:
+                ekbBase = args.ekb_images
+            elif args.build_workdir:
+                ekbBase = os.path.abspath(os.path.join(args.build_workdir, 'ekb'))
+            else:
+                ekbBase = args.ovrd
+
+            ekbBase = os.path.realpath(os.path.expanduser(ekbBase))
+        self.ekbBase = ekbBase
+
+        ## sbe base
+        sbeBase = args.sbe
+        if not sbeBase:
+            if args.build_workdir:
+                sbeBase = os.path.abspath(os.path.join(args.build_workdir, 'sbe'))
+            elif 'sbeRoot' in self.config.keys():
+                sbeBase = self.config['sbeRoot']
+            else:
+                print("Critical! No path to sbe repository")
+                sys.exit(1)
 
+        self.sbeBase = os.path.realpath(os.path.expanduser(sbeBase))
+        self.sbeImageDir = os.path.join(self.sbeBase,'images')
+
+        self.imagefile = os.path.join(output,name)
+        self.singleImagefile = self.imagefile
+        self.eccImagefile = self.imagefile+'.ecc'
+        self.concatCopies = 0
+        if 'concat' in self.config.keys():
+            self.concatCopies = self.config['concat']
+        if self.concatCopies > 1:
+            self.singleImagefile = os.path.join(output,"single_" + name)
+
+        # Output of flashbuild. An existing image is only replaced at the end
+        # of an incremental build.
+        self.flashImagefile = self.singleImagefile
+        if self.args.incremental and self.singleImagefile == self.imagefile:
+            self.flashImagefile = self.imagefile + '.new'
+
+    @buildTrace.traced
+    def setupRepositories(self):
+        # setup git repos and build - only if --build option specified.
+        # Each repository/commit is only built once per builder. The ekb and
+        # sbe repositories are set up at the same time, each logging to its
+        # own file.
+        if self.args.build:
+            import taskRunner
+            tasks = []
+            for (name, basePath, commit, remote) in (('ekb', self.ekbBase, self.config['ekbCommit'],'hw/ekb-src'),
+                                                     ('sbe', self.sbeBase, self.config['sbeCommit'],'hw/sbe')):
+                if (basePath, commit) not in self.builtRepositories:
+                    log = taskRunner.TaskLog(name, os.path.join(self.output, 'logs', f'{name}_setup.log'))
+                    tasks.append((log, self.setupRepository, (basePath, commit, remote)))
+
+            failures = taskRunner.runThreads(tasks)
+            for (log, rc) in failures:
+                print(f"ERROR: setup of the {log.name} repository failed, see {log.logPath}", file=sys.stderr)
+            if failures:
+                sys.exit(failures[0][1])
+            for (log, function, (basePath, commit, remote)) in tasks:
+                self.builtRepositories.add((basePath, commit))
+        os.chdir(self.cwd)
+
+    @buildTrace.traced
+    def loadBinaries(self):
+        ## Load released binaries
+        self.binariesDir = ''
+        self.binaries = None
+        if not self.args.no_downloads:
+            binariesKey = repr(self.config.get('binaries'))
+            if binariesKey not in self.sharedBinaries:
+                self.sharedBinaries[binariesKey] = self.downloadBinaries(self.output)
+            self.binariesDir,self.binaries = self.sharedBinaries[binariesKey]
+
+    @buildTrace.traced
+    def indexOverrides(self):
+        # Only the directories changed since the last build are listed again
+        if self.overrides:
+            listed = self.overrides.refresh()
+            print(f"INFO: Indexed overrides in {self.overrides.root}, {listed} directories listed")
+            self.overrides.save()
+
+    @buildTrace.traced
+    def findTools(self):
+        # Untar sbe_tools.tar.gz to get sbe tools
+        sbeToolsTar = self.config['sbeTools']
+        if self.overrides and self.overrides.find(sbeToolsTar):
+            sbeToolsTar = self.overrides.find(sbeToolsTar)[0]
+        else:
+            sbeToolsTar = os.path.join(self.sbeImageDir, sbeToolsTar)
+
+        self.sbeToolsTar = sbeToolsTar
+        # A rebuilt sbe_tools.tar.gz is extracted again, and its tools found again
+        toolsKey = (sbeToolsTar, fileStamp(sbeToolsTar), self.sbeBase, self.ekbBase)
+        if toolsKey not in self.sharedTools:
+            self.sharedTools[toolsKey] = self.discoverTools(sbeToolsTar)
+        (self.sbeToolsDir, self.sbeImageTool, self.sbeEccTool,
+         self.pakToolsDir, self.pakTool, self.flashBuildTool) = self.sharedTools[toolsKey]
+
+        self.loadPakTools(self.pakToolsDir)
+
+    def discoverTools(self, sbeToolsTar):
+        args = self.args
+        sbeToolsKey = (sbeToolsTar, fileStamp(sbeToolsTar))
+        if self.cacheDir:
+            # Keyed on the tar file's stamp (or digest) by the cache itself
+            sbeToolsDir = os.path.join(self.cachedExtract(sbeToolsTar),'sbe_tools')
+        elif sbeToolsKey in self.sharedSbeTools:
+            sbeToolsDir = self.sharedSbeTools[sbeToolsKey]
+        else:
+            sbeToolsDir = os.path.join(self.output,'sbe_tools')
+            if os.path.exists(sbeToolsDir):
+                # Files of an older sbe_tools.tar.gz must not remain
+                shutil.rmtree(sbeToolsDir)
+            extractTar(sbeToolsTar, self.output)
+        self.sharedSbeTools[sbeToolsKey] = sbeToolsDir
+        sbeImageTool = os.path.join(sbeToolsDir, 'imageTool.py')
+
+        sbeEccTool = os.path.join(sbeToolsDir,'ecc') + '_' + self.exeArch
+        if not os.path.exists(sbeEccTool):
+            sbeEccTool = os.path.join(sbeToolsDir,'ecc')
+            if not os.path.exists(sbeEccTool) and args.ecc_engine == 'tool':
+                print("ERROR: %s does not exist. Make sure SBE is current" % sbeEccTool)
+                sys.exit(1)
 
-imagefile = os.path.join(output,args.name)
-singleImagefile = imagefile
-concatCopies = 0
-if 'concat' in config.keys():
-    concatCopies = config['concat']
-if concatCopies > 1:
-    singleImagefile = os.path.join(output,"single_" + args.name)
+        ## pak tools
+        pakToolsDir = args.pakToolDir
+        if(pakToolsDir):
+            pakToolsDir = os.path.realpath(os.path.expanduser(pakToolsDir))
+        else:
+            # First, look in sbe tools
+            # TODO where under sbeToolsDir will pak tools be?
+            pakToolsDir = os.path.join(sbeToolsDir,'tools')
+        if not os.path.exists(os.path.join(pakToolsDir,'paktool')):
+            # Next, look in sbe path
+            pakToolsDir = os.path.join(self.sbeBase,'public','src','import','public',
+                                       'common','utils','imageProcs','tools')
+        if not os.path.exists(pakToolsDir):
+            # Finally, look in ekb path
+            pakToolsDir = os.path.join(self.ekbBase,'public','common','utils',
+                                       'imageProcs','tools')
+            if not os.path.exists(pakToolsDir):
+                print("ERROR:  Can't find paktools")
+                sys.exit(1)
 
-if os.path.exists(imagefile):
-    os.remove(imagefile)
-if os.path.exists(singleImagefile):
-    os.remove(singleImagefile)
+        pakTool         = os.path.join(pakToolsDir, 'paktool')
+        flashBuildTool  = os.path.join(pakToolsDir, 'flashbuild')
+
+        return (sbeToolsDir, sbeImageTool, sbeEccTool, pakToolsDir, pakTool, flashBuildTool)
+
+    def loadPakTools(self, pakToolsDir):
+        # pakcore is imported again only when the pak tools changed since it
+        # was imported, by a later build of a resident builder
+        pymodDir = "%s/pymod" % pakToolsDir
+        pakKey = (pymodDir, fileStamp(os.path.join(pymodDir,'pakcore.py')),
+                  fileStamp(os.path.join(pymodDir,'output.py')))
+        if self.pak and self.pakKey == pakKey:
+            return
+        if self.pak:
+            print(f"INFO: Pak tools changed, importing pakcore from {pymodDir}")
+            if self.pakKey[0] in sys.path:
+                sys.path.remove(self.pakKey[0])
+            for module in ('pakcore', 'output'):
+                sys.modules.pop(module, None)
+            importlib.invalidate_caches()
+
+        # Required before calling pak tools
+        if pymodDir not in sys.path:
+            sys.path.append(pymodDir)
+
+        from output import out
+        import pakcore as pak
+
+        #only print out critical errors. For debug, change CRITICAL to DEBUG
+        out.setConsoleLevel(out.levels.CRITICAL)
+
+        self.pak = pak
+        self.out = out
+        self.pakKey = pakKey
+
+    @buildTrace.traced
+    def prepareOutput(self):
+        if os.path.exists(self.imagefile) and not self.args.incremental:
+            os.remove(self.imagefile)
+        if os.path.exists(self.flashImagefile) and self.flashImagefile != self.imagefile:
+            os.remove(self.flashImagefile)
+
+        self.genDir = os.path.join(self.output,'gen')
+
+        # State of the previous build, read before gen is cleaned
+        self.oldState = None
+        stateFile = os.path.join(self.genDir,'image.state')
+        if self.args.incremental and os.path.exists(stateFile):
+            try:
+                with open(stateFile) as f:
+                    self.oldState = json.load(f)
+            except ValueError:
+                print(f"WARN ignoring invalid {stateFile}")
+
+        if os.path.exists(self.genDir):
+            shutil.rmtree(self.genDir)
+        os.makedirs(self.genDir)
+
+        self.mergedDir = os.path.join(self.genDir,self.stage1)
+        self.signedDir = os.path.join(self.genDir,self.stage2)
+        self.finalDir  = os.path.join(self.genDir,self.stage3)
+
+        os.makedirs(self.mergedDir,exist_ok=True)
+        os.makedirs(self.signedDir,exist_ok=True)
+        os.makedirs(self.finalDir,exist_ok=True)
+
+        ## signing environment, part of the section cache key
+        # If running in op-build use the host dir
+        if os.environ.get('HOST_DIR'):
+            os.environ['OPBUILD_HOST_DIR'] = os.environ.get('HOST_DIR')
+            os.environ['OPEN_SSL_PATH']='/bin/openssl'
+        else:
+            # Checking for env var SIGNING_BASE_DIR as expected to be
+            # already set to work within the secure build env, for every
+            # other env (local build, CI etc) SIGNING_RHEL_PATH would be set
+            if not os.environ.get('SIGNING_BASE_DIR'):
+                checkEnvVarExist('SIGNING_RHEL_PATH')
+            if not os.environ.get('OPEN_SSL_PATH'):
+                 os.environ['OPEN_SSL_PATH']='/bin/openssl'
+
+        ## section cache
+        self.sectionCacheDir = None
+        self.toolsHash = ''
+        if self.cacheDir:
+            self.sectionCacheDir = os.path.join(self.cacheDir,'sections')
+            # All of sbe_tools.tar.gz and the pak tools, whichever tree they come from
+            self.toolsHash = toolsDigest([self.sbeToolsTar, self.pakToolsDir])
+
+        #
+        self.replacement_tags = {
+                '%binariesDir%'  : self.binariesDir,
+                '%imageToolDir%' : self.imageToolDir,
+                '%ekbImageDir%' : self.ekbImageDir,
+                '%sbeImageDir%' : self.sbeImageDir,
+                '%sbeRoot%'     : self.sbeBase,
+                '%gen%'         : self.genDir,
+        }
+
+    @buildTrace.traced
+    def buildPartitionTable(self):
+        # Discover partitions
+        partitions = []
+        for sectionName, info in self.section_info.items():
+            partitions.append((sectionName, info['partition_size']))
+        self.partitions = partitions
+
+        # Write the  partitions file
+        self.partitionsfile = os.path.join(self.genDir,'partitions')
+        with open(self.partitionsfile,'w') as f:
+            print(partitions, file=f)
+
+        # Build part.tbl
+        cmd = "%s compile-ptable %s %s/part.tbl" % (
+                self.flashBuildTool,
+                self.partitionsfile,
+                self.genDir)
+        #print(cmd)
+        resp = buildTrace.run(cmd.split(), name='flashbuild compile-ptable')
+        if resp.returncode !=0:
+            print("falshBuildTool failed to build part.table. rc = %d" % resp.returncode)
+            sys.exit(resp.returncode)
 
-genDir = os.path.join(output,'gen')
-if os.path.exists(genDir):
-    shutil.rmtree(genDir)
-os.makedirs(genDir)
+    @buildTrace.traced
+    def prepareSections(self):
+        global _workerBuilder
+        args = self.args
+        section_info = self.section_info
+
+        # Resolve archive paths in image_sections
+        # Merge archives where more than one exists in an image section
+        sectionsToBuild = []
+        for sectionName, info in section_info.items():
+            if 'signed_image' in info.keys() and not args.allowToSign:
+                print(f"INFO: Use configured signed image for '{sectionName}' so no signing...")
+                continue
+            sectionsToBuild.append(sectionName)
+
+        # Sections are independent until the final image is built, so they can be
+        # prepared in parallel. Results are collected in config order.
+        sectionResults = []
+        if args.jobs > 1 and len(sectionsToBuild) > 1:
+            sys.stdout.flush()
+            _workerBuilder = self
+            with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs,
+                    mp_context=multiprocessing.get_context('fork')) as pool:
+                futures = [(sectionName, pool.submit(_prepareSectionWorker, sectionName,
+                                                     section_info[sectionName]))
+                           for sectionName in sectionsToBuild]
+                for sectionName, future in futures:
+                    result = future.result()
+                    buildTrace.addEvents(result.pop('traceEvents'))
+                    sectionResults.append((sectionName, result))
+            _workerBuilder = None
+        else:
+            for sectionName in sectionsToBuild:
+                with buildTrace.span('prepareSection', section=sectionName):
+                    sectionResults.append((sectionName, self.prepareSection(sectionName,
+                                                                            section_info[sectionName])))
+
+        # Add signature/hash to sections that require it
+        self.signImgSrc = {}
+        self.hashImgSrc = {}
+        self.asisImgSrc = {}
+
+        self.notHashed = {}
+
+        for sectionName, result in sectionResults:
+            info = section_info[sectionName]
+            info.update(result)
+            if 'mergedArchive' not in info.keys():
+                continue
+
+            pakname = info['mergedArchive']
+
+            saveArchive = info.pop('notHashed')
+            if isinstance(saveArchive, str):
+                # Saved by a worker process
+                savedName = saveArchive
+                saveArchive = self.pak.Archive(savedName)
+                saveArchive.load()
+
+            if 'hashlist' in info.keys():
+                # Must be signed, so source pak to sign comes from stage1
+                self.signImgSrc[sectionName] = pakname
+                # Must be hashed, so source pakname to hash comes from stage2
+                self.hashImgSrc[sectionName] = pakname.replace(self.stage1,self.stage2)
+            elif 'imagehash' in info.keys():
+                # Not to be signed, only hashed, so source pakname to hash is from stage1.
+                self.hashImgSrc[sectionName] = pakname
 
-# Required before calling pak tools
-sys.path.append("%s/pymod" % pakToolsDir)
+            else:
+                self.asisImgSrc[sectionName] = pakname
+
+            # All paks will exist in stage3 - used to build final flash image
+            finalName = pakname.replace(self.stage1,self.stage3)
+            section_info[sectionName]['finalArchive'] = finalName
+            self.notHashed[sectionName] = saveArchive
+
+        self.checkSectionSizes()
+
+    @buildTrace.traced
+    def checkSectionSizes(self):
+        """
+        Fail before signing if a section won't fit in its partition. The final
+        size of a merged section is projected from the merged archive, the
+        noHash entries restored after signing and the entries signing and
+        hashing add. Cached and configured signed sections are final already.
+        """
+        args = self.args
+        pak = self.pak
+        scratch = os.path.join(self.mergedDir, '.size.pak')
+        emptySize = archiveSize(pak, [], scratch)
+
+        rows = []
+        overflow = []
+        for sectionName, size in self.partitions:
+            info = self.section_info[sectionName]
+            noHashSize = 0
+            reserve = 0
+            noHash = []
+            if 'signed_image' in info.keys() and not args.allowToSign:
+                archivePath = self.replaceTags(info['signed_image'])
+            elif 'mergedArchive' in info.keys():
+                archivePath = info['mergedArchive']
+                noHash = list(self.notHashed[sectionName])
+                if noHash:
+                    noHashSize = archiveSize(pak, noHash, scratch) - emptySize
+                if 'hashlist' in info.keys():
+                    reserve += args.sign_reserve
+                if 'hashlist' in info.keys() or 'imagehash' in info.keys():
+                    reserve += IMAGE_HASH_RESERVE
+            else:
+                archivePath = info['finalArchive']
+            archiveBytes = os.path.getsize(archivePath)
+            projected = archiveBytes + noHashSize + reserve
+            rows.append((sectionName, size, archiveBytes, noHashSize, reserve, projected))
+            if projected > size:
+                overflow.append(sectionName)
+
+            if args.size_report:
+                archive = pak.Archive(archivePath)
+                archive.load()
+                entries = [(entry.name, archiveSize(pak, [entry], scratch) - emptySize)
+                           for entry in list(archive) + noHash]
+                print(f"INFO: Entries of '{sectionName}' by size:")
+                for (name, entrySize) in sorted(entries, key=lambda e: -e[1]):
+                    print("    %10d  %s" % (entrySize, name))
+
+        width = max([len(name) for (name,_,_,_,_,_) in rows] + [7])
+        print("%-*s %10s %10s %10s %10s %10s %10s" % (width, 'Section', 'Partition', 'Archive',
+              'noHash', 'Reserve', 'Projected', 'Headroom'))
+        for (name, size, archiveBytes, noHashSize, reserve, projected) in rows:
+            print("%-*s %10d %10d %10d %10d %10d %10d" % (width, name, size, archiveBytes,
+                  noHashSize, reserve, projected, size - projected))
+
+        if overflow:
+            print("ERROR: projected size of section(s) %s exceeds the partition size. "
+                  "Reserve is the estimated size of the signature (--sign_reserve) and "
+                  "image hash entries." % ", ".join(overflow))
+            sys.exit(1)
 
-from output import out
-import pakcore as pak
+    def runImageTool(self, command, pakFiles):
+        """
+        Run sbeImageTool command (signPak or pakHash) on pakFiles, a dict of
+        section name to pak file, through the signing worker if --sign_socket
+        is given. Returns True if the tool was run.
+        """
+        pakFilesArg = ""
+        for sectionName, pakFile in pakFiles.items():
+            pakFilesArg += sectionName + "=" + pakFile + " "
+
+        cmd = f"{self.sbeImageTool} --pakToolDir {self.pakToolsDir} \
+                {command} --pakFiles {pakFilesArg}"
+
+        print("INFO: %s: %s" % ('signing' if command == 'signPak' else 'hashing', pakFilesArg))
+
+        if not pakFiles or not os.path.exists(self.sbeImageTool):
+            return False
+
+        if self.args.sign_socket:
+            import signWorker
+            with buildTrace.span(command, 'subprocess', worker=self.args.sign_socket):
+                try:
+                    result = signWorker.request(self.args.sign_socket, command, self.sbeImageTool,
+                                                self.pakToolsDir, pakFiles)
+                except (OSError, ValueError) as e:
+                    print(f"ERROR: signing worker {self.args.sign_socket}: {e}")
+                    sys.exit(1)
+            print(result['output'], end='')
+            if result['rc'] != 0:
+                print("%s failed with rc %d in signing worker %s" % (cmd, result['rc'],
+                      self.args.sign_socket))
+                sys.exit(result['rc'])
+            return True
+
+        resp = buildTrace.run(cmd.split(), name=command)
+        if resp.returncode != 0:
+            print("%s failed with rc %d" % (cmd,resp.returncode))
+            sys.exit(resp.returncode)
+        return True
 
-#only print out critical errors. For debug, change CRITICAL to DEBUG
-out.setConsoleLevel(out.levels.CRITICAL)
+    @buildTrace.traced
+    def signSections(self):
+        #----------------------------
+        # Call sbeImageTool signPak
+        #----------------------------
+        if self.runImageTool('signPak', self.signImgSrc):
+            stub_cp(self.signImgSrc, self.signedDir)
+
+        #--------------------------------
+        # Call sbeImageTool pakHash
+        #--------------------------------
+        if self.runImageTool('pakHash', self.hashImgSrc):
+            stub_cp(self.hashImgSrc, self.finalDir)
+
+        stub_cp(self.asisImgSrc, self.finalDir)
+
+        # Use configured 'signed_image' as 'finalArchive' to pack since signing were
+        # skipped for those image sections
+        for sectionName, info  in self.section_info.items():
+            if 'signed_image' in info.keys() and not self.args.allowToSign:
+                print(f"INFO: Copy the configured signed image for '{sectionName}' as final image...")
+                signedImgPath = info['signed_image']
+                for key,value in self.replacement_tags.items():
+                    signedImgPath = signedImgPath.replace(key,value)
+
+                finalArchivePath  = os.path.join(self.finalDir, f"{sectionName}.pak")
+                shutil.copy(signedImgPath, finalArchivePath)
+                self.section_info[sectionName]['finalArchive'] = finalArchivePath
+
+    @buildTrace.traced
+    def buildFlashImage(self):
+        # Create image
+        pakArgs = ""
+        archives = {}
 
-section_info = config['image_sections']
+        #----------------------------
+        # Restore images not hashed
+        #----------------------------
+        for sectionName, info  in self.section_info.items():
+            if sectionName in self.notHashed.keys():
+                archive = self.notHashed[sectionName]
+                if any(True for _ in archive):
+                    self.restoreSaved(info['finalArchive'], archive)
+
+            pakArgs = "%s -p %s=%s" % (pakArgs, sectionName, info['finalArchive'])
+            archives[sectionName] = info['finalArchive']
+
+            # Save newly built sections for later builds
+            if self.sectionCacheDir and 'mergedArchive' in info.keys() and \
+               os.path.exists(info['finalArchive']):
+                sectionCachePut(self.sectionCacheDir, info['cacheKey'], info['finalArchive'],
+                                self.args.cache_size*1024*1024)
+
+        self.imageAssembled = False
+        if self.args.assemble_engine == 'flashbuild':
+            #-------------------------
+            # Create final image
+            #-------------------------
+            self.flashbuildImage(self.flashImagefile, pakArgs)
+            return
+
+        checkFile = None
+        if self.args.assemble_check:
+            checkFile = self.flashImagefile + '.flashbuild'
+            self.flashbuildImage(checkFile, pakArgs)
+
+        # Assemble in process. All copies and the golden image are written at
+        # once, unless the image may be patched instead.
+        import flashImage
+        try:
+            if self.concatCopies > 1 and not self.args.incremental:
+                singleSize = flashImage.assemble(self.imagefile, self.partitions, archives,
+                                                 self.imageCopies, self.goldenImage)
+                # The single image is an output of the build too
+                with open(self.imagefile,'rb') as src, open(self.singleImagefile,'wb') as dst:
+                    fileCopy.copyRange(src.fileno(), dst.fileno(), singleSize)
+                self.imageAssembled = True
+            else:
+                flashImage.assemble(self.flashImagefile, self.partitions, archives)
+        except (OSError, ValueError) as e:
+            print("ERROR: image assembly failed: %s" % e)
+            sys.exit(1)
 
-#### Build stages
-####    Note : Below stage will be skipped if section is configured with 'signed_image'
-####           and '--allowToSign' option is not passed since the SBE provides
-####           frozen signed images so tool should not attempt to sign.
-stage1 = 'merged'
-stage2 = 'signed'
-stage3 = 'final'  #hashed
+        if checkFile:
+            if not filecmp.cmp(self.flashImagefile, checkFile, shallow=False):
+                print("ERROR: builtin image assembly differs from flashbuild build-image %s" %
+                      checkFile)
+                exit(1)
+            os.remove(checkFile)
+
+    def flashbuildImage(self, imageFile, pakArgs):
+        cmd = "%s build-image %s %s%s" % (self.flashBuildTool, self.partitionsfile,
+                                          imageFile, pakArgs)
+        resp = buildTrace.run(cmd.split(), name='flashbuild build-image')
+        if resp.returncode != 0:
+            print("flashbuild failed with rc %d" % resp.returncode)
+            sys.exit(resp.returncode)
 
-mergedDir = os.path.join(genDir,stage1)
-signedDir = os.path.join(genDir,stage2)
-finalDir  = os.path.join(genDir,stage3)
+    @buildTrace.traced
+    def resolveImageLayout(self):
+        # The image is imageCopies copies of the flashbuild image followed by
+        # the golden image, if any
+        args = self.args
+        self.imageCopies = 1
+        self.goldenImage = None
+        if self.concatCopies <= 1:
+            return
+
+        self.imageCopies = self.concatCopies
+        if args.buildGoldenImg:
+            print(f"INFO: Using the custom golden image for the given "
+                  f"side count [{args.buildGoldenImg}]")
+            self.imageCopies = args.buildGoldenImg
+
+        if 'golden_image' in self.config.keys() and not args.buildGoldenImg:
+            print("INFO: Using configured golden image to pack in the NOR image")
+            self.goldenImage = self.inputs[self.config['golden_image']][0]
+
+    @buildTrace.traced
+    def concatImage(self):
+        if self.imageAssembled:
+            return
+        if self.concatCopies <= 1:
+            if self.flashImagefile != self.imagefile:
+                os.replace(self.flashImagefile, self.imagefile)
+            return
+
+        imageParts = [self.flashImagefile] * self.imageCopies
+        if self.goldenImage:
+            imageParts.append(self.goldenImage)
+
+        # Copied in the kernel (reflink/copy_file_range) where possible
+        fileCopy.concatFiles(self.imagefile, imageParts)
+
+    def imageState(self):
+        # Everything that has to match for an incremental build
+        golden = None
+        if self.goldenImage:
+            st = os.stat(self.goldenImage)
+            golden = [self.goldenImage, st.st_size, st.st_mtime_ns]
+        return {
+            'image'      : self.imagefile,
+            'eccImage'   : self.eccImagefile,
+            'partitions' : [list(p) for p in self.partitions],
+            'copies'     : self.imageCopies,
+            'golden'     : golden,
+            # The ECC of the patched ranges comes from the same generator
+            'eccEngine'  : self.args.ecc_engine == 'builtin' and 'builtin' or
+                           (os.path.isfile(self.sbeEccTool) and fileIndex.fileDigest(self.sbeEccTool)),
+        }
+
+    def saveImageState(self):
+        state = self.imageState()
+        for key, path in (('imageFile', self.imagefile), ('eccFile', self.eccImagefile)):
+            st = os.stat(path)
+            state[key] = [st.st_size, st.st_mtime_ns]
+        with open(os.path.join(self.genDir,'image.state'),'w') as f:
+            json.dump(state, f)
+
+    @buildTrace.traced
+    def patchImage(self):
+        """
+        Incremental build: write the changed ranges of the new flashbuild image
+        into every copy of the existing image, and recompute the ECC of those
+        ranges only. Returns False if the image has to be built in full.
+        """
+        if not self.args.incremental:
+            return False
+
+        import eccEngine
+
+        state = self.oldState
+        newState = self.imageState()
+        singleSize = os.path.getsize(self.flashImagefile)
+        goldenSize = self.goldenImage and newState['golden'][1] or 0
+
+        reason = None
+        if not state:
+            reason = "no previous build"
+        elif any(state.get(key) != value for key, value in newState.items()):
+            reason = "image layout changed"
+        elif not all(os.path.exists(path) and
+                     [os.stat(path).st_size, os.stat(path).st_mtime_ns] == state[key]
+                     for key, path in (('imageFile', self.imagefile),
+                                       ('eccFile', self.eccImagefile))):
+            reason = "image modified since the last build"
+        elif sum(size for (_,size) in self.partitions) != singleSize or \
+             state['imageFile'][0] != singleSize * self.imageCopies + goldenSize:
+            reason = "partitions don't match the flashbuild image"
+        elif singleSize % eccEngine.WORD_SIZE:
+            reason = "image size is not a multiple of %d" % eccEngine.WORD_SIZE
+        if reason:
+            print(f"INFO: Full image build, {reason}")
+            return False
+
+        # Changed blocks of each partition, compared to the first copy
+        ranges = []
+        changed = []
+        with open(self.flashImagefile,'rb') as new, open(self.imagefile,'r+b') as img, \
+             open(self.eccImagefile,'r+b') as ecc:
+            offset = 0
+            for (sectionName, size) in self.partitions:
+                for blockOffset in range(offset, offset+size, PATCH_BLOCK_SIZE):
+                    length = min(PATCH_BLOCK_SIZE, offset+size-blockOffset)
+                    if os.pread(new.fileno(), length, blockOffset) == \
+                       os.pread(img.fileno(), length, blockOffset):
+                        continue
+                    if sectionName not in changed:
+                        changed.append(sectionName)
+                    if ranges and sum(ranges[-1]) == blockOffset:
+                        ranges[-1][1] += length
+                    else:
+                        ranges.append([blockOffset, length])
+                offset += size
+
+            aligned = []
+            for (start, length) in ranges:
+                # ECC words are 8 data bytes
+                end = start + length
+                start -= start % eccEngine.WORD_SIZE
+                end += -end % eccEngine.WORD_SIZE
+                aligned.append((start, end-start))
+
+            for ((start, length), eccData) in zip(aligned, self.patchEcc(new, aligned)):
+                data = os.pread(new.fileno(), length, start)
+                for copy in range(self.imageCopies):
+                    imgOffset = copy * singleSize + start
+                    os.pwrite(img.fileno(), data, imgOffset)
+                    os.pwrite(ecc.fileno(), eccData,
+                              imgOffset // eccEngine.WORD_SIZE * eccEngine.ECC_WORD_SIZE)
+
+        if self.flashImagefile != self.singleImagefile:
+            os.remove(self.flashImagefile)
+
+        print("INFO: Patched %d bytes of %s in %s" % (sum(length for (_,length) in ranges),
+              ",".join(changed) or "no partition", self.imagefile))
+        return True
+
+    def patchEcc(self, new, ranges):
+        """
+        ECC of the word aligned ranges of the file new, with the --ecc_engine
+        that made the ECC image
+        """
+        import eccEngine
+        if self.args.ecc_engine == 'builtin':
+            return [eccEngine.injectChunk(os.pread(new.fileno(), length, start))
+                    for (start, length) in ranges]
+
+        # ECC words don't depend on their offset, so one tool run does all ranges
+        patchFile = os.path.join(self.genDir, 'patch.bin')
+        with open(patchFile,'wb') as f:
+            for (start, length) in ranges:
+                f.write(os.pread(new.fileno(), length, start))
+        cmd = "%s --inject %s --output %s.ecc --p8" % (self.sbeEccTool, patchFile, patchFile)
+        resp = buildTrace.run(cmd.split(), name='ecc')
+        if resp.returncode != 0:
+            print("ecc failed with rc %d" % resp.returncode)
+            sys.exit(resp.returncode)
+        with open(patchFile + '.ecc','rb') as f:
+            eccData = f.read()
+        os.remove(patchFile)
+        os.remove(patchFile + '.ecc')
+
+        eccRanges = []
+        offset = 0
+        for (_, length) in ranges:
+            eccLength = length // eccEngine.WORD_SIZE * eccEngine.ECC_WORD_SIZE
+            eccRanges.append(eccData[offset:offset+eccLength])
+            offset += eccLength
+        if offset != len(eccData):
+            print("ERROR: ecc output of %s is %d bytes, expected %d" % (patchFile, len(eccData), offset))
+            sys.exit(1)
+        return eccRanges
+
+    @buildTrace.traced
+    def finishImage(self, patched):
+        """
+        Post-assembly stages. They only read the finished image, so they run
+        concurrently, except where one needs the output of another.
+        """
+        import taskRunner
+        needsEcc = []
+        stages = []
+        if not patched:
+            # An incremental build patched the ECC image already
+            stages.append(('ecc', self.injectEcc, []))
+            needsEcc = ['ecc']
+        stages += [('infoTxt', self.extractInfoTxt, []),
+                   ('debugArchive', self.updateDebugArchive, ['infoTxt']),
+                   ('imageState', self.saveImageState, needsEcc)]
+        needsVerify = []
+        if self.args.verify:
+            stages.append(('verify', self.verifyImage, needsEcc))
+            needsVerify = ['verify']
+        # The sbe tests may read the debug tar in the sbe tree
+        stages.append(('sbeTests', self.runSbeTests, needsEcc + needsVerify + ['debugArchive']))
+        taskRunner.runStages(stages)
+
+    def debugArchivePath(self):
+        return os.path.join(self.sbeImageDir, "odyssey/odyssey_sbe_debug_DD1.tar.gz")
+
+    def updatesDebugArchive(self):
+        return self.concatCopies > 1 and not self.args.disable_arch_nor_img and \
+               "lab_image_config" not in self.configFile
+
+    @buildTrace.traced
+    def extractInfoTxt(self):
+        self.infoTxt = None
+        if not self.updatesDebugArchive():
+            return
+        pak = self.pak
+
+        # open imagefile to check for info.txt
+        imgArchive = pak.Archive(self.imagefile)
+        imgArchive.load()
 
-os.makedirs(mergedDir,exist_ok=True)
-os.makedirs(signedDir,exist_ok=True)
-os.makedirs(finalDir,exist_ok=True)
+        try:
+            # get the info.txt for runtime
+            self.infoTxt = bytes(imgArchive.extract('info.txt'))
+        except pak.ArchiveError as e:
+           self.out.print(str(e))
 
-#
-replacement_tags = {
-        '%binariesDir%'  : binariesDir,
-        '%imageToolDir%' : imageToolDir,
-        '%ekbImageDir%' : ekbImageDir,
-        '%sbeImageDir%' : sbeImageDir,
-        '%sbeRoot%'     : sbeBase,
-        '%gen%'         : genDir,
-}
+    @buildTrace.traced
+    def updateDebugArchive(self):
+        if not self.updatesDebugArchive():
+            return
 
-# Discover partitions
-partitions = []
-for sectionName, info in section_info.items():
-    partitions.append((sectionName, info['partition_size']))
+        import tarStream
 
-# Create partitions file and build partition table
-partitionsfile = buildPartitionTable(partitions)
+        print("INFO: Odyssey pnor image config")
+        # Add odyssey_nor_DD1.img into odyssey_sbe_debug_DD1.tar.gz
+        archSbeDebugTar = self.debugArchivePath()
+        if not os.path.exists(archSbeDebugTar):
+            print(f"{archSbeDebugTar} does not exist", file=sys.stderr)
+            sys.exit(1)
 
-# Resolve archive paths in image_sections
-# Merge archives where more than one exists in an image section
-for sectionName, info in section_info.items():
-    if 'signed_image' in info.keys() and not args.allowToSign:
-        print(f"INFO: Use configured signed image for '{sectionName}' so no signing...")
-        continue
+        debugTools = "odyssey_debug_files_tools"
+        addFiles = [(debugTools + "/" + os.path.basename(self.imagefile), self.imagefile)]
+        if self.infoTxt is not None:
+            addFiles.append((debugTools + "/info.txt", self.infoTxt))
+
+        # The members are streamed from the old tar file into the new one and
+        # compressed on all cores, nothing is extracted
+        print("INFO: Add odyssey_nor_DD1.img into odyssey_sbe_debug_DD1.tar.gz")
+        with buildTrace.span('rewriteTar', tar=archSbeDebugTar):
+            tarStream.rewriteTar(archSbeDebugTar, addFiles)
+
+    @buildTrace.traced
+    def injectEcc(self):
+        #--------------------------
+        # ecc
+        #--------------------------
+        if self.args.ecc_engine == 'builtin':
+            import eccEngine
+            try:
+                eccEngine.inject(self.imagefile, self.eccImagefile)
+            except (OSError, ValueError) as e:
+                print("ecc failed: %s" % e)
+                sys.exit(1)
+        else:
+            cmd = "%s --inject %s --output %s --p8" % (self.sbeEccTool,self.imagefile,
+                                                      self.eccImagefile)
+            resp = buildTrace.run(cmd.split())
+            if resp.returncode != 0:
+                print("ecc failed with rc %d" % resp.returncode)
+                sys.exit(resp.returncode)
 
-    archives    = []
-    baseEntries = []
+    @buildTrace.traced
+    def verifyImage(self):
+        #--------------------------
+        # Verify the image and ECC image against the config
+        #--------------------------
+        import imageVerify
+
+        sections = []
+        for sectionName, size in self.partitions:
+            info = self.section_info[sectionName]
+            hashList = None
+            if 'hashlist' in info.keys():
+                hashList = os.path.join(info['hashpath'], info['hashlist'])
+            files = []
+            if 'signed_image' not in info.keys() or self.args.allowToSign:
+                # Configured signed images were built elsewhere
+                for (entryName, entryPath) in info.get('files', []):
+                    if entryName != 'part.tbl':
+                        files.append((entryName, self.replaceTags(entryPath)))
+            sections.append(imageVerify.Section(sectionName, size, info['finalArchive'],
+                                                hashList, info.get('imagehash'), files))
+
+        # part.tbl entries are checked against a table compiled again from the
+        # partitions of the image, not the gen/part.tbl they were made of
+        verifyDir = os.path.join(self.genDir, 'verify')
+        os.makedirs(verifyDir, exist_ok=True)
+        partitionsFile = os.path.join(verifyDir, 'partitions')
+        with open(partitionsFile,'w') as f:
+            print(self.partitions, file=f)
+        partTable = os.path.join(verifyDir, 'part.tbl')
+        cmd = [self.flashBuildTool, "compile-ptable", partitionsFile, partTable]
+        resp = buildTrace.run(cmd, name='flashbuild compile-ptable')
+        if resp.returncode != 0:
+            print("ERROR: verify: %s failed with rc %d" % (" ".join(cmd), resp.returncode))
+            sys.exit(1)
 
-    # Resolve location of archive images
-    for arc in info['archives']:
+        # All cpus unless -j is given
+        jobs = self.args.jobs if self.args.jobs > 1 else None
+        print("INFO: Verifying %s" % self.imagefile)
+        errors = imageVerify.verify(self.pak, self.imagefile, sections, self.imageCopies,
+                                    self.goldenImage, self.eccImagefile, partTable, jobs)
+        for error in errors:
+            print("ERROR: verify: %s" % error)
+        if errors:
+            sys.exit(1)
+        print("INFO: %s verified" % self.imagefile)
+
+    @buildTrace.traced
+    def runSbeTests(self):
+        #--------------------------
+        # Run SBE test cases
+        #--------------------------
+        if not self.args.sbe_test:
+            return
+
+        sbeBase = self.sbeBase
+        print("------------------------")
+        print("Running SBE test cases")
+        print("------------------------")
+        if not os.path.exists(sbeBase):
+            print(f"{sbeBase} is not exist", file=sys.stderr)
+            sys.exit(1)
+        elif not os.path.exists(os.path.join(sbeBase, "internal")):
+            print(f"Not found 'internal' directory in {sbeBase} to run test cases")
+            sys.exit(1)
 
-        arc = resolveFile(arc, replacement_tags, overrides, binaries)
-        archives.append(arc)
+        # Runs next to other stages, so no chdir
+        workon_cmd = self.config['sbeWorkon']
+        runtest_cmd = f"./sbe runtest {self.output}"
+        with buildTrace.Popen(workon_cmd.split(),stdin=subprocess.PIPE,cwd=sbeBase) as proc:
+            proc.communicate(input=str.encode(runtest_cmd))
+            if proc.returncode != 0:
+                print(f"SBE test cases is failed, returncode: {proc.returncode}",
+                      file=sys.stderr)
+                sys.exit(1)
 
-    if 'files' in info.keys():
-        for (entryName,entryPath) in info['files']:
-            for key,value in replacement_tags.items():
-                entryPath = entryPath.replace(key,value)
-            baseEntries.append((entryName,entryPath))
+    #--------------------------
+    # Sections
+    #--------------------------
+    def paktoolMerge(self, mergedArchiveFile, archiveFileList):
+        cmd = [self.pakTool, "merge", mergedArchiveFile] + archiveFileList
+        resp = buildTrace.run(cmd, name='paktool merge')
+        if resp.returncode != 0:
+            print("ERROR: %s failed with rc %d" % (" ".join(cmd), resp.returncode))
+            exit(1)
 
-    # merge archives
-    section_info[sectionName]['mergedArchive'] = mergeArchives(sectionName, archives, baseEntries)
+    def builtinMerge(self, archive, archiveFileList):
+        # Same as paktool merge: entries of each archive are appended in order
+        # and an entry name may only exist once
+        names = set(entry.name for entry in archive)
+        for archiveFile in archiveFileList:
+            srcArchive = self.pak.Archive(archiveFile)
+            srcArchive.load()
+            for entry in srcArchive:
+                if entry.name in names:
+                    print("ERROR: %s: duplicate entry %s" % (archiveFile, entry.name))
+                    exit(1)
+                names.add(entry.name)
+                archive.append(entry)
+
+    def mergeArchives(self, sectionName, archiveFileList, baseEntries):
+        """
+        Returns the merged archive of the section. The caller saves it.
+        """
+        pak = self.pak
+        # Create an empty archive for the section
+        mergedArchiveFile = os.path.join(self.mergedDir, sectionName+'.pak')
+        if os.path.exists(mergedArchiveFile): os.remove(mergedArchiveFile)
+        archive = pak.Archive(mergedArchiveFile)
+
+        # Add essential entries
+        for (entryName,entryPath) in baseEntries:
+            entryData = ''.encode()
+            if os.path.exists(entryPath):
+                with open(entryPath, "rb") as f:
+                    entryData = f.read()
+
+            archive.add(entryName, pak.CM.store ,entryData)
+
+        if len(archiveFileList) == 0:
+            return archive
+
+        if self.args.merge_engine == 'paktool':
+            # Merge archives
+            archive.save()
+            self.paktoolMerge(mergedArchiveFile, archiveFileList)
+
+            archive = pak.Archive(mergedArchiveFile)
+            archive.load()
+            return archive
+
+        # Merge archives in process
+        checkFile = None
+        if self.args.merge_check:
+            archive.save()
+            checkFile = os.path.join(self.mergedDir, sectionName+'.paktool.pak')
+            shutil.copyfile(mergedArchiveFile, checkFile)
+            self.paktoolMerge(checkFile, archiveFileList)
+
+        self.builtinMerge(archive, archiveFileList)
+
+        if checkFile:
+            archive.save()
+            if not filecmp.cmp(mergedArchiveFile, checkFile, shallow=False):
+                print("ERROR: builtin merge of '%s' differs from paktool merge %s" %
+                      (sectionName, checkFile))
+                exit(1)
+            os.remove(checkFile)
+
+        return archive
+
+    def makeHashList(self, archive, hashfile):
+        out = self.out
+        # Create all the hashes for the selected files
+        out.print("Creating hashes")
+        out.moreIndent()
+        if self.args.hash_jobs > 1:
+            # Entries are independent and hashlib/zlib release the GIL on large
+            # buffers. Each hash is stored in its entry, so createHashList() sees
+            # the same result as hashing one entry at a time.
+            entries = list(archive)
+            for entry in entries:
+               out.print(entry.name)
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.args.hash_jobs) as pool:
+                for _ in pool.map(lambda entry: entry.hash(), entries):
+                    pass
+        else:
+            for entry in archive:
+               out.print(entry.name)
+               entry.hash()
+        out.lessIndent()
 
+        #Add the hash.list content
+        archive.add(hashfile, self.pak.CM.store, archive.createHashList())
 
-# Add signature/hash to sections that require it
-signImgSrc = {}
-hashImgSrc = {}
-asisImgSrc = {}
+    def saveAndRemove(self, archive, savedArch, extractList):
+        # An non-existant or empty list would extract everything - don't allow
+        if not extractList:
+            return
 
-notHashed = {}
-
-for sectionName, info in section_info.items():
-    if 'mergedArchive' not in info.keys():
-        continue
-
-    pakname = info['mergedArchive']
-
-    ## Extract and save entries that should not be hashed, then remove them from the archive
-    saveArchive = pak.Archive()
-    if 'noHash' in info.keys():
-        saveAndRemove(pakname, saveArchive, info['noHash'])
+        try:
+            # Filter the list
+            result = archive.find(extractList)
+        except self.pak.ArchiveError as e:
+            self.out.print(str(e))
+            return
 
-    if 'hashlist' in info.keys():
-        #----------------------------
-        # Generate hash.list
-        #----------------------------
-        hashpath = info['hashpath']
-        hashlist = info['hashlist']
+        # Move the files
+        for entry in result:
+            savedArch.append(entry)
+            archive.remove(entry)
 
-        # hashname in archive
-        archivefn = os.path.join(hashpath,hashlist)
+        return
 
-        # create hash list and add it to the archive
-        makeHashList(pakname, archivefn)
+    def restoreSaved(self, archiveName, savedArc):
+        archive = self.pak.Archive(archiveName)
+        archive.load()
+
+        for entry in savedArc:
+            archive.append(entry)
+
+        archive.save()
+
+    def prepareSection(self, sectionName, info):
+        """
+        Resolve the section's archives and merge them, then remove the noHash
+        entries and add the hash list. Returns the section_info updates.
+        """
+        pak = self.pak
+        result      = {}
+        archives    = []
+        baseEntries = []
+
+        # Location of archive images, resolved by resolveInputs()
+        for arc in info['archives']:
+            archives.extend(self.inputs[arc])
+
+        if 'files' in info.keys():
+            for (entryName,entryPath) in info['files']:
+                for key,value in self.replacement_tags.items():
+                    entryPath = entryPath.replace(key,value)
+                baseEntries.append((entryName,entryPath))
+
+        if self.sectionCacheDir:
+            archiveDigests = [self.inputDigests.get(arc) or fileIndex.fileDigest(arc)
+                              for arc in archives]
+            key = sectionCacheKey(sectionName, info, archiveDigests, baseEntries, self.toolsHash)
+            result['cacheKey'] = key
+            finalName = os.path.join(self.finalDir, sectionName+'.pak')
+            if sectionCacheGet(self.sectionCacheDir, key, finalName):
+                print(f"INFO: Using cached '{sectionName}' section {key[:16]}")
+                result['finalArchive'] = finalName
+                return result
+
+        # The section archive stays in memory until it is needed on disk by
+        # the sign/hash tools or flashbuild
+        with buildTrace.span('mergeArchives', section=sectionName):
+            archive = self.mergeArchives(sectionName, archives, baseEntries)
+        pakname = os.path.join(self.mergedDir, sectionName+'.pak')
+        result['mergedArchive'] = pakname
+
+        ## Extract and save entries that should not be hashed, then remove them from the archive
+        saveArchive = pak.Archive()
+        if 'noHash' in info.keys():
+            self.saveAndRemove(archive, saveArchive, info['noHash'])
+
+        if 'hashlist' in info.keys():
+            #----------------------------
+            # Generate hash.list
+            #----------------------------
+            hashpath = info['hashpath']
+            hashlist = info['hashlist']
+
+            # hashname in archive
+            archivefn = os.path.join(hashpath,hashlist)
+
+            # create hash list and add it to the archive
+            with buildTrace.span('makeHashList', section=sectionName):
+                self.makeHashList(archive, archivefn)
+        elif 'imagehash' not in info.keys():
+            # Used as is, nothing to restore after signing/hashing
+            for entry in saveArchive:
+                archive.append(entry)
+            saveArchive = pak.Archive()
+
+        with buildTrace.span('saveArchive', section=sectionName):
+            archive.save()
+        result['notHashed'] = saveArchive
+
+        return result
+
+    def prepareSectionWorker(self, sectionName, info):
+        position = buildTrace.mark()
+        with buildTrace.span('prepareSection', section=sectionName):
+            result = self.prepareSection(sectionName, info)
+
+        # Archives don't cross the process boundary, hand the saved noHash
+        # entries back as a file instead
+        if 'notHashed' in result:
+            savedName = os.path.join(self.mergedDir, sectionName+'.nohash.pak')
+            savedArchive = self.pak.Archive(savedName)
+            for entry in result['notHashed']:
+                savedArchive.append(entry)
+            savedArchive.save()
+            result['notHashed'] = savedName
+
+        # The worker's events are added to the trace of the parent
+        result['traceEvents'] = buildTrace.takeEvents(position)
+        return result
+
+    #--------------------------
+    # Inputs
+    #--------------------------
+    @buildTrace.traced
+    def resolveInputs(self):
+        """
+        Resolve the archives, signed images and golden image of the config in
+        one pass. All missing files are reported before giving up.
+        """
+        args = self.args
+        self.inputs = {}
+        self.inputDigests = {}
+        missing = []
+
+        specs = []
+        for sectionName, info in self.section_info.items():
+            if 'signed_image' in info.keys() and not args.allowToSign:
+                signedImgPath = self.replaceTags(info['signed_image'])
+                if not os.path.exists(signedImgPath):
+                    missing.append(signedImgPath)
+                continue
+            for arc in info['archives']:
+                specs.append((arc, False))
+        if self.concatCopies > 1 and 'golden_image' in self.config.keys() and \
+           not args.buildGoldenImg:
+            specs.append((self.config['golden_image'], True))
+
+        for (spec, single) in specs:
+            if spec in self.inputs:
+                continue
+            paths = self.locateFile(spec)
+            if not paths:
+                missing.append(self.replaceTags(spec))
+            elif single and len(paths) > 1:
+                print(f"ERROR {spec} matches more than one file: {' '.join(paths)}")
+                missing.append(self.replaceTags(spec))
+            else:
+                self.inputs[spec] = paths
 
-        # Must be signed, so source pak to sign comes from stage1
-        signImgSrc[sectionName] = pakname
-        # Must be hashed, so source pakname to hash comes from stage2
-        hashImgSrc[sectionName] = pakname.replace(stage1,stage2)
-    elif 'imagehash' in info.keys():
-        # Not to be signed, only hashed, so source pakname to hash is from stage1.
-        hashImgSrc[sectionName] = pakname
+        if missing:
+            for fpath in missing:
+                print(f"ERROR Required file not found: {fpath}")
+            sys.exit(1)
 
-    else:
-        asisImgSrc[sectionName] = pakname
-
-    # All paks will exist in stage3 - used to build final flash image
-    finalName = pakname.replace(stage1,stage3)
-    section_info[sectionName]['finalArchive'] = finalName
-    notHashed[sectionName] = saveArchive
-
-#----------------------------
-# Call sbeImageTool signPak
-#----------------------------
-# If running in op-build use the host dir
-if os.environ.get('HOST_DIR'):
-    os.environ['OPBUILD_HOST_DIR'] = os.environ.get('HOST_DIR')
-    os.environ['OPEN_SSL_PATH']='/bin/openssl'
-else:
-    # Checking for env var SIGNING_BASE_DIR as expected to be
-    # already set to work within the secure build env, for every
-    # other env (local build, CI etc) SIGNING_RHEL_PATH would be set
-    if not os.environ.get('SIGNING_BASE_DIR'):
-        checkEnvVarExist('SIGNING_RHEL_PATH')
-    if not os.environ.get('OPEN_SSL_PATH'):
-         os.environ['OPEN_SSL_PATH']='/bin/openssl'
-
-pakFilesToSign = ""
-for sectionName, pakFile in signImgSrc.items():
-    pakFilesToSign += sectionName + "=" + pakFile + " "
-
-cmd = f"{sbeImageTool} --pakToolDir {pakToolsDir} \
-        signPak --pakFiles {pakFilesToSign}"
-
-print(f"INFO: signing: {pakFilesToSign}")
-
-if os.path.exists(sbeImageTool):
-    resp = subprocess.run(cmd.split())
-    if resp.returncode != 0:
-        print("%s failed with rc %d" % (cmd,resp.returncode))
-        sys.exit(resp.returncode)
-    else:
-        stub_cp(signImgSrc, signedDir)
+        self.locatedInputs = [fpath for paths in self.inputs.values() for fpath in paths]
+        if args.watch:
+            # The debug tar of the sbe tree is updated by the build itself
+            (files, trees) = self.watchPaths()
+            self.watchSnapshot.add(files, trees, [self.debugArchivePath()])
+
+        for spec, paths in self.inputs.items():
+            self.inputs[spec] = [self.unpackFile(fpath) for fpath in paths]
+
+        # Digests of indexed files are kept in their index for the next build
+        if self.sectionCacheDir:
+            for index in (self.overrides, self.binaries):
+                if not index:
+                    continue
+                for paths in self.inputs.values():
+                    for fpath in paths:
+                        if fpath in index:
+                            self.inputDigests[fpath] = index.digest(fpath)
+                index.save()
+
+    def replaceTags(self, fpath):
+        for key,value in self.replacement_tags.items():
+            fpath = fpath.replace(key,value)
+        return fpath
+
+    def locateFile(self, fpath):
+        """
+        Return the files fpath stands for. fpath may be a glob pattern on the
+        file name, it then stands for all matching files of the first place
+        that has any.
+        """
+        fpath = self.replaceTags(fpath)
+        # First look for the file in the overrides
+        # If not there then check fpath
+        # If not there then look in binaries
+        fname =  os.path.basename(fpath)
+        if fileIndex.isPattern(fname):
+            for paths in (self.overrides and self.overrides.glob(fname),
+                          sorted(glob.glob(fpath)),
+                          self.binaries and self.binaries.glob(fname)):
+                if paths:
+                    return paths
+            return []
+
+        if self.overrides and self.overrides.find(fname):
+            paths = self.overrides.find(fname)
+            if len(paths) > 1:
+                print(f"WARN {fname} found more than once in the overrides, using {paths[0]}")
+            return paths[:1]
+        if os.path.exists(fpath):
+            return [fpath]
+        if self.binaries and self.binaries.find(fname):
+            return self.binaries.find(fname)[:1]
+        return []
+
+    def unpackFile(self, newPath):
+        tgzext = '.tar.gz'
+        if newPath.endswith(tgzext):
+            if self.cacheDir:
+                # Only the file named after the tarball is needed
+                member = os.path.basename(newPath)[:-len(tgzext)]
+                newPath = os.path.join(self.cachedExtract(newPath,[member]), member)
+            else:
+                # untar tar -C binaries -xzf binaries/sbe_images/odyssey_dd1_0/golden/golden_odyssey_nor_DD1.img.tar.gz
+                # TODO might want to consider case where newPath is in an unwriteable location
+                extractTar(newPath, os.path.dirname(newPath))
+                newPath=newPath[:-len(tgzext)]
+        print(f"INFO: Using {newPath}")
+        return newPath
+
+    def cachedExtract(self, tarPath, members=None):
+        """
+        Extract tarPath once into the extraction cache and return the directory
+        holding its content. The cache key is the size and mtime of the tar file,
+        or its content digest with --strict_cache.
+        """
+        if self.args.strict_cache:
+            key = "sha256=%s" % fileIndex.fileDigest(tarPath)
+        else:
+            st = os.stat(tarPath)
+            key = "%s:%d:%d" % (os.path.realpath(tarPath), st.st_size, st.st_mtime_ns)
+        if members:
+            key += ":" + ",".join(sorted(members))
+        key = hashlib.sha256(key.encode()).hexdigest()
+
+        extractDir = os.path.join(self.cacheDir,'extract',key)
+        self.usedExtracts.add(extractDir)
+        if os.path.exists(extractDir):
+            # Marks it as recently used for the eviction
+            try:
+                os.utime(extractDir)
+            except OSError:
+                pass
+            return extractDir
+
+        # Extract into a private directory and publish it with a rename, so other
+        # builds never see a partially extracted tar file
+        tmpDir = "%s.%d.tmp" % (extractDir, os.getpid())
+        if os.path.exists(tmpDir):
+            shutil.rmtree(tmpDir)
+        os.makedirs(tmpDir)
+        print(f"INFO: Extracting {tarPath} into cache")
+        extractTar(tarPath, tmpDir, members)
+        try:
+            os.rename(tmpDir, extractDir)
+        except OSError:
+            # Another build published it first
+            shutil.rmtree(tmpDir)
+        evictExtracts(os.path.dirname(extractDir), self.args.cache_size*1024*1024,
+                      self.usedExtracts)
+        return extractDir
+
+    @buildTrace.traced
+    def updateBinariesMirror(self, url, branch, commits):
+        """
+        Create or update the bare mirror of the binaries repository in the cache
+        dir. The mirror holds the branches and tags of the repository, not its
+        other refs (pull requests...). It is fetched when one of the requested
+        commits is missing (or --update_binaries is given), pins that are still
+        missing are fetched by name. An empty commit asks for the latest
+        commit, then the branch is always fetched. The fetch is only skipped when
+        every file is pinned to a commit the mirror has. Returns the path of the
+        mirror.
+        """
+        mirrorsDir = os.path.join(self.cacheDir,'binaries')
+        os.makedirs(mirrorsDir,exist_ok=True)
+        mirrorPath = os.path.join(mirrorsDir,
+                                  hashlib.sha256(url.encode()).hexdigest()[:16]+'.git')
+
+        # The mirror is shared by all builds using the same cache dir
+        with open(mirrorPath+'.lock','w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+
+            if not os.path.exists(mirrorPath):
+                tmpPath = "%s.%d.tmp" % (mirrorPath, os.getpid())
+                if os.path.exists(tmpPath):
+                    shutil.rmtree(tmpPath)
+                # Branches and tags only, a --mirror clone would also get
+                # every pull request of the repository
+                cmd = ["git","clone","--bare",url,tmpPath]
+                print("INFO: " + " ".join(cmd))
+                resp = buildTrace.run(cmd)
+                if resp.returncode != 0:
+                    print(f"ERROR: {' '.join(cmd)} failed with rc {resp.returncode}")
+                    sys.exit(resp.returncode)
+                # A bare clone has no fetch refspec, set one so fetches update the branches
+                buildTrace.run(["git","-C",tmpPath,"config","remote.origin.fetch",
+                                "+refs/heads/*:refs/heads/*"])
+                os.rename(tmpPath, mirrorPath)
+                missing = [c for c in commits if c and not gitHasCommit(mirrorPath, c)]
+            else:
+                missing = [c for c in commits if c and not gitHasCommit(mirrorPath, c)]
+                if missing or self.args.update_binaries or '' in commits:
+                    if missing:
+                        print(f"INFO: {' '.join(missing)} not in binaries mirror")
+                    # Mirrors made by earlier versions with --mirror fetch all refs
+                    resp = buildTrace.run(["git","-C",mirrorPath,"config","--get",
+                                           "remote.origin.mirror"],stdout=subprocess.DEVNULL)
+                    if resp.returncode == 0:
+                        buildTrace.run(["git","-C",mirrorPath,"config","--unset",
+                                        "remote.origin.mirror"])
+                        buildTrace.run(["git","-C",mirrorPath,"config","remote.origin.fetch",
+                                        "+refs/heads/*:refs/heads/*"])
+                    cmd = ["git","-C",mirrorPath,"fetch","--prune","--tags","origin"]
+                    if not missing and not self.args.update_binaries and branch:
+                        # Only the latest commit of the branch is needed
+                        cmd = ["git","-C",mirrorPath,"fetch","origin",
+                               f"+refs/heads/{branch}:refs/heads/{branch}"]
+                    print("INFO: " + " ".join(cmd))
+                    resp = buildTrace.run(cmd)
+                    if resp.returncode != 0:
+                        print(f"ERROR: {' '.join(cmd)} failed with rc {resp.returncode}")
+                        sys.exit(resp.returncode)
+                else:
+                    print(f"INFO: Using binaries mirror {mirrorPath}")
+
+            fetchPins(mirrorPath, missing)
+
+        return mirrorPath
+
+    def partialCloneBinaries(self, downloads):
+        """
+        Bare partial clone (--filter=blob:none) of the binaries repository of
+        a structured 'binaries' config: the commits and trees of the branch are
+        cloned, file contents are only fetched for the configured files. The
+        clone is kept in the cache dir if there is one. It is fetched again
+        when a requested commit is missing (or --update_binaries is given), and
+        the branch is fetched when a file asks for the latest commit ('').
+        Returns (path of the clone, ref of the latest commit).
+        """
+        binaries = self.config['binaries']
+        url = binaries['url']
+        branch = binaries.get('branch')
+        commits = [commit for (_,commit) in binaries['files'] if commit]
+
+        if self.cacheDir:
+            clonesDir = os.path.join(self.cacheDir,'binaries')
+            repoPath = os.path.join(clonesDir,
+                                    hashlib.sha256(f"{url} {branch}".encode()).hexdigest()[:16]+'.partial.git')
+        else:
+            clonesDir = downloads
+            repoPath = os.path.join(downloads,"released")
+        os.makedirs(clonesDir,exist_ok=True)
+
+        # The clone is shared by all builds using the same cache dir
+        with open(repoPath+'.lock','w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+
+            cloned = False
+            if not os.path.exists(repoPath):
+                tmpPath = "%s.%d.tmp" % (repoPath, os.getpid())
+                if os.path.exists(tmpPath):
+                    shutil.rmtree(tmpPath)
+                cmd = ["git","clone","--bare","--filter=blob:none"]
+                if branch:
+                    cmd += ["--single-branch","--branch",branch]
+                cmd += [url,tmpPath]
+                print("INFO: " + " ".join(cmd))
+                resp = buildTrace.run(cmd)
+                if resp.returncode != 0:
+                    print(f"ERROR: {' '.join(cmd)} failed with rc {resp.returncode}")
+                    sys.exit(resp.returncode)
+                # A bare clone has no fetch refspec, set one so fetches update the branch
+                heads = f"refs/heads/{branch}" if branch else "refs/heads/*"
+                buildTrace.run(["git","-C",tmpPath,"config","remote.origin.fetch",f"+{heads}:{heads}"])
+                os.rename(tmpPath, repoPath)
+                cloned = True
+
+            missing = [c for c in commits if not gitHasCommit(repoPath, c)]
+            if missing or (self.args.update_binaries and not cloned):
+                cmd = ["git","-C",repoPath,"fetch","--prune","--tags","origin"]
+                print("INFO: " + " ".join(cmd))
+                resp = buildTrace.run(cmd)
+                if resp.returncode != 0:
+                    print(f"ERROR: {' '.join(cmd)} failed with rc {resp.returncode}")
+                    sys.exit(resp.returncode)
+            elif not cloned and any(not commit for (_,commit) in binaries['files']):
+                # Files of the latest commit, update the branch
+                cmd = ["git","-C",repoPath,"fetch","origin"]
+                print("INFO: " + " ".join(cmd))
+                resp = buildTrace.run(cmd)
+                if resp.returncode != 0:
+                    print(f"ERROR: {' '.join(cmd)} failed with rc {resp.returncode}")
+                    sys.exit(resp.returncode)
+            elif not cloned:
+                print(f"INFO: Using binaries clone {repoPath}")
+
+            fetchPins(repoPath, missing)
+
+            baseRef = 'HEAD'
+            if branch:
+                baseRef = 'refs/heads/' + branch
+            specs = [f"{commit or baseRef}:{file}" for (file,commit) in binaries['files']]
+            fetchMissingBlobs(repoPath, [commit or baseRef for (_,commit) in binaries['files']], specs)
+
+        return (repoPath, baseRef)
+
+    @buildTrace.traced
+    def downloadBinaries(self, output):
+        config = self.config
+        cwd = os.getcwd()
+        binariesDir=os.path.join(output,"binaries")
+        if os.path.exists(binariesDir):
+            shutil.rmtree(binariesDir)
+        os.makedirs(binariesDir)
+        downloads = os.path.join(output,"downloads")
+        if os.path.exists(downloads):
+            shutil.rmtree(downloads)
+        os.makedirs(downloads)
+        if 'binaries' in config.keys() and 'url' in config['binaries']:
+            (repoPath, baseRef) = self.partialCloneBinaries(downloads)
+        elif 'binaries' in config.keys():
+            repoName = "released"
+            repoPath = os.path.join(downloads,repoName)
+            baseRef = 'HEAD'
+            os.chdir(downloads)
+            cmds=config['binaries']['repository']
+            for cmd in cmds:
+                if cmd.startswith('git clone') and self.cacheDir:
+                    # Read straight from the local mirror instead of cloning the remote
+                    (url,branch) = parseCloneCmd(cmd)
+                    commits = [commit for (_,commit) in config['binaries']['files']]
+                    repoPath = self.updateBinariesMirror(url, branch, commits)
+                    if branch:
+                        baseRef = branch
+                    continue
+                if cmd.startswith('git clone'):
+                    # Files are read from the object database, no worktree needed
+                    cmd = f"{cmd} --no-checkout {repoName}"
+                print(cmd)
+                resp=buildTrace.run(cmd.split())
+                if resp.returncode != 0:
+                    os.chdir(cwd)
+                    print(f"ERROR: {cmd} failed with rc {resp.returncode}")
+                    sys.exit(resp.returncode)
+            os.chdir(cwd)
 
-#--------------------------------
-# Call sbeImageTool pakHash
-#--------------------------------
-pakFilesToHash = ""
-for sectionName, pakFile in hashImgSrc.items():
-    pakFilesToHash += sectionName + "=" + pakFile + " "
+        if 'binaries' in config.keys():
+            # get base commit id
+            cmd = ["git","-C",repoPath,"rev-parse","--verify",baseRef+"^{commit}"]
+            resp=buildTrace.run(cmd,stdout=subprocess.PIPE)
+            if resp.returncode != 0:
+                print(f"ERROR: {' '.join(cmd)} failed with rc {resp.returncode}")
+                sys.exit(resp.returncode)
+            baseCommit = resp.stdout.decode().strip()
+
+            # Pins are resolved first, branches other than the cloned one
+            # only exist as origin/<branch> in a plain clone
+            pins = resolveCommits(repoPath, [commit for (_,commit) in config['binaries']['files']
+                                             if commit])
+            blobs = []
+            for file,commit in config['binaries']['files']:
+                if commit == '':
+                    commit = baseCommit
+                else:
+                    commit = pins.get(commit, commit)
+                print(f"INFO: {commit}:{file}")
+                blobs.append((f"{commit}:{file}",
+                              os.path.join(binariesDir,os.path.basename(file))))
+            extractBlobs(repoPath, blobs)
+
+        if os.path.exists(downloads):
+            shutil.rmtree(downloads)
+
+        # index binaries, the directory is new for every build
+        binaries = fileIndex.FileIndex(binariesDir)
+        binaries.refresh()
+        return (binariesDir,binaries)
+
+    #--------------------------
+    # Repositories
+    #--------------------------
+    def setupRepository(self, log, basePath, commit, remote):
+        with buildTrace.span('setupRepository', repo=remote, commit=commit):
+            self._setupRepository(log, basePath, commit, remote)
+
+    def _setupRepository(self, log, basePath, commit, remote):
+        args = self.args
+        config = self.config
+        log.print("basePath: %s" % basePath)
+        if not os.path.exists(basePath):
+            if not args.no_downloads:
+                #Download repo
+                log.print("git repo %s does not exist. Attempting to clone it" % basePath)
+                basePath=basePath.rstrip('/')
+                (dir,repo_name) = os.path.split(basePath)
+                os.makedirs(dir,exist_ok=True)
+                log.print("cwd: %s  repo: %s" % (dir,repo_name))
+                cmd = 'git clone -b %s ssh://gerrit-server/%s %s -o gerrit' % (commit, remote, repo_name)
+                log.print(cmd)
+                (rc, _, _) = log.run(cmd.split(), cwd=dir)
+                if rc != 0:
+                    log.print("git clone failed with rc %d" % rc)
+                    sys.exit(1)
 
-cmd = f"{sbeImageTool} --pakToolDir {pakToolsDir} \
-        pakHash --pakFiles {pakFilesToHash}"
+        if not os.path.exists(os.path.join(basePath,'.git')):
+            log.print("%s is not a git repositry" % basePath)
+            sys.exit(1)
 
-print(f"INFO: hashing: {pakFilesToHash}")
+        if not args.nobranchchange:
+            (rc, _, _) = log.run(["git","checkout",commit], cwd=basePath)
+            if rc != 0:
+                log.print("git checkout had returncode %d" % rc)
+                sys.exit(1)
+            if args.update:
+                if 'sbe' in remote:
+                    cmds = ['git pull']
+                elif 'ekb' in remote:
+                    cmds = ['git fetch gerrit', 'git rebase gerrit/%s' % (commit)]
+                else:
+                    log.print('Unknown remote: %s' % remote)
+                    sys.exit(1)
+                for cmd in cmds:
+                    log.print(cmd)
+                    (rc, _, _) = log.run(cmd.split(), cwd=basePath)
+                    if rc != 0:
+                        log.print("git update failed with rc %d" % rc)
+                        sys.exit(1)
+
+        if 'sbe' in remote:
+            cmd= config['sbeWorkon']
+            build_cmd=config['sbeBuild']
+            if (args.devready or args.devreadysbe):
+                if not args.nobranchchange:
+                    self.getDevReadyCommits(log, 'sbe', commit, basePath)
+                else:
+                    log.print("Not getting dev-ready updates because --nobranchchange was specified")
+
+        elif 'ekb' in remote:
+            cmd= config['ekbWorkon']
+            build_cmd= config['ekbBuild']
+            if (args.devready or args.devreadyekb):
+                if not args.nobranchchange:
+                    self.getDevReadyCommits(log, 'ekb', commit, basePath)
+                else:
+                    log.print("Not getting dev-ready updates because --nobranchchange was specified")
+        else:
+            log.print('Unknown remote: %s' % remote)
+            sys.exit(1)
 
-if os.path.exists(sbeImageTool):
-    resp = subprocess.run(cmd.split())
-    if resp.returncode != 0:
-        print("%s failed with rc %d" % (cmd,resp.returncode))
-        sys.exit(resp.returncode)
-    else:
-        stub_cp(hashImgSrc, finalDir)
-
-stub_cp(asisImgSrc, finalDir)
-
-# Use configured 'signed_image' as 'finalArchive' to pack since signing were
-# skipped for those image sections
-for sectionName, info  in section_info.items():
-    if 'signed_image' in info.keys() and not args.allowToSign:
-        print(f"INFO: Copy the configured signed image for '{sectionName}' as final image...")
-        signedImgPath = info['signed_image']
-        for key,value in replacement_tags.items():
-            signedImgPath = signedImgPath.replace(key,value)
-
-        finalArchivePath  = os.path.join(finalDir, f"{sectionName}.pak")
-        shutil.copy(signedImgPath, finalArchivePath)
-        section_info[sectionName]['finalArchive'] = finalArchivePath
-
-# Create image
-cmd = "%s build-image %s %s" % (flashBuildTool, partitionsfile, singleImagefile)
-
-#----------------------------
-# Restore images not hashed
-#----------------------------
-for sectionName, info  in section_info.items():
-    if sectionName in notHashed.keys():
-        archive = notHashed[sectionName]
-        restoreSaved(info['finalArchive'], archive)
-
-    cmd = "%s -p %s=%s" % (cmd, sectionName, info['finalArchive'])
-#print(cmd)
-#-------------------------
-# Create final image
-#-------------------------
-resp = subprocess.run(cmd.split())
-if resp.returncode != 0:
-    print("flashbuild failed with rc %d" % resp.returncode)
-    sys.exit(resp.returncode)
-
-if concatCopies > 1:
-    shutil.copyfile(singleImagefile, imagefile)
-
-    if args.buildGoldenImg:
-        print(f"INFO: Using the custom golden image for the given "
-              f"side count [{args.buildGoldenImg}]")
-        concatCopies = args.buildGoldenImg
-
-    f1 = open(imagefile, 'ab+')
-    for i in range(concatCopies-1):
-        f = open(singleImagefile, 'rb')
-        f1.write(f.read())
-        f.close()
-
-    if 'golden_image' in config.keys() and not args.buildGoldenImg:
-        print("INFO: Using configured golden image to pack in the NOR image")
-        goldenImgPath = config['golden_image']
-
-        goldenImgPath = resolveFile(goldenImgPath, replacement_tags, overrides, binaries)
-
-        goldenImgFd = open(goldenImgPath, 'rb')
-        f1.write(goldenImgFd.read())
-        goldenImgFd.close()
-
-    f1.close()
-
-    if not args.disable_arch_nor_img and "lab_image_config" not in args.configfile:
-        print("INFO: Odyssey pnor image config")
-        # Copy odyssey_nor_DD1.img into odyssey_sbe_debug_DD1.tar.gz
-        archSbeDebugTar = os.path.join(sbeImageDir, "odyssey/odyssey_sbe_debug_DD1.tar.gz")
-        if not os.path.exists(archSbeDebugTar):
-            print(f"{archSbeDebugTar} does not exist", file=sys.stderr)
+        (rc, _, _) = log.run(cmd.split(), input=build_cmd, cwd=basePath)
+        if rc != 0:
+            log.print("Building %s had a returncode %d" % (basePath, rc))
             sys.exit(1)
+
+    def getDevReadyCommits(self, log, repo, commit, basePath):
+        log.print("Running ./%s cronus checkout" % repo)
+        if (repo == 'sbe'):
+            dev_out_file = 'cro_ody_sbe_image_cronus_checkout.sversion'
+            cmd = 'export PROJECT_NAME=sbe; export SBEROOT=`pwd` export SBEROOT_INT=`pwd`/internal; export SBE_INSIDE_WORKON=1; source ./internal/projectrc; ./sbe cronus_devready checkout; unset SBE_INSIDE_WORKON; unset PROJECT_NAME; unset SBEROOT; unset SBEROOT_INT;'
         else:
-            print("INFO: Untar odyssey_sbe_debug_DD1.tar.gz")
-            archive = tarfile.open(archSbeDebugTar)
-            pathSbeDebugTar = os.path.dirname(os.path.abspath(archSbeDebugTar))
+            dev_out_file = 'cro_ody_ekb_image_cronus_checkout.sversion'
+            cmd = 'source ./env.bash; ./ekb cronus checkout --branch %s' % commit
+        # Sometimes seeing stuff in stderr that isn't actually an error, so not going to fail
+        (rc, dev_out, err) = log.run(cmd, name=f'{repo} cronus checkout', cwd=basePath, shell=True, capture=True)
 
-            if 'filter' in inspect.signature(tarfile.TarFile.extractall).parameters:
-                archive.extractall(pathSbeDebugTar,filter="data")
-            else:
-                archive.extractall(pathSbeDebugTar)
+        log.print(repo, " cronus checkout --branch", commit)
 
-            archive.close()
+        # look for explicit problems
+        if ('Outstanding tracked changes' or 'Not a git repository' or 'Run this tool from the root' or 'Cherry-picks failed') in dev_out:
+            log.print("ERROR! Failed checking of dev-ready checkouts")
+            sys.exit(1)
 
-            # Remove odyssey_sbe_debug_DD1.tar.gz
-            os.remove(archSbeDebugTar)
+        # look for confirmation it worked
+        if not ('Checking out' and 'All Cherry-picks applied cleanly') in dev_out:
+            log.print("ERROR! Failed checking out dev-ready checkouts")
+            sys.exit(1)
 
-            print("INFO: Copy odyssey_nor_DD1.img into extracted odyssey_debug_files_tools")
-            pathSbeDebugTools = os.path.join(pathSbeDebugTar, "odyssey_debug_files_tools")
-            shutil.copy(imagefile, pathSbeDebugTools)
+        # write output to a file
+        filename = os.path.join(self.output, dev_out_file)
+        outfile = open(filename, 'w')
+        outfile.write(dev_out)
+        outfile.close()
 
-            # open imagefile to check for info.txt
-            imgArchive = pak.Archive(imagefile)
-            imgArchive.load()
 
-            try:
-                # get the info.txt for runtime
-                data = imgArchive.extract('info.txt')
-                pathInfoTxt = os.path.join(pathSbeDebugTools, "info.txt")
-                outfile = open(pathInfoTxt, 'wb')
-                outfile.write(bytearray(data))
-                outfile.close()
-            except pak.ArchiveError as e:
-               out.print(str(e))
-
-            print("INFO: Archive odyssey_debug_files_tools into tar file odyssey_sbe_debug_DD1.tar.gz")
-            archive = tarfile.open(archSbeDebugTar, "w:gz")
-            archive.add(pathSbeDebugTools, arcname=os.path.basename(pathSbeDebugTools))
-            archive.close()
-
-            # Remove directory odyssey_debug_files_tools
-            shutil.rmtree(pathSbeDebugTools)
-
-#--------------------------
-# ecc
-#--------------------------
-eccImagefile = imagefile+'.ecc'
-cmd = "%s --inject %s --output %s --p8" % (sbeEccTool,imagefile,eccImagefile)
-resp = subprocess.run(cmd.split())
-if resp.returncode != 0:
-    print("ecc failed with rc %d" % resp.returncode)
-    sys.exit(resp.returncode)
-
-#--------------------------
-# Run SBE test cases
-#--------------------------
-if args.sbe_test:
-    print("------------------------")
-    print("Running SBE test cases")
-    print("------------------------")
-    if not os.path.exists(sbeBase):
-        print(f"{sbeBase} is not exist", file=sys.stderr)
-        sys.exit(1)
-    elif not os.path.exists(os.path.join(sbeBase, "internal")):
-        print(f"Not found 'internal' directory in {sbeBase} to run test cases")
-        sys.exit(1)
+############################################################
+# Main - Main - Main - Main - Main - Main - Main - Main
+############################################################
 
-    os.chdir(sbeBase)
+def createParser():
+    parser = argparse.ArgumentParser(description="Build image",
+                                     formatter_class=argparse.RawDescriptionHelpFormatter,
+                                     epilog=textwrap.dedent('''
 
-    workon_cmd = config['sbeWorkon']
-    runtest_cmd = f"./sbe runtest {output}"
-    with subprocess.Popen(workon_cmd.split(),stdin=subprocess.PIPE) as proc:
-        proc.communicate(input=str.encode(runtest_cmd))
-        if proc.returncode != 0:
-            print(f"SBE test cases is failed, returncode: {proc.returncode}",
-                  file=sys.stderr)
-            os.chdir(cwd)
+examples:
+  > imageBuild.py configs/odyssey/dd1/ody_pnor_dd1_image_config -o ./image_output -n pnor.bin
+  > imageBuild.py configs/odyssey/dd1/ody_pnor_dd1_image_config configs/odyssey/dd1/ody_pnor_dd1_lab_image_config
+        -o ./image_output -n pnor.bin -n pnor_lab.bin
+'''))
+
+    parser.add_argument('configfile', nargs='+',
+                        help="The configuration file used to build the image. Several "
+                        "config files build a batch of images sharing their common inputs "
+                        "and sections, each in <output>/<config file name>.")
+    parser.add_argument('-b','--build',action='store_true',
+                        help='Downloads ekb and sbe repositories (if not found), '
+                        'then checks out branchs and builds them. Note: Requires '
+                        ' --ekb and --sbe, or --build_workdir')
+    parser.add_argument('--nobranchchange', action='store_true',
+                        help="Don't change the branch when building")
+    parser.add_argument('--update', action='store_true',
+                        help='After changing to specified branch, '
+                        'update it from the server as well')
+    parser.add_argument('--devready', action='store_true',
+                        help='Apply dev-ready ekb and sbe commits on top of branch')
+    parser.add_argument('--devreadyekb', action='store_true',
+                        help='Apply dev-ready ekb commits on top of branch')
+    parser.add_argument('--devreadysbe', action='store_true',
+                        help='Apply dev-ready sbe commits on top of branch')
+    parser.add_argument('--ekb',default=None,
+                        help='Base path of the ekb git repository.'
+                        ' Use --ekb_images instead for pre-built images')
+    parser.add_argument('--ekb_images',default=None,
+                        help='Image directory of pre-built ekb images.')
+    parser.add_argument('--sbe',default=None,
+                        help='Base path of sbe repository or sbe images. Default: use value '
+                        'in configfile')
+    parser.add_argument('--ovrd',default=None,
+                        help='Directory to look for override source files.'
+                        ' Files must have same name as those being overridden')
+    parser.add_argument('-o','--output', default='./image_output',
+                        help='output directory. default ./image_output')
+    parser.add_argument('-n','--name', action='append',
+                        help='output image filename. default: image.bin. '
+                        'Give once per config file for a batch build.')
+    parser.add_argument('--pakToolDir',default=None,
+                        help='Directory of PAK tools. '
+                        'PAK tool override. Only required if PAK tools not available in '
+                        'ekb,sbe,or sbe_tools.')
+    parser.add_argument('--sbe_test',action='store_true',
+                        help='Run sbe test cases to validate the images')
+    parser.add_argument('--build_workdir', type=str,
+                        help='Work directory for the build. '
+                        'Tool will ignore xxxxRoot configure parameter value.')
+    parser.add_argument('--buildGoldenImg', type=int, metavar="SIDE_COUNT",
+                        help='Use to build golden image with the side count '
+                             'instead of the configured frozen golden image.'
+                             'The golden image will be used for the given sides.')
+    parser.add_argument('--allowToSign', action='store_true',
+                        help='Use to allow the signing process for the frozen '
+                             'configured image_sections.')
+    parser.add_argument('--no_downloads', action='store_true',
+                        help='Disable downloading any repositories/binaries etc.')
+    parser.add_argument('--disable_arch_nor_img', action='store_true',
+                        help='disable nor image copy into debug archive')
+    parser.add_argument('--merge_engine', choices=['paktool','builtin'], default='paktool',
+                        help='Merge section archives with paktool, or in process with pakcore. '
+                        'default: paktool')
+    parser.add_argument('--merge_check', action='store_true',
+                        help='With --merge_engine builtin, also merge with paktool and fail '
+                        'if the results differ')
+    parser.add_argument('--ecc_engine', choices=['tool','builtin'], default='tool',
+                        help='Generate the ECC image with the ecc tool from sbe_tools, or '
+                        'with the builtin engine using all cpus. default: tool')
+    parser.add_argument('--assemble_engine', choices=['flashbuild','builtin'], default='flashbuild',
+                        help='Assemble the image with flashbuild build-image, or in process, '
+                        'writing all concat copies in one pass. part.tbl is compiled by flashbuild '
+                        'either way. Use --assemble_check to compare builtin with flashbuild. '
+                        'default: flashbuild')
+    parser.add_argument('--assemble_check', action='store_true',
+                        help='With --assemble_engine builtin, also build the image with flashbuild '
+                        'and fail if the results differ')
+    parser.add_argument('--sign_reserve', type=lambda x: int(x,0), default=0x4000, metavar='BYTES',
+                        help='Space reserved in signed sections for the signature entries when '
+                        'checking the section sizes before signing. default: 0x4000')
+    parser.add_argument('--size_report', action='store_true',
+                        help='Print the size of every entry of each section with the section '
+                        'size check')
+    parser.add_argument('--verify', action='store_true',
+                        help='Verify the finished image: the partitions against their '
+                        'section archives and the concat copies, the hash lists, the partition '
+                        'table, the golden image and the ECC image. Uses all cpus unless -j is given.')
+    parser.add_argument('-j','--jobs', type=int, default=1,
+                        help='Number of image sections to merge and hash in parallel. default: 1')
+    parser.add_argument('--hash_jobs', type=int, default=1,
+                        help='Number of threads hashing the entries of a section for its '
+                        'hash list. default: 1')
+    parser.add_argument('--cache_dir', default=None,
+                        help='Directory for the persistent build cache. Image sections whose '
+                        'inputs, settings and tools are unchanged are reused from this cache '
+                        'instead of being merged, signed and hashed again. The binaries '
+                        'repository branches and tags are kept here and only fetched when needed.')
+    parser.add_argument('--cache_size', type=int, default=1024, metavar="MB",
+                        help='Maximum size in MB of the section cache, and of the tar '
+                        'extraction cache. Least recently used entries are evicted. default: 1024')
+    parser.add_argument('--strict_cache', action='store_true',
+                        help='Identify cached tar file extractions by content digest instead '
+                        'of size and mtime')
+    parser.add_argument('--update_binaries', action='store_true',
+                        help='Fetch all of the binaries repository mirror in --cache_dir even if '
+                        'all requested commits are already present')
+    parser.add_argument('--sign_socket', default=None, metavar='SOCKET',
+                        help='Sign and hash sections through the signing worker listening on '
+                        'SOCKET (see signWorker.py) instead of running imageTool.py')
+    parser.add_argument('--trace', default=None, metavar='FILE',
+                        help='Record the time, cpu, I/O and memory use of each build stage '
+                        'and subprocess in FILE (Chrome trace format, open it with '
+                        'chrome://tracing or Perfetto) and print a summary table')
+    parser.add_argument('--incremental', action='store_true',
+                        help='Patch only the changed partitions of the existing image and '
+                        'ECC image in the output directory. Falls back to a full build if the '
+                        'layout of the image changed. Best used with --cache_dir.')
+    parser.add_argument('--watch', action='store_true',
+                        help='Stay resident and rebuild incrementally whenever the config file, '
+                        'the ekb and sbe images, the overrides or other inputs change. Implies '
+                        '--incremental, the cache is <output>/cache unless --cache_dir is given.')
+    parser.add_argument('--watch_delay', type=float, default=1.0, metavar='SECONDS',
+                        help='With --watch, wait until no file changed for SECONDS before '
+                        'rebuilding. default: 1.0')
+    parser.add_argument('--watch_poll', action='store_true',
+                        help='With --watch, poll the files instead of using inotify, for '
+                        'network file systems')
+    return parser
+
+def defaultOptions(**kwargs):
+    """
+    Options for ImageBuilder with the command line defaults, updated with kwargs
+    """
+    options = createParser().parse_args(['unused'])
+    options.configfile = []
+    for key, value in kwargs.items():
+        if not hasattr(options, key):
+            raise TypeError("Unknown option '%s'" % key)
+        setattr(options, key, value)
+    return options
+
+def main(argv=None):
+    args = createParser().parse_args(argv)
+
+    output    = os.path.abspath(args.output)
+    os.makedirs(output,exist_ok=True)
+
+    # process the configuration files
+    configFiles = [os.path.abspath(configFile) for configFile in args.configfile]
+    for configFile in configFiles:
+        if(not os.path.exists(configFile)):
+            print("The given config file: '%s', does not exist!" % configFile, file=sys.stderr)
             sys.exit(1)
 
-    os.chdir(cwd)
+    names = args.name
+    if not names:
+        names = ['image.bin']
+    if len(names) == 1:
+        names = names * len(configFiles)
+    if len(names) != len(configFiles):
+        print("ERROR Needs one --name per config file, or a single --name for all")
+        sys.exit(1)
+    if len(set(os.path.basename(configFile) for configFile in configFiles)) != len(configFiles):
+        print("ERROR Config files of a batch build need different file names")
+        sys.exit(1)
+
+    # A batch build shares the binaries, sbe tools and repository builds between
+    # images. Sections that are identical between images are only built once, by
+    # way of the section cache.
+    if len(configFiles) > 1 and not args.cache_dir:
+        args.cache_dir = os.path.join(output,'cache')
+
+    # Watch mode rebuilds with the same builder. Changed sections are built
+    # again, the others come from the section cache, and only the changed
+    # partitions of the image and ECC image are rewritten.
+    if args.watch:
+        args.incremental = True
+        if not args.cache_dir:
+            args.cache_dir = os.path.join(output,'cache')
+
+    builder = ImageBuilder(args)
+
+    while True:
+        watchFiles = set(configFiles)
+        watchTrees = set()
+        if args.watch:
+            import fileWatch
+            snapshot = fileWatch.Snapshot()
+        for configFile, name in zip(configFiles, names):
+            imageOutput = output
+            if len(configFiles) > 1:
+                # Each image gets its own output directory named after its config file
+                imageOutput = os.path.join(output, os.path.basename(configFile))
+                os.makedirs(imageOutput,exist_ok=True)
+                print(f"INFO: Building {name} from {configFile} in {imageOutput}")
+            if not args.watch:
+                builder.build(configFile, imageOutput, name)
+                continue
+            try:
+                builder.build(configFile, imageOutput, name)
+            except SystemExit as e:
+                print(f"ERROR: Build of {name} from {configFile} failed ({e.code}), "
+                      "rebuilding on the next change")
+            (files, trees) = builder.watchPaths()
+            watchFiles |= files
+            watchTrees |= trees
+            snapshot.update(builder.watchSnapshot)
+        if not args.watch:
+            break
+
+        watcher = fileWatch.Watcher(watchFiles, watchTrees, poll=args.watch_poll, snapshot=snapshot)
+        print("INFO: Watching %d files and %d directories for changes, Ctrl-C to stop" %
+              (len(watchFiles), len(watchTrees)), flush=True)
+        try:
+            changed = watcher.wait(args.watch_delay)
+        except KeyboardInterrupt:
+            print("INFO: Stopped watching")
+            break
+        finally:
+            watcher.close()
+        for path in changed[:10]:
+            print(f"INFO: Changed {path}")
+        if len(changed) > 10:
+            print(f"INFO: ... and {len(changed) - 10} more")
+
+if __name__ == '__main__':
+    main()
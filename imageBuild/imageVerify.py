@@ -0,0 +1,139 @@
+"""
+Verification of a built image against the build's partitions and sections.
+
+The image is memory mapped and the partitions are checked in parallel, each
+one read once:
+ - the partition holds its section archive, padded with zeros
+ - every other concat copy of the partition is identical to the first one
+ - the section archive loads as a pak archive
+ - its hash list matches the hashes of the entries it was made from
+ - the image hash entry is present. Its value isn't checked, only
+   imageTool.py computes it.
+ - a part.tbl entry is the partition table compiled from the partitions
+   of the image
+ - 'files' entries hold the content they were generated from
+The golden image tail and the ECC image (checked word by word against the
+image by eccEngine) are verified at the same time.
+"""
+import os
+import mmap
+import concurrent.futures
+
+import eccEngine
+
+class Section:
+    def __init__(self, name, size, archive, hashList=None, imageHash=None, files=()):
+        self.name = name
+        self.size = size
+        self.archive = archive
+        self.hashList = hashList
+        self.imageHash = imageHash
+        self.files = files
+
+def _checkPartition(pak, image, section, offset, singleSize, copies, partTable):
+    errors = []
+    with open(section.archive, 'rb') as f:
+        data = f.read()
+    region = image[offset:offset+section.size]
+    if len(data) > section.size:
+        return ["%s: archive is larger than its partition" % section.name]
+    if region[:len(data)] != data:
+        errors.append("%s: partition doesn't hold %s" % (section.name, section.archive))
+    padding = region[len(data):]
+    if padding.count(0) != len(padding):
+        errors.append("%s: partition padding is not zero" % section.name)
+    for copy in range(1, copies):
+        copyOffset = copy * singleSize + offset
+        if image[copyOffset:copyOffset+section.size] != region:
+            errors.append("%s: copy %d differs from the first copy" % (section.name, copy))
+
+    archive = pak.Archive(section.archive)
+    try:
+        archive.load()
+    except Exception as e:
+        errors.append("%s: not a valid pak archive: %s" % (section.name, e))
+        return errors
+    entries = list(archive)
+    names = [entry.name for entry in entries]
+
+    if section.hashList:
+        if section.hashList not in names:
+            errors.append("%s: %s missing" % (section.name, section.hashList))
+        else:
+            # The hash list was made of the entries before it
+            hashed = pak.Archive()
+            for entry in entries[:names.index(section.hashList)]:
+                hashed.append(entry)
+                entry.hash()
+            if hashed.createHashList() != bytes(archive.extract(section.hashList)):
+                errors.append("%s: %s doesn't match the entries" % (section.name, section.hashList))
+
+    if section.imageHash and not any(name == section.imageHash or
+                                     name.endswith('/' + section.imageHash) for name in names):
+        errors.append("%s: %s missing" % (section.name, section.imageHash))
+
+    files = list(section.files)
+    if partTable and 'part.tbl' in names:
+        files.append(('part.tbl', partTable))
+    for (entryName, path) in files:
+        if not os.path.exists(path):
+            continue
+        with open(path, 'rb') as f:
+            content = f.read()
+        if entryName not in names or bytes(archive.extract(entryName)) != content:
+            errors.append("%s: %s doesn't match %s" % (section.name, entryName, path))
+    return errors
+
+def _checkTail(image, offset, tailPath):
+    with open(tailPath, 'rb') as f:
+        tail = f.read()
+    if image[offset:] != tail:
+        return ["golden image tail doesn't match %s" % tailPath]
+    return []
+
+def _checkEcc(eccPath, imagePath, jobs):
+    try:
+        bad = eccEngine.verify(eccPath, jobs, dataPath=imagePath)
+    except (OSError, ValueError) as e:
+        return ["ECC image: %s" % e]
+    errors = ["ECC image: word at offset 0x%x doesn't match" % offset for offset in bad[:16]]
+    if len(bad) > 16:
+        errors.append("ECC image: %d words don't match" % len(bad))
+    return errors
+
+def verify(pak, imagePath, sections, copies=1, tailPath=None, eccPath=None, partTable=None,
+           jobs=None):
+    """
+    Verify imagePath, made of copies of the sections (list of Section in
+    partition order) followed by tailPath, and its ECC image eccPath.
+    partTable is the partition table compiled from the partitions of the
+    image, the part.tbl entries must match it.
+    Returns the list of errors found.
+    """
+    singleSize = sum(section.size for section in sections)
+    tailSize = os.path.getsize(tailPath) if tailPath else 0
+    imageSize = os.path.getsize(imagePath)
+    if imageSize != singleSize * copies + tailSize:
+        return ["image size %d doesn't match the partitions: %d copies of %d bytes + %d" %
+                (imageSize, copies, singleSize, tailSize)]
+    if not imageSize:
+        return []
+
+    jobs = jobs or os.cpu_count() or 1
+    errors = []
+    with open(imagePath, 'rb') as f, \
+         mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as image, \
+         concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = []
+        if eccPath:
+            futures.append(pool.submit(_checkEcc, eccPath, imagePath, jobs))
+        offset = 0
+        for section in sections:
+            futures.append(pool.submit(_checkPartition, pak, image, section, offset,
+                                       singleSize, copies, partTable))
+            offset += section.size
+        if tailPath:
+            futures.append(pool.submit(_checkTail, image, singleSize * copies, tailPath))
+        for future in futures:
+            errors.extend(future.result())
+    return errors
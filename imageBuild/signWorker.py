@@ -0,0 +1,401 @@
+#!/usr/bin/env python3
+"""
+Signing worker shared by imageBuild.py runs.
+
+The worker listens on a Unix socket for signPak and pakHash jobs, each one
+the sections of one build, and runs them with imageTool.py on behalf of the
+builds, keeping the tool warm between jobs.
+
+For each imageTool.py and pak tools directory the worker starts a zygote: a
+single threaded python process that has compiled imageTool.py and imported
+the pak tools (pakcore, output) and every module imageTool.py imports. A job
+is run in a child forked from the zygote, which sets the signing environment
+of the job, redirects its output and runs imageTool.py as __main__, so the
+interpreter startup and the imports are paid once per worker instead of once
+per job. A zygote is replaced when imageTool.py or the pak tools change. The
+programs imageTool.py runs itself (openssl, signing scripts) still start for
+every job.
+
+Jobs waiting at the same time are run as a single imageTool.py invocation
+with all their --pakFiles when they use the same command, imageTool.py, pak
+tools and signing environment, and their section names differ. imageTool.py
+takes each section name once and names the entries it adds after the
+section, so sections can't be renamed apart: builds of the same config (the
+same section names) never share an invocation. Invocations run
+concurrently, up to --jobs at a time.
+
+A job fails with the return code of the invocation it was batched into, all
+its sections get that result.
+
+Protocol: the client sends one JSON line
+  {"command": "signPak"|"pakHash", "tool": ..., "pakToolDir": ...,
+   "env": {...}, "pakFiles": {section: path}}
+and gets one JSON line back
+  {"rc": int, "output": str, "sections": {section: rc}}
+"""
+import os
+import sys
+import ast
+import json
+import time
+import queue
+import select
+import signal
+import socket
+import argparse
+import builtins
+import importlib
+import tempfile
+import threading
+import traceback
+import concurrent.futures
+import subprocess
+import socketserver
+
+# Environment of the signing tools, sent with every job
+SIGNING_ENV = ('HOST_DIR','OPBUILD_HOST_DIR','SIGNING_BASE_DIR','SIGNING_RHEL_PATH','OPEN_SSL_PATH')
+
+# Pak tools modules, imported by the zygote
+PAK_MODULES = ('pakcore.py', 'output.py')
+
+class Job:
+    def __init__(self, request):
+        self.command = request['command']
+        self.tool = request['tool']
+        self.pakToolDir = request['pakToolDir']
+        self.env = request.get('env', {})
+        self.pakFiles = request['pakFiles']
+        self.done = threading.Event()
+        self.result = None
+
+    def key(self):
+        return (self.command, self.tool, self.pakToolDir, tuple(sorted(self.env.items())))
+
+def makeBatches(jobs):
+    """
+    Group jobs into batches of the same key with unique section names, in
+    arrival order
+    """
+    batches = []
+    for job in jobs:
+        for batch in batches:
+            if batch[0].key() == job.key() and \
+               not any(name in other.pakFiles for other in batch for name in job.pakFiles):
+                batch.append(job)
+                break
+        else:
+            batches.append([job])
+    return batches
+
+def toolStamp(tool, pakToolDir):
+    # Size and mtime of imageTool.py and the pak tools modules
+    stamps = []
+    for path in [tool] + [os.path.join(pakToolDir, 'pymod', name) for name in PAK_MODULES]:
+        try:
+            st = os.stat(path)
+            stamps.append((st.st_size, st.st_mtime_ns))
+        except OSError:
+            stamps.append(None)
+    return tuple(stamps)
+
+class Zygote:
+    """
+    The worker side of a zygote process: sends it jobs and waits for their
+    results
+    """
+    def __init__(self, tool, pakToolDir):
+        self.stamp = toolStamp(tool, pakToolDir)
+        self.proc = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--zygote',
+                                      tool, pakToolDir],
+                                     stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.nextId = 0
+        self.exited = False
+        threading.Thread(target=self.reader, daemon=True).start()
+
+    def reader(self):
+        for line in self.proc.stdout:
+            response = json.loads(line)
+            with self.lock:
+                result = self.pending.pop(response['id'])
+            result.update(rc=response['rc'], output=response['output'])
+            result['done'].set()
+        self.proc.wait()
+        with self.lock:
+            self.exited = True
+            for result in self.pending.values():
+                result.update(rc=1, output="signing zygote exited with rc %d\n" %
+                              self.proc.returncode)
+                result['done'].set()
+            self.pending.clear()
+
+    def run(self, argv, env):
+        """
+        Run imageTool.py with argv and env added to the environment. Returns
+        (rc, output).
+        """
+        result = {'done': threading.Event()}
+        with self.lock:
+            if self.exited:
+                return (1, "signing zygote exited with rc %d\n" % self.proc.returncode)
+            jobId = self.nextId
+            self.nextId += 1
+            self.pending[jobId] = result
+            try:
+                self.proc.stdin.write((json.dumps({'id': jobId, 'argv': argv, 'env': env}) +
+                                       "\n").encode())
+                self.proc.stdin.flush()
+            except OSError as e:
+                del self.pending[jobId]
+                return (1, "signing zygote: %s\n" % e)
+        result['done'].wait()
+        return (result['rc'], result['output'])
+
+    def close(self):
+        # The zygote exits once its running jobs are done
+        with self.lock:
+            try:
+                self.proc.stdin.close()
+            except OSError:
+                pass
+
+class SignWorker(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socketPath, window, jobs):
+        self.jobs = queue.Queue()
+        self.window = window
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=jobs)
+        self.zygotes = {}
+        self.zygotesLock = threading.Lock()
+        super().__init__(socketPath, JobHandler)
+        threading.Thread(target=self.batcher, daemon=True).start()
+
+    def batcher(self):
+        while True:
+            jobs = [self.jobs.get()]
+            # Wait for the jobs of other builds, if asked to
+            deadline = time.monotonic() + self.window
+            while True:
+                try:
+                    jobs.append(self.jobs.get(timeout=max(0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            for batch in makeBatches(jobs):
+                self.pool.submit(self.runBatch, batch)
+
+    def zygote(self, tool, pakToolDir):
+        """
+        The zygote of tool and pakToolDir, a new one if they changed since it
+        was started
+        """
+        with self.zygotesLock:
+            zygote = self.zygotes.get((tool, pakToolDir))
+            if zygote and (zygote.exited or zygote.stamp != toolStamp(tool, pakToolDir)):
+                zygote.close()
+                zygote = None
+            if not zygote:
+                zygote = Zygote(tool, pakToolDir)
+                self.zygotes[(tool, pakToolDir)] = zygote
+            return zygote
+
+    def runBatch(self, batch):
+        job = batch[0]
+        pakFiles = ["%s=%s" % (name, path) for other in batch for (name, path) in other.pakFiles.items()]
+        argv = [job.tool, "--pakToolDir", job.pakToolDir, job.command, "--pakFiles"] + pakFiles
+        try:
+            (rc, output) = self.zygote(job.tool, job.pakToolDir).run(argv, job.env)
+        except OSError as e:
+            (rc, output) = (1, "%s: %s\n" % (job.tool, e))
+        print("INFO: %s of %d section(s) from %d job(s), rc %d" %
+              (job.command, len(pakFiles), len(batch), rc), flush=True)
+        for other in batch:
+            other.result = {'rc': rc, 'output': output,
+                            'sections': {name: rc for name in other.pakFiles}}
+            other.done.set()
+
+    def server_close(self):
+        super().server_close()
+        with self.zygotesLock:
+            for zygote in self.zygotes.values():
+                zygote.close()
+            self.zygotes = {}
+
+class JobHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        try:
+            job = Job(json.loads(self.rfile.readline()))
+        except (ValueError, KeyError, TypeError) as e:
+            result = {'rc': 1, 'output': "invalid request: %s\n" % e, 'sections': {}}
+        else:
+            self.server.jobs.put(job)
+            job.done.wait()
+            result = job.result
+        self.wfile.write((json.dumps(result) + "\n").encode())
+
+def request(socketPath, command, tool, pakToolDir, pakFiles):
+    """
+    Run command on pakFiles {section: path} through the worker at socketPath.
+    Returns the result of the worker. Raises OSError if the worker can't be
+    reached.
+    """
+    job = {'command'    : command,
+           'tool'       : os.path.abspath(tool),
+           'pakToolDir' : os.path.abspath(pakToolDir),
+           'env'        : {var: os.environ[var] for var in SIGNING_ENV if var in os.environ},
+           'pakFiles'   : {name: os.path.abspath(path) for (name, path) in pakFiles.items()}}
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socketPath)
+        sock.sendall((json.dumps(job) + "\n").encode())
+        with sock.makefile('rb') as f:
+            response = f.readline()
+    if not response:
+        raise OSError("no response from signing worker %s" % socketPath)
+    return json.loads(response)
+
+#------------------------------------------------------------------------------
+# Zygote process
+#------------------------------------------------------------------------------
+def preload(tool, pakToolDir):
+    """
+    Import the pak tools and the modules imported by tool
+    """
+    sys.path[0] = os.path.dirname(tool)
+    sys.path.append(os.path.join(pakToolDir, 'pymod'))
+    with open(tool) as f:
+        tree = ast.parse(f.read(), tool)
+    names = [os.path.splitext(name)[0] for name in PAK_MODULES]
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            names += [alias.name for alias in node.names]
+        elif isinstance(node, ast.ImportFrom) and node.level == 0 and node.module:
+            names.append(node.module)
+    for name in names:
+        try:
+            importlib.import_module(name)
+        except Exception:
+            # Left to the job, which imports it the way the tool does
+            pass
+
+def runChild(code, job, outFd, fds):
+    for fd in fds:
+        os.close(fd)
+    os.dup2(outFd, 1)
+    os.dup2(outFd, 2)
+    os.close(outFd)
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    os.environ.update(job['env'])
+    sys.argv = job['argv']
+    rc = 0
+    try:
+        exec(code, {'__name__': '__main__', '__file__': job['argv'][0], '__builtins__': builtins})
+    except SystemExit as e:
+        if isinstance(e.code, int):
+            rc = e.code
+        elif e.code is not None:
+            print(e.code, file=sys.stderr)
+            rc = 1
+    except BaseException:
+        traceback.print_exc()
+        rc = 1
+    try:
+        sys.stdout.flush()
+        sys.stderr.flush()
+    finally:
+        os._exit(rc & 0xff)
+
+def zygoteMain(tool, pakToolDir):
+    # Requests and responses on private descriptors, anything the tool
+    # prints goes to the worker's stderr
+    requestFd = os.dup(0)
+    responseFd = os.dup(1)
+    devNull = os.open(os.devnull, os.O_RDONLY)
+    os.dup2(devNull, 0)
+    os.close(devNull)
+    os.dup2(2, 1)
+    # Stopped by the worker closing the requests
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    preload(tool, pakToolDir)
+    with open(tool) as f:
+        code = compile(f.read(), tool, 'exec')
+
+    children = {}   # exit pipe -> (job id, pid, output file)
+    buf = b''
+    eof = False
+    while not eof or children:
+        readable = list(children) + ([] if eof else [requestFd])
+        (ready, _, _) = select.select(readable, [], [])
+        for fd in ready:
+            if fd == requestFd:
+                data = os.read(requestFd, 64*1024)
+                if not data:
+                    eof = True
+                    continue
+                buf += data
+                while b'\n' in buf:
+                    (line, buf) = buf.split(b'\n', 1)
+                    job = json.loads(line)
+                    output = tempfile.TemporaryFile()
+                    (exitRead, exitWrite) = os.pipe()
+                    sys.stdout.flush()
+                    sys.stderr.flush()
+                    pid = os.fork()
+                    if pid == 0:
+                        # exitWrite stays open until the child is gone
+                        runChild(code, job, output.fileno(),
+                                 [requestFd, responseFd, exitRead] + list(children))
+                    os.close(exitWrite)
+                    children[exitRead] = (job['id'], pid, output)
+            else:
+                os.read(fd, 1)
+                os.close(fd)
+                (jobId, pid, output) = children.pop(fd)
+                (_, status) = os.waitpid(pid, 0)
+                rc = os.waitstatus_to_exitcode(status)
+                if rc < 0:
+                    # Killed by a signal, as the shell reports it
+                    rc = 128 - rc
+                output.seek(0)
+                response = {'id': jobId, 'rc': rc,
+                            'output': output.read().decode(errors='replace')}
+                output.close()
+                os.write(responseFd, (json.dumps(response) + "\n").encode())
+
+if __name__ == '__main__':
+    if len(sys.argv) == 4 and sys.argv[1] == '--zygote':
+        zygoteMain(sys.argv[2], sys.argv[3])
+        sys.exit(0)
+
+    parser = argparse.ArgumentParser(description="Signing worker running the signPak and "
+                                     "pakHash jobs of imageBuild.py --sign_socket")
+    parser.add_argument('--socket', required=True, help='Path of the Unix socket to listen on')
+    parser.add_argument('--window', type=float, default=0.0,
+                        help='Seconds to wait for more jobs before running a batch. Only builds '
+                        'with different section names can share a batch. default: 0')
+    parser.add_argument('-j','--jobs', type=int, default=os.cpu_count() or 1,
+                        help='Number of imageTool.py invocations run at the same time. '
+                        'default: number of cpus')
+    args = parser.parse_args()
+
+    if os.path.exists(args.socket):
+        # Left over by a worker that didn't exit cleanly
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            if sock.connect_ex(args.socket) == 0:
+                print("ERROR: a worker is already listening on %s" % args.socket, file=sys.stderr)
+                sys.exit(1)
+        os.remove(args.socket)
+
+    # Only the user running the worker may connect
+    os.umask(0o077)
+    server = SignWorker(args.socket, args.window, args.jobs)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    print("INFO: signing worker listening on %s" % args.socket, flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(args.socket)
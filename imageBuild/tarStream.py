@@ -0,0 +1,128 @@
+"""
+Streaming tar rewrite with parallel gzip compression.
+
+rewriteTar() copies the members of a tar file from its input stream into a
+new tar file and appends new members, nothing is extracted to disk.
+
+GzipWriter compresses like 'pigz -i': the data is cut into blocks that are
+deflated independently on a thread pool (zlib releases the GIL). Every block
+but the last ends with a sync flush, so the blocks simply concatenate into a
+single deflate stream. The last block ends with Z_FINISH. The output is a
+normal single member gzip file. The CRC of the uncompressed data is computed
+in order, as the blocks are handed out.
+"""
+import io
+import os
+import time
+import zlib
+import struct
+import tarfile
+import collections
+import concurrent.futures
+
+BLOCK_SIZE = 512*1024
+
+def _deflateBlock(data, level, last):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(data) + \
+        compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+class GzipWriter:
+    """
+    Write-only file object gzip compressing into fileobj with jobs threads.
+    The gzip header has no file name and a zero mtime, so the output only
+    depends on the data.
+    """
+    def __init__(self, fileobj, level=9, jobs=None, blockSize=BLOCK_SIZE):
+        self.fileobj = fileobj
+        self.level = level
+        self.blockSize = blockSize
+        self.jobs = jobs or os.cpu_count() or 1
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.jobs)
+        self.pending = collections.deque()
+        self.buffer = bytearray()
+        self.crc = 0
+        self.size = 0
+
+        # magic, deflate, no flags, no mtime, extra flags, OS unix
+        extraFlags = 2 if level == 9 else 4 if level == 1 else 0
+        fileobj.write(struct.pack('<BBBBIBB', 0x1f, 0x8b, 8, 0, 0, extraFlags, 3))
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) > self.blockSize:
+            block = bytes(self.buffer[:self.blockSize])
+            del self.buffer[:self.blockSize]
+            self._submit(block, False)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def _submit(self, block, last):
+        self.crc = zlib.crc32(block, self.crc)
+        self.size += len(block)
+        self.pending.append(self.pool.submit(_deflateBlock, block, self.level, last))
+        # Bound the memory held by blocks waiting to be written
+        while len(self.pending) > 2 * self.jobs:
+            self.fileobj.write(self.pending.popleft().result())
+
+    def close(self):
+        if self.pool is None:
+            return
+        self._submit(bytes(self.buffer), True)
+        self.buffer = bytearray()
+        while self.pending:
+            self.fileobj.write(self.pending.popleft().result())
+        self.fileobj.write(struct.pack('<II', self.crc, self.size & 0xffffffff))
+        self.pool.shutdown()
+        self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        if excType is None:
+            self.close()
+        elif self.pool is not None:
+            self.pool.shutdown(cancel_futures=True)
+            self.pool = None
+
+def rewriteTar(tarPath, addFiles, level=9, jobs=None):
+    """
+    Rewrite tarPath, a tar file in any compression tarfile reads, as a gzip
+    compressed tar file with the members of addFiles appended. addFiles is a
+    list of (arcname, content) where content is a file path or bytes. Members
+    of the input with the same name are dropped. tarPath is only replaced
+    once the new file is complete.
+    """
+    names = set(os.path.normpath(arcname) for (arcname, _) in addFiles)
+    tmpPath = "%s.%d.tmp" % (tarPath, os.getpid())
+    try:
+        with tarfile.open(tarPath, 'r|*') as src, open(tmpPath, 'wb') as f, \
+             GzipWriter(f, level, jobs) as gz, \
+             tarfile.open(fileobj=gz, mode='w|', copybufsize=1024*1024) as dst:
+            for member in src:
+                if os.path.normpath(member.name) in names:
+                    continue
+                if member.isreg():
+                    dst.addfile(member, src.extractfile(member))
+                else:
+                    dst.addfile(member)
+
+            for (arcname, content) in addFiles:
+                if isinstance(content, (bytes, bytearray)):
+                    info = tarfile.TarInfo(arcname)
+                    info.size = len(content)
+                    info.mtime = int(time.time())
+                    info.mode = 0o644
+                    dst.addfile(info, io.BytesIO(content))
+                else:
+                    info = dst.gettarinfo(content, arcname)
+                    with open(content, 'rb') as contentFile:
+                        dst.addfile(info, contentFile)
+        os.replace(tmpPath, tarPath)
+    except BaseException:
+        if os.path.exists(tmpPath):
+            os.remove(tmpPath)
+        raise
@@ -0,0 +1,177 @@
+"""
+Tasks and build stages run concurrently on threads.
+
+Everything a task prints, and the output of the commands it runs, goes to
+its log file and is echoed on stdout prefixed with the task name. A task
+fails by calling sys.exit() or raising, which cancels the other tasks: their
+running commands are killed and their next run() exits.
+
+runStages() runs build stages, each once the stages it needs are done.
+"""
+import os
+import signal
+import threading
+import traceback
+import subprocess
+import concurrent.futures
+
+import buildTrace
+
+_echoLock = threading.Lock()
+
+class Cancelled(Exception):
+    pass
+
+class TaskLog:
+    def __init__(self, name, logPath, cancel=None):
+        self.name = name
+        self.logPath = logPath
+        self.cancel = cancel or threading.Event()
+        os.makedirs(os.path.dirname(logPath), exist_ok=True)
+        self.logFile = open(logPath, 'w')
+
+    def write(self, line):
+        line = line.rstrip('\n')
+        with _echoLock:
+            self.logFile.write(line + '\n')
+            self.logFile.flush()
+            print("[%s] %s" % (self.name, line), flush=True)
+
+    def print(self, *args, file=None):
+        for line in " ".join(str(arg) for arg in args).split('\n'):
+            self.write(line)
+
+    def _pump(self, pipe, lines):
+        for line in pipe:
+            self.write(line)
+            if lines is not None:
+                lines.append(line)
+        pipe.close()
+
+    def run(self, args, name=None, input=None, cwd=None, shell=False, capture=False):
+        """
+        Run a command, logging its output. Returns (returncode, stdout, stderr),
+        stdout and stderr are only kept with capture. The command is killed if
+        the task is cancelled.
+        """
+        if self.cancel.is_set():
+            raise Cancelled()
+        (outLines, errLines) = ([], []) if capture else (None, None)
+        proc = buildTrace.Popen(args, name=name, cwd=cwd, shell=shell,
+                                stdin=subprocess.PIPE if input is not None else subprocess.DEVNULL,
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                universal_newlines=True, errors='replace',
+                                start_new_session=True)
+        pumps = [threading.Thread(target=self._pump, args=(proc.stdout, outLines)),
+                 threading.Thread(target=self._pump, args=(proc.stderr, errLines))]
+        for pump in pumps:
+            pump.start()
+        if input is not None:
+            try:
+                proc.stdin.write(input)
+                proc.stdin.close()
+            except BrokenPipeError:
+                pass
+
+        cancelled = False
+        while True:
+            try:
+                proc.wait(timeout=0.2)
+                break
+            except subprocess.TimeoutExpired:
+                if self.cancel.is_set() and not cancelled:
+                    # Kill the whole process group, workon shells start children
+                    cancelled = True
+                    try:
+                        os.killpg(proc.pid, signal.SIGTERM)
+                    except ProcessLookupError:
+                        pass
+        for pump in pumps:
+            pump.join()
+        if cancelled:
+            raise Cancelled()
+        if capture:
+            return (proc.returncode, "".join(outLines), "".join(errLines))
+        return (proc.returncode, None, None)
+
+    def close(self):
+        self.logFile.close()
+
+def runThreads(tasks):
+    """
+    Run tasks, a list of (TaskLog, function, args), each on its own thread as
+    function(log, *args). When a task fails the others are cancelled. Returns
+    the failed tasks as (TaskLog, exit code), the first failure first.
+    """
+    cancel = threading.Event()
+    failures = []
+
+    def runTask(log, function, args):
+        try:
+            function(log, *args)
+        except Cancelled:
+            log.print("cancelled")
+        except SystemExit as e:
+            code = e.code if isinstance(e.code, int) else 1
+            if code:
+                failures.append((log, code))
+                cancel.set()
+        except BaseException:
+            log.print(traceback.format_exc())
+            failures.append((log, 1))
+            cancel.set()
+        finally:
+            log.close()
+
+    threads = []
+    for (log, function, args) in tasks:
+        log.cancel = cancel
+        thread = threading.Thread(target=runTask, args=(log, function, args), name=log.name)
+        thread.start()
+        threads.append(thread)
+    try:
+        for thread in threads:
+            thread.join()
+    except KeyboardInterrupt:
+        cancel.set()
+        for thread in threads:
+            thread.join()
+        raise
+    return failures
+
+def runStages(stages):
+    """
+    Run stages, a list of (name, function, names of the stages it needs), on
+    threads, each one as soon as the stages it needs are done. No stage is
+    started after a failure. Once the running stages are done the first
+    failure is raised again, so a stage calling sys.exit(rc) exits with rc.
+    """
+    done = set()
+    waiting = list(stages)
+    running = {}
+    failure = None
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(len(stages),1)) as pool:
+        while waiting or running:
+            if failure is None:
+                for stage in list(waiting):
+                    (name, function, needs) = stage
+                    if all(need in done for need in needs):
+                        waiting.remove(stage)
+                        running[pool.submit(function)] = name
+            if not running:
+                break
+            (finished, _) = concurrent.futures.wait(running,
+                                return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                if future.exception() is not None:
+                    if failure is None:
+                        failure = future.exception()
+                else:
+                    done.add(name)
+
+    if failure is not None:
+        raise failure
+    if waiting:
+        raise ValueError("stages %s need stages that don't exist" %
+                         ", ".join(name for (name,_,_) in waiting))
@@ -0,0 +1,142 @@
+"""
+downloadBinaries() against a local file:// binaries repository, for the
+legacy 'repository' config and the structured 'url' config, with and
+without --cache_dir.
+"""
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import imageBuild
+
+def git(*args, cwd=None):
+    cmd = ["git","-c","user.name=test","-c","user.email=test@example.com",
+           "-c","init.defaultBranch=main"] + list(args)
+    return subprocess.run(cmd, cwd=cwd, check=True, stdout=subprocess.PIPE,
+                          stderr=subprocess.DEVNULL).stdout.decode().strip()
+
+class BinariesTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        work = os.path.join(self.tmp, 'work')
+        os.makedirs(os.path.join(work, 'd'))
+        git("init", "-q", work)
+        self.commits = {}
+        for version in ('v1', 'v2'):
+            self.write(work, 'd/a.bin', version)
+            self.write(work, 'b.bin', version)
+            git("add", "-A", cwd=work)
+            git("commit", "-q", "-m", version, cwd=work)
+            self.commits[version] = git("rev-parse", "HEAD", cwd=work)
+        git("tag", "t1", self.commits['v1'], cwd=work)
+        git("checkout", "-q", "-b", "other", self.commits['v1'], cwd=work)
+        self.write(work, 'd/a.bin', 'other')
+        git("commit", "-q", "-am", "other", cwd=work)
+        git("checkout", "-q", "main", cwd=work)
+        self.work = work
+
+        # A pull request: a commit only reachable from refs/pull
+        git("checkout", "-q", "-b", "pr", self.commits['v2'], cwd=work)
+        self.write(work, 'd/a.bin', 'pr')
+        git("commit", "-q", "-am", "pr", cwd=work)
+        self.commits['pr'] = git("rev-parse", "HEAD", cwd=work)
+        git("checkout", "-q", "main", cwd=work)
+
+        self.remote = os.path.join(self.tmp, 'remote.git')
+        git("clone", "-q", "--bare", work, self.remote)
+        git("update-ref", "refs/pull/1/head", self.commits['pr'], cwd=self.remote)
+        git("branch", "-D", "pr", cwd=self.remote)
+        self.url = "file://" + self.remote
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def write(self, repo, path, content):
+        with open(os.path.join(repo, path), 'w') as f:
+            f.write(content)
+
+    def read(self, binariesDir, name):
+        with open(os.path.join(binariesDir, name)) as f:
+            return f.read()
+
+    def builder(self, structured, files, cacheDir=None):
+        options = imageBuild.defaultOptions(ovrd=self.tmp, cache_dir=cacheDir)
+        builder = imageBuild.ImageBuilder(options)
+        if structured:
+            binaries = {'url': self.url, 'branch': 'main', 'files': files}
+        else:
+            binaries = {'repository': ['git clone %s --branch main' % self.url], 'files': files}
+        builder.config = {'binaries': binaries}
+        return builder
+
+    def download(self, structured, files, cacheDir=None):
+        output = os.path.join(self.tmp, 'out')
+        os.makedirs(output, exist_ok=True)
+        cwd = os.getcwd()
+        try:
+            (binariesDir, _) = self.builder(structured, files, cacheDir).downloadBinaries(output)
+        finally:
+            os.chdir(cwd)
+        return binariesDir
+
+    def pushV3(self):
+        self.write(self.work, 'b.bin', 'v3')
+        git("commit", "-q", "-am", "v3", cwd=self.work)
+        git("push", "-q", self.remote, "main", cwd=self.work)
+
+    def checkPins(self, structured, cacheDir=None):
+        # branch, other branch, tag and commit id pins
+        binariesDir = self.download(structured, [('b.bin', ''), ('d/a.bin', 'other')], cacheDir)
+        self.assertEqual(self.read(binariesDir, 'b.bin'), 'v2')
+        self.assertEqual(self.read(binariesDir, 'a.bin'), 'other')
+        binariesDir = self.download(structured, [('d/a.bin', 't1')], cacheDir)
+        self.assertEqual(self.read(binariesDir, 'a.bin'), 'v1')
+        binariesDir = self.download(structured, [('d/a.bin', self.commits['v1'])], cacheDir)
+        self.assertEqual(self.read(binariesDir, 'a.bin'), 'v1')
+
+    def checkLatest(self, structured, cacheDir):
+        binariesDir = self.download(structured, [('b.bin', '')], cacheDir)
+        self.assertEqual(self.read(binariesDir, 'b.bin'), 'v2')
+        self.pushV3()
+        binariesDir = self.download(structured, [('b.bin', '')], cacheDir)
+        self.assertEqual(self.read(binariesDir, 'b.bin'), 'v3')
+
+    def testLegacyPins(self):
+        self.checkPins(False)
+
+    def testLegacyPinsCached(self):
+        self.checkPins(False, os.path.join(self.tmp, 'cache'))
+
+    def testStructuredPins(self):
+        self.checkPins(True)
+
+    def testStructuredPinsCached(self):
+        self.checkPins(True, os.path.join(self.tmp, 'cache'))
+
+    def testLegacyLatestCached(self):
+        self.checkLatest(False, os.path.join(self.tmp, 'cache'))
+
+    def testStructuredLatestCached(self):
+        self.checkLatest(True, os.path.join(self.tmp, 'cache'))
+
+    def testMirrorRefs(self):
+        # The mirror holds branches and tags, pull requests only when pinned
+        cacheDir = os.path.join(self.tmp, 'cache')
+        self.checkPins(False, cacheDir)
+        mirrorsDir = os.path.join(cacheDir, 'binaries')
+        (mirror,) = [d for d in os.listdir(mirrorsDir) if d.endswith('.git')]
+        refs = git("for-each-ref", "--format=%(refname)", cwd=os.path.join(mirrorsDir, mirror))
+        self.assertNotIn('refs/pull/', refs)
+        binariesDir = self.download(False, [('d/a.bin', self.commits['pr'])], cacheDir)
+        self.assertEqual(self.read(binariesDir, 'a.bin'), 'pr')
+
+    def testMissingFile(self):
+        with self.assertRaises(SystemExit):
+            self.download(False, [('d/none.bin', 'other')])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,156 @@
+"""
+eccEngine against the published P8 ECC (skiboot libflash/ecc.c): known
+answers, inject/verify/remove round trips and chunked runs.
+
+Set ECC_TOOL to the ecc tool of sbe_tools to also compare with
+'ecc --inject --p8'.
+"""
+import os
+import sys
+import random
+import shutil
+import tempfile
+import unittest
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import eccEngine
+
+ECC_TOOL = os.environ.get('ECC_TOOL')
+
+# eccgenerate() of skiboot libflash/ecc.c, one word at a time
+SKIBOOT_ECC_MATRIX = [
+    0x0000e8423c0f99ff,
+    0x00e8423c0f99ff00,
+    0xe8423c0f99ff0000,
+    0x423c0f99ff0000e8,
+    0x3c0f99ff0000e842,
+    0x0f99ff0000e8423c,
+    0x99ff0000e8423c0f,
+    0xff0000e8423c0f99,
+]
+
+def referenceEcc(word):
+    result = 0
+    for i in range(8):
+        result |= (bin(SKIBOOT_ECC_MATRIX[i] & word).count('1') & 1) << i
+    return result
+
+def referenceInject(data):
+    out = bytearray()
+    for offset in range(0, len(data), 8):
+        word = data[offset:offset+8]
+        out += word + bytes([referenceEcc(int.from_bytes(word, 'big'))])
+    return bytes(out)
+
+# Entries of the syndromematrix of skiboot libflash/ecc.c: the syndrome
+# (ECC of the data XOR the stored ECC) of a flipped data bit, bit 0 being the
+# MSB of the big endian word
+SYNDROMES = {
+    0x07: 47, 0x0b: 37, 0x0d: 35, 0x0e: 39, 0x13: 48, 0x15: 30, 0x16: 29,
+    0x19: 57, 0x1a: 27, 0x1c: 31, 0x23: 17, 0x25: 18, 0x26: 40, 0x29: 58,
+    0x2a: 22, 0x2c: 21, 0x31: 16, 0x32: 49, 0x34: 19, 0x38: 23, 0x3d: 20,
+    0x43: 51, 0x45: 46, 0x46: 9,  0x49: 34, 0x4a: 10, 0x4c: 32, 0x4f: 36,
+}
+
+# Data word, ECC byte
+VECTORS = [
+    (0x0000000000000000, 0x00),
+    (0xffffffffffffffff, 0x00),
+    (0x0123456789abcdef, 0xdd),
+    (0xfedcba9876543210, 0xdd),
+    (0x8000000000000000, 0xc4),
+    (0x0000000000000001, 0xc1),
+    (0xdeadbeefcafef00d, 0x30),
+    (0x5a5a5a5a5a5a5a5a, 0x00),
+]
+
+class EccTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.random = random.Random(8)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def data(self, size):
+        return self.random.randbytes(size)
+
+    def file(self, name, content):
+        path = os.path.join(self.tmp, name)
+        with open(path, 'wb') as f:
+            f.write(content)
+        return path
+
+    def read(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def testSyndromes(self):
+        for (syndrome, bit) in SYNDROMES.items():
+            self.assertEqual(eccEngine.generateECC(1 << (63 - bit)), syndrome, bit)
+        # ECC bit n flipped, E0 being the MSB of the ECC byte
+        for n in range(8):
+            chunk = eccEngine.injectChunk(bytes(8))
+            chunk[8] ^= 0x80 >> n
+            self.assertEqual(eccEngine.verifyChunk(chunk), [0])
+
+    def testVectors(self):
+        for (word, ecc) in VECTORS:
+            self.assertEqual(referenceEcc(word), ecc)
+            data = word.to_bytes(8, 'big')
+            self.assertEqual(bytes(eccEngine.injectChunk(data)), data + bytes([ecc]))
+
+    def testReference(self):
+        data = self.data(8 * 4096)
+        self.assertEqual(bytes(eccEngine.injectChunk(data)), referenceInject(data))
+
+    def testRoundTrip(self):
+        data = self.data(8 * 10000)
+        src = self.file('image.bin', data)
+        ecc = os.path.join(self.tmp, 'image.bin.ecc')
+        eccEngine.inject(src, ecc, jobs=1)
+        self.assertEqual(self.read(ecc), referenceInject(data))
+        self.assertEqual(eccEngine.verify(ecc, jobs=1, dataPath=src), [])
+
+        removed = os.path.join(self.tmp, 'removed.bin')
+        eccEngine.remove(ecc, removed, jobs=1)
+        self.assertEqual(self.read(removed), data)
+
+        # A flipped data bit and a flipped ECC bit, in different words
+        content = bytearray(self.read(ecc))
+        content[1234 * 9 + 3] ^= 0x10
+        content[5678 * 9 + 8] ^= 0x01
+        with open(ecc, 'wb') as f:
+            f.write(content)
+        self.assertEqual(eccEngine.verify(ecc, jobs=1), [1234 * 8, 5678 * 8])
+
+    def testChunks(self):
+        # Three chunks, the last one short
+        data = self.data(2 * eccEngine.CHUNK_SIZE + 8 * 1001)
+        src = self.file('image.bin', data)
+        results = {}
+        for jobs in (1, 3):
+            ecc = os.path.join(self.tmp, 'image.%d.ecc' % jobs)
+            eccEngine.inject(src, ecc, jobs=jobs)
+            results[jobs] = self.read(ecc)
+            self.assertEqual(eccEngine.verify(ecc, jobs=jobs, dataPath=src), [])
+            removed = os.path.join(self.tmp, 'removed.%d.bin' % jobs)
+            eccEngine.remove(ecc, removed, jobs=jobs)
+            self.assertEqual(self.read(removed), data)
+        self.assertEqual(results[1], results[3])
+        self.assertEqual(results[1][:9 * 4096], referenceInject(data[:8 * 4096]))
+        self.assertEqual(results[1][-9 * 4096:], referenceInject(data[-8 * 4096:]))
+
+    @unittest.skipUnless(ECC_TOOL, "ECC_TOOL is not set")
+    def testTool(self):
+        data = self.data(8 * 100000)
+        src = self.file('image.bin', data)
+        toolEcc = os.path.join(self.tmp, 'tool.ecc')
+        subprocess.run([ECC_TOOL, '--inject', src, '--output', toolEcc, '--p8'], check=True)
+        ecc = os.path.join(self.tmp, 'image.bin.ecc')
+        eccEngine.inject(src, ecc)
+        self.assertEqual(self.read(ecc), self.read(toolEcc))
+
+if __name__ == '__main__':
+    unittest.main()
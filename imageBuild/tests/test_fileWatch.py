@@ -0,0 +1,86 @@
+"""
+fileWatch.Watcher against a Snapshot taken before the watcher is set up, as
+a --watch build takes it when it reads its inputs.
+"""
+import os
+import sys
+import shutil
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import fileWatch
+
+class WatcherTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.config = os.path.join(self.tmp, 'config')
+        self.tree = os.path.join(self.tmp, 'images')
+        os.makedirs(self.tree)
+        self.write(self.config, 'config')
+        self.write(os.path.join(self.tree, 'a.pak'), 'a')
+        self.debugTar = os.path.join(self.tree, 'debug.tar.gz')
+        self.write(self.debugTar, 'debug')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def write(self, path, content):
+        with open(path, 'w') as f:
+            f.write(content)
+        # Changes within the mtime granularity are still seen by size
+        st = os.stat(path)
+        os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 10**6))
+
+    def snapshot(self):
+        snapshot = fileWatch.Snapshot()
+        snapshot.add([self.config], [self.tree], [self.debugTar])
+        return snapshot
+
+    def wait(self, watcher, timeout=5):
+        # wait() in a thread, None if it doesn't return within timeout
+        # (only used where a change is expected, the thread is left blocked)
+        result = []
+        thread = threading.Thread(target=lambda: result.append(watcher.wait(0.1)), daemon=True)
+        thread.start()
+        thread.join(timeout)
+        return result[0] if result else None
+
+    def checkChangedDuringBuild(self, poll):
+        snapshot = self.snapshot()
+        # Lands while the build runs, before the watcher exists
+        newPak = os.path.join(self.tree, 'b.pak')
+        self.write(newPak, 'b')
+        self.write(self.debugTar, 'debug with the new image')
+        watcher = fileWatch.Watcher([self.config], [self.tree], poll=poll, snapshot=snapshot)
+        try:
+            self.assertEqual(self.wait(watcher), [newPak])
+        finally:
+            watcher.close()
+
+    def testChangedDuringBuild(self):
+        self.checkChangedDuringBuild(False)
+
+    def testChangedDuringBuildPolled(self):
+        self.checkChangedDuringBuild(True)
+
+    def testExcluded(self):
+        watcher = fileWatch.Watcher([self.config], [self.tree], snapshot=self.snapshot())
+        try:
+            self.write(self.debugTar, 'debug with the new image')
+            self.assertEqual(watcher.changes(), [])
+            self.write(self.config, 'new config')
+            self.assertEqual(self.wait(watcher), [self.config])
+        finally:
+            watcher.close()
+
+    def testUnchanged(self):
+        watcher = fileWatch.Watcher([self.config], [self.tree], snapshot=self.snapshot())
+        try:
+            self.assertEqual(watcher.changes(), [])
+        finally:
+            watcher.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,91 @@
+"""
+Parity of --assemble_engine builtin (flashImage.assemble()) with 'flashbuild
+build-image'.
+
+Needs the real pak tools: set PAK_TOOLS_DIR to a pak tools directory (with
+flashbuild and pymod/pakcore.py), for example
+<sbe>/public/src/import/public/common/utils/imageProcs/tools. The stand-in
+flashbuild of bench/sbe_tools was written from the same layout as
+flashImage, so it doesn't prove anything here.
+"""
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import subprocess
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import imageBuild
+import flashImage
+
+PAK_TOOLS_DIR = os.environ.get('PAK_TOOLS_DIR')
+
+CONFIG = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                      'configs', 'odyssey', 'dd1', 'ody_pnor_dd1_image_config')
+
+@unittest.skipUnless(PAK_TOOLS_DIR, "PAK_TOOLS_DIR is not set")
+class AssembleParityTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        builder = imageBuild.ImageBuilder(imageBuild.defaultOptions(ovrd=self.tmp))
+        builder.loadPakTools(PAK_TOOLS_DIR)
+        self.pak = builder.pak
+        self.flashBuildTool = os.path.join(PAK_TOOLS_DIR, 'flashbuild')
+
+        # The partitions of a shipped config, in config order
+        config = imageBuild.readConfigFile(CONFIG)
+        self.partitions = [(name, info['partition_size'])
+                           for (name, info) in config['image_sections'].items()]
+        self.partitionsFile = os.path.join(self.tmp, 'partitions')
+        with open(self.partitionsFile, 'w') as f:
+            print(self.partitions, file=f)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def archives(self, fill):
+        """
+        A section archive per partition, about fill of its size
+        """
+        archives = {}
+        for (name, size) in self.partitions:
+            path = os.path.join(self.tmp, name + '.pak')
+            archive = self.pak.Archive(path)
+            archive.add(name + '/data.bin', self.pak.CM.store, os.urandom(int(size * fill)))
+            archive.save()
+            archives[name] = path
+        return archives
+
+    def flashbuild(self, archives):
+        imagePath = os.path.join(self.tmp, 'flashbuild.bin')
+        cmd = [self.flashBuildTool, 'build-image', self.partitionsFile, imagePath]
+        for (name, _) in self.partitions:
+            cmd += ['-p', '%s=%s' % (name, archives[name])]
+        subprocess.run(cmd, check=True)
+        with open(imagePath, 'rb') as f:
+            return f.read()
+
+    def assemble(self, archives, copies=1, tailPath=None):
+        imagePath = os.path.join(self.tmp, 'builtin.bin')
+        flashImage.assemble(imagePath, self.partitions, archives, copies, tailPath)
+        with open(imagePath, 'rb') as f:
+            return f.read()
+
+    def testSingle(self):
+        for fill in (0.1, 0.5):
+            archives = self.archives(fill)
+            self.assertEqual(self.assemble(archives), self.flashbuild(archives))
+
+    def testCopies(self):
+        archives = self.archives(0.3)
+        tailPath = os.path.join(self.tmp, 'golden.bin')
+        with open(tailPath, 'wb') as f:
+            f.write(os.urandom(12345))
+        with open(tailPath, 'rb') as f:
+            tail = f.read()
+        self.assertEqual(self.assemble(archives, 2, tailPath),
+                         self.flashbuild(archives) * 2 + tail)
+
+if __name__ == '__main__':
+    unittest.main()
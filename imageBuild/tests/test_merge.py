@@ -0,0 +1,98 @@
+"""
+Parity of --merge_engine builtin with 'paktool merge'.
+
+Needs the real pak tools: set PAK_TOOLS_DIR to a pak tools directory (with
+paktool and pymod/pakcore.py), for example
+<sbe>/public/src/import/public/common/utils/imageProcs/tools. The stand-ins
+of bench/sbe_tools implement merge the same way as the builtin engine, so
+they don't prove anything here.
+"""
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import imageBuild
+
+PAK_TOOLS_DIR = os.environ.get('PAK_TOOLS_DIR')
+
+@unittest.skipUnless(PAK_TOOLS_DIR, "PAK_TOOLS_DIR is not set")
+class MergeParityTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.builders = {}
+        for engine in ('paktool', 'builtin'):
+            options = imageBuild.defaultOptions(ovrd=self.tmp, merge_engine=engine)
+            builder = imageBuild.ImageBuilder(options)
+            builder.loadPakTools(PAK_TOOLS_DIR)
+            builder.pakTool = os.path.join(PAK_TOOLS_DIR, 'paktool')
+            builder.mergedDir = os.path.join(self.tmp, engine)
+            os.makedirs(builder.mergedDir)
+            self.builders[engine] = builder
+        self.pak = self.builders['builtin'].pak
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def archive(self, name, entries):
+        path = os.path.join(self.tmp, name)
+        archive = self.pak.Archive(path)
+        for (entryName, method, data) in entries:
+            archive.add(entryName, method, data)
+        archive.save()
+        return path
+
+    def merge(self, engine, archives, baseEntries=()):
+        builder = self.builders[engine]
+        archive = builder.mergeArchives('section', archives, list(baseEntries))
+        archive.save()
+        with open(os.path.join(builder.mergedDir, 'section.pak'), 'rb') as f:
+            return f.read()
+
+    def assertParity(self, archives, baseEntries=()):
+        self.assertEqual(self.merge('builtin', archives, baseEntries),
+                         self.merge('paktool', archives, baseEntries))
+
+    def representative(self):
+        CM = self.pak.CM
+        return [self.archive('a.pak', [('rt/sppe.bin', CM.zlib, os.urandom(4096) * 4),
+                                       ('info.txt', CM.store, b'build info\n'),
+                                       ('rt/empty.bin', CM.store, b'')]),
+                self.archive('b.pak', [('rt/ekb/z.bin', CM.zlib, b'z' * 10000),
+                                       ('rt/ekb/a.bin', CM.store, os.urandom(333))]),
+                self.archive('c.pak', [('rt/sbebuildinfo.bin', CM.store, b'x' * 100)])]
+
+    def testOrdering(self):
+        self.assertParity(self.representative())
+        self.assertParity(list(reversed(self.representative())))
+
+    def testBaseEntries(self):
+        partTbl = os.path.join(self.tmp, 'part.tbl')
+        with open(partTbl, 'wb') as f:
+            f.write(b'\x01\x02' * 64)
+        self.assertParity(self.representative(),
+                          [('part.tbl', partTbl), ('rt/attr.ovrd', 'EMPTY')])
+
+    def testEmptyInputList(self):
+        self.assertParity([])
+        self.assertParity([], [('rt/attr.ovrd', 'EMPTY')])
+
+    def testEmptyArchive(self):
+        self.assertParity([self.archive('empty.pak', [])] + self.representative())
+
+    def testDuplicates(self):
+        CM = self.pak.CM
+        first = self.archive('d1.pak', [('rt/dup.bin', CM.store, b'first')])
+        second = self.archive('d2.pak', [('rt/dup.bin', CM.store, b'second')])
+        results = {}
+        for engine in ('paktool', 'builtin'):
+            try:
+                results[engine] = self.merge(engine, [first, second])
+            except SystemExit:
+                results[engine] = 'failed'
+        self.assertEqual(results['builtin'], results['paktool'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+"""
+Section cache shared by builds that evict each other's entries.
+"""
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import imageBuild
+
+class SectionCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.cacheDir = os.path.join(self.tmp, 'sections')
+        self.src = os.path.join(self.tmp, 'section.pak')
+        with open(self.src, 'wb') as f:
+            f.write(b'p' * 1000)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def testGetEvicted(self):
+        imageBuild.sectionCachePut(self.cacheDir, 'a', self.src, 10000)
+        os.remove(os.path.join(self.cacheDir, 'a.pak'))
+        dst = os.path.join(self.tmp, 'out.pak')
+        self.assertFalse(imageBuild.sectionCacheGet(self.cacheDir, 'a', dst))
+
+    def testGet(self):
+        imageBuild.sectionCachePut(self.cacheDir, 'a', self.src, 10000)
+        dst = os.path.join(self.tmp, 'out.pak')
+        self.assertTrue(imageBuild.sectionCacheGet(self.cacheDir, 'a', dst))
+        with open(dst, 'rb') as f:
+            self.assertEqual(f.read(), b'p' * 1000)
+
+    def testPutEvictedByOtherBuild(self):
+        imageBuild.sectionCachePut(self.cacheDir, 'a', self.src, 10000)
+        imageBuild.sectionCachePut(self.cacheDir, 'b', self.src, 10000)
+        listdir = os.listdir
+        def evictingListdir(path):
+            names = listdir(path)
+            # Another build removes 'a' after it was listed
+            os.remove(os.path.join(self.cacheDir, 'a.pak'))
+            return names
+        with mock.patch('os.listdir', evictingListdir):
+            imageBuild.sectionCachePut(self.cacheDir, 'c', self.src, 1500)
+        self.assertEqual(sorted(os.listdir(self.cacheDir)), ['c.pak'])
+
+if __name__ == '__main__':
+    unittest.main()
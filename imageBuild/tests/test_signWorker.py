@@ -0,0 +1,137 @@
+"""
+signWorker.py driven with the stand-in imageTool.py and pak tools of
+bench/sbe_tools: concurrent builds, results identical to running
+imageTool.py directly, and the zygote kept warm between jobs.
+"""
+import os
+import sys
+import json
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+import subprocess
+import importlib.util
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import signWorker
+
+BENCH_TOOLS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                           'bench', 'sbe_tools')
+
+class SignWorkerTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.toolsDir = os.path.join(self.tmp, 'sbe_tools')
+        shutil.copytree(BENCH_TOOLS, self.toolsDir,
+                        ignore=shutil.ignore_patterns('__pycache__'))
+        self.tool = os.path.join(self.toolsDir, 'imageTool.py')
+        self.pakToolDir = os.path.join(self.toolsDir, 'tools')
+
+        # The stand-in pakcore under a name of its own, the real one may be
+        # imported by other tests
+        spec = importlib.util.spec_from_file_location(
+            'benchPakcore', os.path.join(self.pakToolDir, 'pymod', 'pakcore.py'))
+        self.pak = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(self.pak)
+
+        self.socketPath = os.path.join(self.tmp, 'sign.sock')
+        self.server = signWorker.SignWorker(self.socketPath, 0.0, 4)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmp)
+
+    def archive(self, path, sectionName):
+        archive = self.pak.Archive(path)
+        archive.add(sectionName + '/sppe.bin', self.pak.CM.zlib, os.urandom(1024) * 4)
+        archive.add(sectionName + '/hash.list', self.pak.CM.store, os.urandom(64))
+        archive.save()
+
+    def build(self, name):
+        # The sections of one build, with a copy to sign without the worker
+        buildDir = os.path.join(self.tmp, name)
+        os.makedirs(buildDir)
+        pakFiles = {}
+        for sectionName in ('rt', 'bmc'):
+            pakFiles[sectionName] = os.path.join(buildDir, sectionName + '.pak')
+            self.archive(pakFiles[sectionName], sectionName)
+            shutil.copy(pakFiles[sectionName], pakFiles[sectionName] + '.ref')
+        return pakFiles
+
+    def request(self, command, pakFiles):
+        return signWorker.request(self.socketPath, command, self.tool, self.pakToolDir, pakFiles)
+
+    def runDirect(self, command, pakFiles):
+        cmd = [sys.executable, self.tool, '--pakToolDir', self.pakToolDir, command,
+               '--pakFiles'] + ["%s=%s" % (name, path) for (name, path) in pakFiles.items()]
+        subprocess.run(cmd, check=True)
+
+    def read(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def testConcurrentBuilds(self):
+        builds = [self.build('build%d' % i) for i in range(3)]
+        results = [None] * len(builds)
+        def sign(i):
+            results[i] = [self.request(command, builds[i]) for command in ('signPak', 'pakHash')]
+        threads = [threading.Thread(target=sign, args=(i,)) for i in range(len(builds))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        for (pakFiles, result) in zip(builds, results):
+            for commandResult in result:
+                self.assertEqual(commandResult['rc'], 0, commandResult['output'])
+                self.assertEqual(commandResult['sections'], {'rt': 0, 'bmc': 0})
+            refFiles = {name: path + '.ref' for (name, path) in pakFiles.items()}
+            self.runDirect('signPak', refFiles)
+            self.runDirect('pakHash', refFiles)
+            for (name, path) in pakFiles.items():
+                self.assertEqual(self.read(path), self.read(refFiles[name]))
+                archive = self.pak.Archive(path)
+                archive.load()
+                self.assertIn(name + '/hash.list.sig', [entry.name for entry in archive])
+
+        # All jobs ran in children of one zygote
+        self.assertEqual(len(self.server.zygotes), 1)
+
+    def testWarm(self):
+        self.request('signPak', self.build('first'))
+        zygote = self.server.zygotes[(self.tool, self.pakToolDir)]
+        self.assertEqual(self.request('signPak', self.build('second'))['rc'], 0)
+        self.assertIs(self.server.zygotes[(self.tool, self.pakToolDir)], zygote)
+        self.assertIsNone(zygote.proc.poll())
+
+    def testToolChanged(self):
+        self.request('signPak', self.build('first'))
+        zygote = self.server.zygotes[(self.tool, self.pakToolDir)]
+        st = os.stat(self.tool)
+        os.utime(self.tool, ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+        self.assertEqual(self.request('signPak', self.build('second'))['rc'], 0)
+        self.assertIsNot(self.server.zygotes[(self.tool, self.pakToolDir)], zygote)
+        zygote.proc.wait(10)
+
+    def testFailure(self):
+        result = self.request('signPak', {'rt': os.path.join(self.tmp, 'none.pak')})
+        self.assertNotEqual(result['rc'], 0)
+        self.assertEqual(result['sections'], {'rt': result['rc']})
+        self.assertIn('Traceback', result['output'])
+        # The zygote survives a failed job
+        self.assertEqual(self.request('signPak', self.build('after'))['rc'], 0)
+
+    def testInvalidRequest(self):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.connect(self.socketPath)
+            sock.sendall(b'{"command": "signPak"}\n')
+            with sock.makefile('rb') as f:
+                result = json.loads(f.readline())
+        self.assertEqual(result['rc'], 1)
+
+if __name__ == '__main__':
+    unittest.main()